@@ -0,0 +1,539 @@
+#!/usr/bin/python
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+# A tiny stand-in for a wiki's api.php, good enough to measure mw against
+# without hammering a real site. It answers the queries, edits, logins,
+# category and allpages listings mw makes, and serves and takes uploads
+# for File: pages. Every revision shows up in recent changes, and a
+# page's history can be paged through. Titles that were never created
+# exist anyway, with one revision whose text is derived from the title.
+#
+# usage: bench/fakewiki.py [PORT] [LATENCY_MS]
+
+import BaseHTTPServer
+import cgi
+import gzip
+import hashlib
+import json
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+from StringIO import StringIO
+
+TOKEN = 'fake+\\'
+FILLER = [u'Lorem', u'ipsum', u'dolor', u'sit', u'amet', u'[[link]]',
+          u'{{template}}', u'consectetur', u'adipiscing', u'elit.']
+NAMESPACES = {u'User': 2, u'File': 6, u'Template': 10, u'Category': 14,
+              u'Module': 828}
+# mixed into titles and text to exercise the UTF-8 paths
+UNICODE = [u'Stra\xdfe', u'\u65e5\u672c\u8a9e', u'\u0420\u043e\u0441\u0441\u0438\u044f',
+           u'caf\xe9', u'\u03bb\u03cc\u03b3\u03bf\u03c2']
+
+
+def _from(value, start, newer):
+    # whether `value` comes at or after `start` when listing in the
+    # direction given by rcdir/rvdir
+    if newer:
+        return value >= start
+    return value <= start
+
+
+class FakeWiki(object):
+
+    def __init__(self, page_size=2000, highlimits=False, depth=1,
+                 unicode_mix=0.0, seed=0):
+        self.page_size = page_size
+        self.highlimits = highlimits
+        self.depth = depth
+        self.unicode_mix = unicode_mix
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.revisions = {}
+        self.categories = {}
+        self.changes = []
+        self.requests = 0
+        self.edits = 0
+        self.files = {}
+        self.stash = {}
+        self.uploads = 0
+        self.downloads = 0
+        self.largest_chunk = 0
+
+    def populate(self, count, category=None, namespace=None):
+        """Create `count` pages and return their titles."""
+        titles = []
+        for i in xrange(count):
+            title = u'Bench page %d' % i
+            if self.random.random() < self.unicode_mix:
+                title = u'Bench %s %d' % (self.random.choice(UNICODE), i)
+            if namespace is not None:
+                title = u'%s:%s' % (namespace, title)
+            self.page(title)
+            titles.append(title)
+        if category is not None:
+            self.categories[category] = titles
+        return titles
+
+    def populate_files(self, count, size=100000):
+        """Create `count` File: pages with uploads; returns the titles."""
+        titles = []
+        for i in xrange(count):
+            title = u'File:Bench %d.png' % i
+            data = ''.join(chr(self.random.randrange(256))
+                           for j in xrange(size))
+            self.page(title)
+            with self.lock:
+                self._set_file(title, data)
+            titles.append(title)
+        return titles
+
+    def _set_file(self, title, data):
+        # with self.lock held
+        self.files[title] = {
+            'data': data,
+            'sha1': hashlib.sha1(data).hexdigest(),
+            'timestamp': '2011-01-01T00:00:%02dZ' % (len(self.files) % 60),
+        }
+
+    def file_by_pageid(self, pageid):
+        with self.lock:
+            for title, page in self.pages.items():
+                if page['pageid'] == pageid and title in self.files:
+                    self.downloads += 1
+                    return self.files[title]['data']
+        return None
+
+    def text(self, title, revision):
+        words = []
+        size = len(title) + 2
+        while size < self.page_size:
+            if self.random.random() < self.unicode_mix:
+                word = self.random.choice(UNICODE)
+            else:
+                word = self.random.choice(FILLER)
+            words.append(word)
+            size += len(word) + 1
+        return u'%s (%d)\n\n%s' % (title, revision, u' '.join(words))
+
+    def page(self, title):
+        with self.lock:
+            if title not in self.pages:
+                self.pages[title] = {
+                    'pageid': len(self.pages) + 1,
+                    'title': title,
+                    'ns': NAMESPACES.get(title.split(u':')[0], 0),
+                    'revisions': [],
+                }
+                for revision in xrange(self.depth):
+                    self._add_revision(title, self.text(title, revision),
+                                       'fake revision')
+            return self.pages[title]
+
+    def _add_revision(self, title, text, comment):
+        # with self.lock held
+        page = self.pages[title]
+        revid = len(self.revisions) + 1
+        rv = {
+            'revid': revid,
+            'user': 'Fake',
+            'timestamp': '2011-01-01T%02d:%02d:%02dZ' % (
+                    revid / 3600 % 24, revid / 60 % 60, revid % 60),
+            'comment': comment,
+            '*': text,
+        }
+        if page['revisions']:
+            kind = 'edit'
+        else:
+            kind = 'new'
+        page['revisions'].append(rv)
+        page['lastrevid'] = revid
+        page['length'] = len(text)
+        self.revisions[revid] = (title, rv)
+        self.changes.append({
+            'rcid': len(self.changes) + 1,
+            'type': kind,
+            'ns': page['ns'],
+            'title': title,
+            'pageid': page['pageid'],
+            'revid': revid,
+            'timestamp': rv['timestamp'],
+        })
+        return rv
+
+    def _limit(self, params, name, content=False):
+        # what 'max' means for the account, as the real api works it out
+        limit = params.get(name, 'max')
+        if limit != 'max':
+            return int(limit)
+        if content:
+            limit = 50
+        else:
+            limit = 500
+        if self.highlimits:
+            limit *= 10
+        return limit
+
+    def _recentchanges(self, params):
+        # newest first unless rcdir=newer, rclimit at a time; rcstart and
+        # rcend bound the timestamps, rccontinue is the rcid to go on from
+        newer = params.get('rcdir', 'older') == 'newer'
+        with self.lock:
+            changes = list(self.changes)
+        if not newer:
+            changes.reverse()
+        if 'rcstart' in params:
+            changes = [change for change in changes
+                       if _from(change['timestamp'], params['rcstart'],
+                                newer)]
+        if 'rcend' in params:
+            changes = [change for change in changes
+                       if _from(params['rcend'], change['timestamp'],
+                                newer)]
+        if 'rccontinue' in params:
+            changes = [change for change in changes
+                       if _from(change['rcid'], int(params['rccontinue']),
+                                newer)]
+        if 'rctype' in params:
+            kinds = params['rctype'].split('|')
+            changes = [change for change in changes
+                       if change['type'] in kinds]
+        limit = self._limit(params, 'rclimit')
+        prop = params.get('rcprop', 'title|timestamp|ids').split('|')
+        keys = ['type']
+        if 'title' in prop:
+            keys += ['ns', 'title']
+        if 'ids' in prop:
+            keys += ['rcid', 'pageid', 'revid']
+        if 'timestamp' in prop:
+            keys += ['timestamp']
+        listed = [dict((key, change[key]) for key in keys)
+                  for change in changes[:limit]]
+        if len(changes) > limit:
+            return listed, {'rccontinue': str(changes[limit]['rcid']),
+                            'continue': '-||'}
+        return listed, None
+
+    def _history(self, title, params):
+        # a page's revisions, newest first unless rvdir=newer, rvlimit at
+        # a time from rvstartid or rvstart; rvcontinue is the revid to go
+        # on from
+        page = self.page(title)
+        newer = params.get('rvdir', 'older') == 'newer'
+        with self.lock:
+            revisions = list(page['revisions'])
+        if not newer:
+            revisions.reverse()
+        startid = params.get('rvcontinue', params.get('rvstartid'))
+        if startid is not None:
+            revisions = [rv for rv in revisions
+                         if _from(rv['revid'], int(startid), newer)]
+        if 'rvstart' in params:
+            revisions = [rv for rv in revisions
+                         if _from(rv['timestamp'], params['rvstart'], newer)]
+        limit = self._limit(params, 'rvlimit',
+                            'content' in params.get('rvprop', ''))
+        if len(revisions) > limit:
+            return revisions[:limit], {
+                    'rvcontinue': str(revisions[limit]['revid']),
+                    'continue': '||'}
+        return revisions, None
+
+    def _page_info(self, title, params, revisions=None):
+        page = self.page(title)
+        info = dict((key, page[key]) for key in
+                    ['pageid', 'title', 'ns', 'lastrevid', 'length'])
+        if 'revisions' in params.get('prop', ''):
+            info['revisions'] = []
+            if revisions is None:
+                revisions = [page['revisions'][-1]]
+            for rv in revisions:
+                rv = dict(rv)
+                if 'sha1' in params.get('rvprop', ''):
+                    rv['sha1'] = hashlib.sha1(
+                            rv['*'].encode('utf-8')).hexdigest()
+                if 'size' in params.get('rvprop', ''):
+                    rv['size'] = len(rv['*'].encode('utf-8'))
+                if 'content' not in params.get('rvprop', 'content'):
+                    del rv['*']
+                info['revisions'].append(rv)
+        if 'imageinfo' in params.get('prop', '') and title in self.files:
+            media = self.files[title]
+            info['imageinfo'] = [{
+                'url': '/media/%d' % page['pageid'],
+                'sha1': media['sha1'],
+                'size': len(media['data']),
+                'timestamp': media['timestamp'],
+            }]
+        if params.get('intoken') == 'edit':
+            info['edittoken'] = TOKEN
+        return info
+
+    def call(self, params):
+        with self.lock:
+            self.requests += 1
+        action = params.get('action')
+        if action == 'login':
+            return self.login(params)
+        if action == 'edit':
+            return self.edit(params)
+        if action == 'upload':
+            return self.upload(params)
+        if action != 'query':
+            return {'error': {'code': 'unknown_action',
+                              'info': 'Unrecognized value for parameter '
+                                      "'action'"}}
+        query = {}
+        response = {'query': query}
+        if params.get('meta') == 'userinfo':
+            rights = ['read', 'edit']
+            if self.highlimits:
+                rights.append('apihighlimits')
+            query['userinfo'] = {'id': 1, 'name': 'Fake', 'rights': rights}
+        if params.get('meta') == 'tokens':
+            query['tokens'] = {'csrftoken': TOKEN}
+        if params.get('list') == 'recentchanges':
+            query['recentchanges'], more = self._recentchanges(params)
+            if more is not None:
+                response['continue'] = more
+        if params.get('list') == 'categorymembers':
+            members = self.categories.get(params['cmtitle'], [])
+            start = int(params.get('cmcontinue', 0))
+            limit = self._limit(params, 'cmlimit')
+            query['categorymembers'] = [
+                    {'ns': NAMESPACES.get(title.split(u':')[0], 0),
+                     'title': title}
+                    for title in members[start:start + limit]]
+            if start + limit < len(members):
+                response['continue'] = {'cmcontinue': str(start + limit),
+                                        'continue': '-||'}
+        pages = {}
+        if params.get('generator') == 'allpages':
+            # page titles in order, gaplimit at a time
+            namespace = int(params.get('gapnamespace', 0))
+            prefix = params.get('gapprefix', u'')
+            with self.lock:
+                titles = sorted(title for title, page in self.pages.items()
+                                if page['ns'] == namespace)
+            if namespace:
+                names = [title.split(u':', 1)[1] for title in titles]
+            else:
+                names = titles
+            matching = [(name, title) for name, title in zip(names, titles)
+                        if name.startswith(prefix) and
+                        name >= params.get('gapcontinue', u'')]
+            limit = int(params.get('gaplimit', 10))
+            for name, title in matching[:limit]:
+                info = self._page_info(title, params)
+                pages[str(info['pageid'])] = info
+            if len(matching) > limit:
+                response['continue'] = {'gapcontinue': matching[limit][0],
+                                        'continue': 'gapcontinue||'}
+        if 'titles' in params:
+            titles = params['titles'].split('|')
+            history = 'revisions' in params.get('prop', '') and [
+                    name for name in ['rvlimit', 'rvdir', 'rvstart',
+                                      'rvstartid', 'rvcontinue']
+                    if name in params]
+            if history and len(titles) > 1:
+                return {'error': {'code': 'rvmultpages',
+                                  'info': 'rvlimit may only be used with a '
+                                          'single page'}}
+            for title in titles:
+                revisions = None
+                if history:
+                    revisions, more = self._history(title, params)
+                    if more is not None:
+                        response['continue'] = more
+                info = self._page_info(title, params, revisions)
+                pages[str(info['pageid'])] = info
+        if 'revids' in params:
+            for revid in params['revids'].split('|'):
+                with self.lock:
+                    title, rv = self.revisions[int(revid)]
+                info = self._page_info(title, params, [rv])
+                pages[str(info['pageid'])] = info
+        if pages:
+            query['pages'] = pages
+        return response
+
+    def login(self, params):
+        if 'lgtoken' not in params:
+            return {'login': {'result': 'NeedToken', 'token': 'logintoken'}}
+        return {'login': {'result': 'Success', 'lgusername':
+                          params['lgname']}}
+
+    def edit(self, params):
+        if params.get('token') != TOKEN:
+            return {'error': {'code': 'badtoken', 'info': 'Invalid token'}}
+        page = self.page(params['title'])
+        with self.lock:
+            oldrevid = page['lastrevid']
+            # the one pre-save transform we do: signatures
+            params['text'] = params['text'].replace(u'~~~~',
+                                                    u'[[User:Fake|Fake]]')
+            if page['revisions'][-1]['*'] == params['text']:
+                return {'edit': {'result': 'Success', 'nochange': '',
+                                 'pageid': page['pageid'],
+                                 'title': page['title']}}
+            rv = self._add_revision(page['title'], params['text'],
+                                    params.get('summary', ''))
+            self.edits += 1
+        return {'edit': {'result': 'Success', 'pageid': page['pageid'],
+                         'title': page['title'], 'oldrevid': oldrevid,
+                         'newrevid': rv['revid'],
+                         'newtimestamp': rv['timestamp']}}
+
+    def upload(self, params):
+        # chunks go to the stash, then the stashed file is published
+        if params.get('token') != TOKEN:
+            return {'error': {'code': 'badtoken', 'info': 'Invalid token'}}
+        title = u'File:' + params['filename']
+        with self.lock:
+            if 'chunk' in params:
+                key = params.get('filekey') or 'stash%d' % len(self.stash)
+                data = self.stash.get(key, '')
+                if int(params['offset']) != len(data):
+                    return {'error': {'code': 'badoffset',
+                                      'info': 'wrong offset'}}
+                self.largest_chunk = max(self.largest_chunk,
+                                         len(params['chunk']))
+                self.stash[key] = data + params['chunk']
+                if len(self.stash[key]) < int(params['filesize']):
+                    return {'upload': {'result': 'Continue', 'filekey': key,
+                                       'offset': len(self.stash[key])}}
+                return {'upload': {'result': 'Success', 'filekey': key}}
+            if params.get('filekey') not in self.stash:
+                return {'error': {'code': 'missingparam',
+                                  'info': 'no such file in the stash'}}
+            self._set_file(title, self.stash.pop(params['filekey']))
+            self.uploads += 1
+            media = self.files[title]
+        # a new version of a file makes a null revision of its page
+        page = self.page(title)
+        with self.lock:
+            self._add_revision(title, page['revisions'][-1]['*'],
+                               params.get('comment', ''))
+        return {'upload': {'result': 'Success',
+                           'filename': params['filename'],
+                           'imageinfo': {'sha1': media['sha1'],
+                                         'timestamp': media['timestamp']}}}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive, like a real wiki
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path.startswith('/media/'):
+            self.send_media(int(url.path[len('/media/'):]))
+            return
+        self.respond(urlparse.parse_qs(url.query))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        if self.headers.getheader('content-type', '').startswith(
+                'multipart/form-data'):
+            form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                    environ={'REQUEST_METHOD': 'POST'})
+            params = {}
+            for key in form.keys():
+                if form[key].filename is not None:
+                    params[key] = form[key].value  # file data stays bytes
+                else:
+                    params[key] = [form[key].value]
+            self.respond(params)
+            return
+        self.respond(urlparse.parse_qs(self.rfile.read(length)))
+
+    def send_media(self, pageid):
+        data = self.server.wiki.file_by_pageid(pageid)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def respond(self, params):
+        params = dict((k, v if isinstance(v, str) else v[-1].decode('utf-8'))
+                      for k, v in params.items())
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = json.dumps(self.server.wiki.call(params))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        if 'gzip' in self.headers.getheader('accept-encoding', ''):
+            buf = StringIO()
+            fd = gzip.GzipFile(fileobj=buf, mode='wb')
+            fd.write(body)
+            fd.close()
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients drop idle keep-alive connections whenever they like
+        pass
+
+
+def start(wiki=None, port=0, latency=0):
+    """Serve `wiki` from a background thread; returns the server."""
+    server = Server(('127.0.0.1', port), Handler)
+    server.wiki = wiki or FakeWiki()
+    server.latency = latency
+    server.url = 'http://127.0.0.1:%d/api.php' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    port = 8080
+    latency = 0
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        latency = int(sys.argv[2]) / 1000.0
+    server = start(port=port, latency=latency)
+    print 'serving %s' % server.url
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+# Time `mw pull` of N pages inside a checkout that already tracks many
+# more. The time per pulled page should stay flat as N grows; if it grows
+# with N (or with the size of the checkout) pull is rescanning the tree.
+#
+# usage: bench/pull_scaling.py [TRACKED_PAGES]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import mw.clicommands
+import mw.metadir
+import mw.transport
+
+
+class FakeTransport(object):
+    """Answers the queries pull makes from memory, without any HTTP."""
+
+    def __init__(self, api_url, cookie_file=None):
+        self.api_url = api_url
+
+    def call(self, data):
+        if data.get('meta') == 'userinfo':
+            return {'query': {'userinfo': {'id': 1, 'rights': []}}}
+        # title n has pageid and revid 1000000 + n
+        if 'revids' in data:
+            ids = [int(revid) for revid in data['revids'].split('|')]
+        else:
+            ids = [1000000 + int(title.split()[-1])
+                   for title in data['titles'].split('|')]
+        pages = {}
+        for pageid in ids:
+            title = u'Bench page %d' % (pageid - 1000000)
+            text = u'%s\n\n%s' % (title, 'Lorem ipsum dolor. ' * 100)
+            pages[str(pageid)] = {
+                'pageid': pageid,
+                'title': title,
+                'ns': 0,
+                'lastrevid': pageid,
+                'length': len(text),
+            }
+            if 'revisions' in data['prop']:
+                pages[str(pageid)]['revisions'] = [{
+                    'revid': pageid,
+                    'user': 'Bench',
+                    'timestamp': '2011-01-01T00:00:00Z',
+                    'comment': 'benchmark',
+                    '*': text,
+                }]
+        return {'query': {'pages': pages}}
+
+
+def make_checkout(root, tracked):
+    os.chdir(root)
+    metadir = mw.metadir.Metadir()
+    metadir.create('http://localhost/api.php')
+    metadir.config.set('pull', 'rate', '0')  # measure us, not the limit
+    metadir.save_config()
+    metadir = mw.metadir.Metadir()
+    for i in xrange(tracked):
+        pagename = u'Tracked page %d' % i
+        content = u'tracked %d' % i
+        metadir.pagedict_add(pagename, i + 1, i + 1)
+        metadir.pages_add_rv(i + 1, {'revid': i + 1, 'user': 'Bench',
+                                     'timestamp': '2011-01-01T00:00:00Z',
+                                     '*': content})
+        fd = file(mw.metadir.pagename_to_filename(pagename) + '.wiki', 'w')
+        fd.write(content.encode('utf-8'))
+        fd.close()
+    metadir.cache_commit()
+    # warm the index the way a user's earlier `mw status` would have
+    metadir.working_dir_status()
+
+
+def time_pull(root, count):
+    os.chdir(root)
+    pull = mw.clicommands.PullCommand()
+    pull.args = ['Bench page %d' % i for i in xrange(count)]
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        pull._do_command()
+        return time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def main():
+    tracked = 2000
+    if len(sys.argv) > 1:
+        tracked = int(sys.argv[1])
+    mw.transport.Transport = FakeTransport
+    print 'checkout tracking %d pages' % tracked
+    print '%8s %10s %14s' % ('pages', 'seconds', 'ms per page')
+    for count in [100, 200, 400, 800]:
+        root = tempfile.mkdtemp(prefix='mw-bench-')
+        try:
+            make_checkout(root, tracked)
+            elapsed = time_pull(root, count)
+        finally:
+            os.chdir('/')
+            shutil.rmtree(root)
+        print '%8d %10.3f %14.3f' % (count, elapsed, elapsed * 1000 / count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+# Pull the same set of pages from bench/fakewiki.py with different numbers
+# of requests in flight and report pages per second.
+#
+# usage: bench/pull_throughput.py [PAGES] [LATENCY_MS]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import fakewiki
+import mw.clicommands
+import mw.metadir
+
+
+def time_pull(url, count, jobs):
+    root = tempfile.mkdtemp(prefix='mw-bench-')
+    stdout = sys.stdout
+    try:
+        os.chdir(root)
+        metadir = mw.metadir.Metadir()
+        metadir.create(url)
+        metadir.config.set('pull', 'rate', '0')  # measure us, not the limit
+        metadir.save_config()
+        pull = mw.clicommands.PullCommand()
+        (pull.options, pull.args) = pull.parser.parse_args(
+                ['-j', str(jobs)] + ['Bench page %d' % i
+                                     for i in xrange(count)])
+        sys.stdout = open(os.devnull, 'w')
+        start = time.time()
+        pull._do_command()
+        elapsed = time.time() - start
+        pull.api.close()
+        return elapsed
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+        os.chdir('/')
+        shutil.rmtree(root)
+
+
+def main():
+    count = 2000
+    latency = 50
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        latency = int(sys.argv[2])
+    server = fakewiki.start(latency=latency / 1000.0)
+    print '%d pages, %d ms simulated latency' % (count, latency)
+    print '%6s %10s %14s' % ('jobs', 'seconds', 'pages/second')
+    for jobs in [1, 2, 4, 8]:
+        elapsed = time_pull(server.url, count, jobs)
+        print '%6d %10.3f %14.1f' % (jobs, elapsed, count / elapsed)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
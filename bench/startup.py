@@ -0,0 +1,128 @@
+#!/usr/bin/python
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+# How long `mw status` takes on a clean checkout, from exec to exit, and
+# which imports that time goes to (like python3's -X importtime). A
+# clean `mw st` should stay under 50 ms so it can live in a shell prompt.
+#
+# usage: bench/startup.py [PAGES]
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+src = os.path.join(here, '..', 'src')
+sys.path.insert(0, src)
+import mw.metadir
+
+RUNS = 20
+
+# run inside the child: time every module's first import, including
+# whatever it imports itself
+IMPORTTIME = '''
+import __builtin__, sys, time
+real_import = __builtin__.__import__
+depth = [0]
+times = []
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return real_import(name, *args, **kwargs)
+    depth[0] += 1
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        depth[0] -= 1
+        times.append((time.time() - start, depth[0], name))
+__builtin__.__import__ = timed_import
+sys.argv = ['mw', 'status']
+try:
+    execfile(%r)
+finally:
+    for elapsed, level, name in sorted(times, reverse=True)[:12]:
+        sys.stderr.write('%%8.2f ms  %%s%%s\\n' %% (elapsed * 1000,
+                                                  '  ' * level, name))
+'''
+
+
+def make_checkout(root, pages):
+    os.chdir(root)
+    metadir = mw.metadir.Metadir()
+    metadir.create('http://localhost/api.php')
+    metadir = mw.metadir.Metadir()
+    for i in xrange(pages):
+        pagename = u'Page %d' % i
+        metadir.pagedict_add(pagename, i + 1, i + 1)
+        metadir.pages_add_rv(i + 1, {'revid': i + 1, 'user': 'Bench',
+                                     'timestamp': '2011-01-01T00:00:00Z',
+                                     '*': pagename})
+        fd = file(mw.metadir.pagename_to_filename(pagename) + '.wiki', 'w')
+        fd.write(pagename.encode('utf-8'))
+        fd.close()
+    metadir.cache_commit()
+    metadir.working_dir_status()
+
+
+def median_ms(argv, env):
+    times = []
+    for i in range(RUNS):
+        start = time.time()
+        subprocess.check_call(argv, env=env, stdout=open(os.devnull, 'w'))
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) / 2] * 1000
+
+
+def main():
+    pages = 1000
+    if len(sys.argv) > 1:
+        pages = int(sys.argv[1])
+    mw_script = os.path.join(here, '..', 'bin', 'mw')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.abspath(src)] +
+            [p for p in [os.environ.get('PYTHONPATH')] if p])
+    root = tempfile.mkdtemp(prefix='mw-bench-')
+    try:
+        make_checkout(root, pages)
+        # make sure the index is old enough to be trusted
+        time.sleep(1.1)
+        subprocess.check_call([sys.executable, mw_script, 'status'], env=env)
+        print 'clean checkout of %d pages, median of %d runs' % (pages, RUNS)
+        print '%10.1f ms  python -c pass' % median_ms(
+                [sys.executable, '-c', 'pass'], env)
+        print '%10.1f ms  import mw.cli' % median_ms(
+                [sys.executable, '-c', 'import mw.cli'], env)
+        print '%10.1f ms  mw status' % median_ms(
+                [sys.executable, mw_script, 'status'], env)
+        print
+        print 'slowest imports during mw status:'
+        subprocess.check_call([sys.executable, '-c',
+                               IMPORTTIME % os.path.abspath(mw_script)],
+                              env=env, stdout=open(os.devnull, 'w'))
+    finally:
+        os.chdir('/')
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
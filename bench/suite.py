@@ -0,0 +1,293 @@
+#!/usr/bin/python
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+# Time the everyday commands (startup, pull, pullcat, pull --namespace,
+# pull --history, a bare pull after edits on the wiki, status, diff,
+# commit) against a synthetic wiki served by
+# bench/fakewiki.py from this process. Every run starts from the same
+# seed, so two runs with the same options see exactly the same pages and
+# can be compared: --out saves the results as JSON, --baseline compares
+# against an earlier --out and exits 1 if anything got slower by more
+# than --threshold.
+#
+# usage: bench/suite.py [options]
+
+import ConfigParser
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+src = os.path.join(here, '..', 'src')
+mw_script = os.path.join(here, '..', 'bin', 'mw')
+import fakewiki
+
+CATEGORY = u'Category:Bench'
+# differences smaller than this are noise whatever the ratio
+NOISE = 0.02
+
+
+def parse_args():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--pages', type='int', default=500,
+                      help='number of pages on the wiki (default: 500)')
+    parser.add_option('--page-size', type='int', default=2000,
+                      help='size of each page in characters (default: 2000)')
+    parser.add_option('--depth', type='int', default=1,
+                      help='revisions per page (default: 1)')
+    parser.add_option('--unicode', type='float', default=0.1,
+                      help='fraction of titles and words that are not '
+                      'ASCII (default: 0.1)')
+    parser.add_option('--latency', type='int', default=0,
+                      help='simulated latency per request in ms (default: 0)')
+    parser.add_option('--edits', type='int', default=10,
+                      help='pages changed for diff and commit (default: 10)')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='runs of each benchmark (default: 5)')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed for the synthetic wiki (default: 0)')
+    parser.add_option('--only', action='append', metavar='NAME',
+                      help='only run this benchmark (may be given more than '
+                      'once)')
+    parser.add_option('--out', metavar='FILE',
+                      help='write the results to FILE as JSON')
+    parser.add_option('--baseline', metavar='FILE',
+                      help='compare against the results in FILE')
+    parser.add_option('--threshold', type='float', default=0.2,
+                      help='slowdown against the baseline that counts as a '
+                      'regression (default: 0.2, i.e. 20%)')
+    options, args = parser.parse_args()
+    if args:
+        parser.error('no arguments expected')
+    return options
+
+
+class Suite(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.wiki = fakewiki.FakeWiki(page_size=options.page_size,
+                                      depth=options.depth,
+                                      unicode_mix=options.unicode,
+                                      seed=options.seed)
+        self.titles = self.wiki.populate(options.pages, CATEGORY)
+        self.server = fakewiki.start(self.wiki,
+                                     latency=options.latency / 1000.0)
+        self.random = random.Random(options.seed)
+        self.root = tempfile.mkdtemp(prefix='mw-bench-')
+        self.env = dict(os.environ)
+        self.env['PYTHONPATH'] = os.pathsep.join(
+                [src] + filter(None, [os.environ.get('PYTHONPATH')]))
+        # the same filename and output encoding whatever the caller's
+        # locale, and output goes to /dev/null rather than a terminal
+        self.env['LC_ALL'] = 'C.UTF-8'
+        self.env['PYTHONIOENCODING'] = 'utf-8'
+        self.results = {}
+
+    def close(self):
+        self.server.shutdown()
+        shutil.rmtree(self.root)
+
+    def mw(self, checkout, *args):
+        """Run mw in `checkout`; returns (seconds, api requests)."""
+        requests = self.wiki.requests
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            code = subprocess.call([sys.executable, mw_script] + list(args),
+                                   cwd=checkout, env=self.env, stdout=devnull)
+        elapsed = time.time() - start
+        if code != 0:
+            raise RuntimeError('mw %s failed with exit status %d' %
+                               (' '.join(args), code))
+        return elapsed, self.wiki.requests - requests
+
+    def checkout(self, name):
+        # a new, empty checkout that doesn't wait on any rate limits
+        path = os.path.join(self.root, name)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.mkdir(path)
+        self.mw(path, 'init', self.server.url)
+        filename = os.path.join(path, '.mw', 'config')
+        config = ConfigParser.RawConfigParser()
+        config.read(filename)
+        config.set('pull', 'rate', '0')
+        config.set('commit', 'edits_per_minute', '0')
+        with open(filename, 'wb') as fd:
+            config.write(fd)
+        return path
+
+    def measure(self, name, run, setup=None):
+        if self.options.only and name not in self.options.only:
+            return
+        runs = []
+        requests = 0
+        for i in xrange(self.options.repeat):
+            args = setup() if setup else ()
+            elapsed, requests = run(*args)
+            runs.append(elapsed)
+        runs.sort()
+        self.results[name] = {
+                'median': runs[len(runs) // 2],
+                'min': runs[0],
+                'max': runs[-1],
+                'requests': requests,
+        }
+        print '%-16s %10.3f %10.3f %10d' % (name, runs[len(runs) // 2],
+                                            runs[0], requests)
+        sys.stdout.flush()
+
+    def edit_files(self, checkout, count):
+        # change a line in the middle of `count` random pages
+        for title in self.random.sample(self.titles, count):
+            filename = os.path.join(checkout, title.replace(u' ', u'_') +
+                                    u'.wiki').encode('utf-8')
+            with file(filename) as fd:
+                lines = fd.read().split('\n')
+            lines.insert(len(lines) // 2, 'edited at %f' % time.time())
+            with file(filename, 'w') as fd:
+                fd.write('\n'.join(lines))
+
+    def edit_wiki(self, count):
+        # someone else saves a new revision of `count` random pages
+        for title in self.random.sample(self.titles, count):
+            text = self.wiki.text(title, len(self.wiki.pages[title]
+                                             ['revisions']))
+            with self.wiki.lock:
+                self.wiki._add_revision(title, text, 'bench')
+
+    def pulled_checkout(self, name, titles):
+        path = self.checkout(name)
+        self.mw(path, 'pull', *titles)
+        return path
+
+    def run(self):
+        print '%d pages of %d characters, %d revisions each, %d ms latency' \
+                % (self.options.pages, self.options.page_size,
+                   self.options.depth, self.options.latency)
+        print '%-16s %10s %10s %10s' % ('benchmark', 'median', 'min',
+                                        'requests')
+        titles = [title.encode('utf-8') for title in self.titles]
+
+        empty = self.checkout('empty')
+        self.measure('startup', lambda: self.mw(empty, 'status'))
+        self.measure('pull',
+                     lambda path: self.mw(path, 'pull', *titles),
+                     lambda: (self.checkout('pull'),))
+        self.measure('pullcat',
+                     lambda path: self.mw(path, 'pullcat',
+                                          CATEGORY.encode('utf-8')),
+                     lambda: (self.checkout('pullcat'),))
+        self.measure('pullns',
+                     lambda path: self.mw(path, 'pull', '--namespace', '0'),
+                     lambda: (self.checkout('pullns'),))
+
+        self.measure('pull-history',
+                     lambda path: self.mw(path, 'pull', '--history', *titles),
+                     lambda: (self.pulled_checkout('history', titles),))
+
+        edits = min(self.options.edits, len(self.titles))
+        main = self.pulled_checkout('main', titles)
+        # the first bare pull remembers where recent changes are up to,
+        # the ones after it only look at what changed since
+        self.mw(main, 'pull')
+        if self.options.depth > 1:
+            self.mw(main, 'pull', '--history', *titles)
+        self.measure('pull-noop', lambda: self.mw(main, 'pull'))
+        self.measure('pull-changed', lambda: self.mw(main, 'pull'),
+                     lambda: self.edit_wiki(edits) or ())
+        self.measure('status', lambda: self.mw(main, 'status'))
+        self.measure('status-refresh',
+                     lambda: self.mw(main, 'status', '--refresh'))
+        self.edit_files(main, edits)
+        self.measure('status-dirty', lambda: self.mw(main, 'status'))
+        self.measure('diff', lambda: self.mw(main, 'diff'))
+        self.measure('commit',
+                     lambda: self.mw(main, 'commit', '-m', 'bench'),
+                     lambda: self.edit_files(main, edits) or ())
+
+    def settings(self):
+        # what shapes the synthetic wiki and the runs; results are only
+        # comparable between runs with the same settings
+        return dict((key, getattr(self.options, key)) for key in
+                    ['pages', 'page_size', 'depth', 'unicode', 'latency',
+                     'edits', 'repeat', 'seed'])
+
+    def save(self, filename):
+        data = {
+                'options': self.settings(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'results': self.results,
+        }
+        with file(filename, 'w') as fd:
+            json.dump(data, fd, indent=1, sort_keys=True)
+            fd.write('\n')
+
+    def compare(self, filename):
+        """Print the change against a saved run; True if nothing regressed."""
+        with file(filename) as fd:
+            baseline = json.load(fd)
+        ours = self.settings()
+        for key, value in baseline.get('options', {}).items():
+            if key in ours and ours[key] != value:
+                print 'warning: baseline was run with %s = %s, not %s' % (
+                        key, value, ours[key])
+        print
+        print '%-16s %10s %10s %8s' % ('benchmark', 'baseline', 'now',
+                                       'change')
+        ok = True
+        for name in sorted(self.results):
+            if name not in baseline['results']:
+                continue
+            old = baseline['results'][name]['median']
+            new = self.results[name]['median']
+            change = (new - old) / old if old else 0.0
+            flag = ''
+            if change > self.options.threshold and new - old > NOISE:
+                flag = '  REGRESSION'
+                ok = False
+            print '%-16s %10.3f %10.3f %+7.1f%%%s' % (name, old, new,
+                                                       change * 100, flag)
+        return ok
+
+
+def main():
+    options = parse_args()
+    suite = Suite(options)
+    try:
+        suite.run()
+    finally:
+        suite.close()
+    if options.out:
+        suite.save(options.out)
+    if options.baseline and not suite.compare(options.baseline):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
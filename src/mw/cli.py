@@ -17,6 +17,8 @@
 ###
 
 import mw.clicommands
+import mw.metadir
+import mw.metrics
 import os
 import sys
 
@@ -27,15 +29,15 @@ class CLI(object):
         self.me = os.path.basename(sys.argv[0])
         self.commands = {}
         self.shortcuts = {}
+        # only the command that actually runs gets created, in main()
         for name in mw.clicommands.__dict__:
             if name == 'CommandBase':
                 continue
             clazz = mw.clicommands.__dict__[name]
             if isinstance(clazz, type) and \
                issubclass(clazz, mw.clicommands.CommandBase):
-                cmd = clazz()
-                self.commands[cmd.name] = cmd
-                self.shortcuts[cmd.name] = cmd.shortcuts
+                self.commands[clazz.name] = clazz
+                self.shortcuts[clazz.name] = clazz.shortcuts
         self.all_commands = {}
         self.all_commands.update(self.commands)
         for command in self.shortcuts:
@@ -43,7 +45,8 @@ class CLI(object):
                 self.all_commands[shortcut] = self.commands[command]
 
     def usage(self):
-        print 'usage: %s [subcommand]' % self.me
+        print 'usage: %s [--profile] [--metrics-out FILE] [--cprofile FILE] ' \
+              '[subcommand]' % self.me
         print
         commands = self.commands.keys()
         commands.sort()
@@ -57,7 +60,33 @@ class CLI(object):
         print
         sys.exit(1)
 
+    def _global_options(self):
+        # options for mw itself go before the subcommand
+        self.profile = False
+        self.metrics_out = None
+        self.cprofile_out = None
+        while len(sys.argv) > 1 and sys.argv[1][:2] == '--' and \
+              sys.argv[1] != '--help':
+            name, equals, value = sys.argv.pop(1).partition('=')
+            if name in ['--metrics-out', '--cprofile'] and not equals:
+                if len(sys.argv) < 2:
+                    print '%s: %s needs a file name' % (self.me, name)
+                    sys.exit(1)
+                value = sys.argv.pop(1)
+            if name == '--profile':
+                self.profile = True
+            elif name == '--metrics-out':
+                self.metrics_out = value
+            elif name == '--cprofile':
+                self.cprofile_out = value
+            else:
+                print '%s: invalid option: %s' % (self.me, name)
+                self.usage()
+        if self.profile or self.metrics_out:
+            mw.metrics.enable()
+
     def main(self):
+        self._global_options()
         # determine what the subcommand is
         if len(sys.argv) > 1:
             if sys.argv[1] in self.all_commands:
@@ -70,4 +99,16 @@ class CLI(object):
         if len(sys.argv) == 1:
             self.usage()
         # woo let's go
-        self.all_commands[the_command].main()
+        command = self.all_commands[the_command](mw.metadir.Metadir())
+        try:
+            if self.cprofile_out is not None:
+                import cProfile
+                cProfile.runctx('command.main()', globals(),
+                                {'command': command}, self.cprofile_out)
+            else:
+                command.main()
+        finally:
+            if self.profile:
+                mw.metrics.report()
+            if self.metrics_out is not None:
+                mw.metrics.write_json(self.metrics_out)
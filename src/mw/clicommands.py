@@ -17,41 +17,54 @@
 ###
 
 import codecs
-import cookielib
-import getpass
 import hashlib
+import itertools
+import mw.media
 import mw.metadir
+import mw.metrics
 from optparse import OptionParser, OptionGroup
 import os
-import simplemediawiki
-import subprocess
 import sys
 import time
 
+# the most titles pullcat --depth remembers to drop repeats with
+SEEN_TITLES = 100000
+
 
 class CommandBase(object):
+    # subclasses describe themselves here, so mw.cli can list commands
+    # without creating them
+    name = None
+    description = None
+    usage = None
+    shortcuts = []
 
-    def __init__(self, name, description, usage=None):
+    def __init__(self, metadir=None):
         self.me = os.path.basename(sys.argv[0])
-        self.description = description
-        if usage is None:
-            usage = '%prog ' + name
+        if self.usage is None:
+            usage = '%prog ' + self.name
         else:
-            usage = '%%prog %s %s' % (name, usage)
-        self.parser = OptionParser(usage=usage, description=description)
-        self.name = name
-        self.metadir = mw.metadir.Metadir()
-        self.shortcuts = []
+            usage = '%%prog %s %s' % (self.name, self.usage)
+        self.parser = OptionParser(usage=usage, description=self.description)
+        if metadir is None:
+            metadir = mw.metadir.Metadir()
+        self.metadir = metadir
+        self.options = None
+        self.session = None
 
     def main(self):
         (self.options, self.args) = self.parser.parse_args()
         self.args = self.args[1:]  # don't need the first thing
-        self._do_command()
+        # every command is timed as a whole here, phases inside it add
+        # their own timers
+        with mw.metrics.timer('command.' + self.name):
+            self._do_command()
 
     def _do_command(self):
         pass
 
     def _login(self):
+        import getpass
         user = raw_input('Username: ')
         passwd = getpass.getpass()
         result = self.api.call({'action': 'login',
@@ -81,18 +94,94 @@ class CommandBase(object):
 
     def _api_setup(self):
         if not self.api_setup: # do not call _api_setup twice
-            cookie_filename = os.path.join(self.metadir.location, 'cookies')
             self.api_url = self.metadir.config.get('remote', 'api_url')
-            self.api = simplemediawiki.MediaWiki(self.api_url,
-                                             cookie_file=cookie_filename)
+            self.api = self._new_api()
             self.api_setup = True
 
+    def _continue(self, data, response, module):
+        # the request for the next page of results, or None when done;
+        # newer wikis answer with 'continue', older ones 'query-continue'
+        if 'continue' in response:
+            data = dict(data)
+            data.update(response['continue'])
+            return data
+        if module in response.get('query-continue', {}):
+            data = dict(data)
+            data.update(response['query-continue'][module])
+            return data
+        return None
 
-class InitCommand(CommandBase):
+    def _session_start(self, names):
+        # remember the arguments and the options in `names`, so --resume
+        # can run the command again if it is interrupted
+        self.session = {
+                'command': self.name,
+                'args': list(self.args),
+                'options': dict([(name, getattr(self.options, name))
+                                 for name in names]),
+        }
+        self.metadir.session_set(self.session)
+
+    def _session_resume(self):
+        self.session = self.metadir.session_get()
+        if self.session is None or self.session['command'] != self.name:
+            print '%s: no interrupted %s to resume' % (self.me, self.name)
+            sys.exit(1)
+        self.args = [arg.encode('utf-8') for arg in self.session['args']]
+        for name, value in self.session['options'].items():
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            setattr(self.options, name, value)
+        return self.session
+
+    def _session_end(self):
+        # only a run that started or resumed the session may end it
+        if self.session is not None:
+            self.metadir.session_set(None)
+            self.session = None
+
+    def _new_api(self):
+        # every command and worker thread in the process shares one
+        # transport, and with it the connection pool and cookies
+        import mw.transport
+        cookie_filename = os.path.join(self.metadir.location, 'cookies')
+        return mw.transport.get(self.api_url, cookie_filename)
+
+    def _fetcher(self, api_factory=None):
+        import mw.fetcher
+        config = self.metadir.config_get
+        jobs = int(config('pull', 'jobs', 4))
+        if getattr(self.options, 'jobs', None):
+            jobs = self.options.jobs
+        maxlag = config('remote', 'maxlag', None)
+        if maxlag is not None:
+            maxlag = int(maxlag)
+        return mw.fetcher.BatchFetcher(api_factory or self._new_api, jobs=jobs,
+                rate=float(config('pull', 'rate', 0)),
+                burst=int(config('pull', 'burst', jobs)),
+                maxlag=maxlag)
 
-    def __init__(self):
-        usage = 'API_URL'
-        CommandBase.__init__(self, 'init', 'start a mw repo', usage)
+    def _batch_size(self):
+        # how many titles the wiki lets us ask about in one query
+        if not hasattr(self, 'batch_size'):
+            data = {
+                    'action': 'query',
+                    'meta': 'userinfo',
+                    'uiprop': 'rights',
+            }
+            rights = self.api.call(data)['query']['userinfo'].get('rights',
+                                                                   [])
+            if 'apihighlimits' in rights:
+                self.batch_size = 500
+            else:
+                self.batch_size = 50
+        return self.batch_size
+
+
+class InitCommand(CommandBase):
+    name = 'init'
+    description = 'start a mw repo'
+    usage = 'API_URL'
 
     def _do_command(self):
         if len(self.args) < 1:
@@ -103,9 +192,8 @@ class InitCommand(CommandBase):
 
 
 class LoginCommand(CommandBase):
-
-    def __init__(self):
-        CommandBase.__init__(self, 'login', 'authenticate with wiki')
+    name = 'login'
+    description = 'authenticate with wiki'
 
     def _do_command(self):
         self._die_if_no_init()
@@ -114,9 +202,8 @@ class LoginCommand(CommandBase):
 
 
 class LogoutCommand(CommandBase):
-
-    def __init__(self):
-        CommandBase.__init__(self, 'logout', 'forget authentication')
+    name = 'logout'
+    description = 'forget authentication'
 
     def _do_command(self):
         self._die_if_no_init()
@@ -126,68 +213,181 @@ class LogoutCommand(CommandBase):
             pass
 
 
-class PullCategoryMembersCommand(CommandBase):
-
-    def __init__(self):
-        usage = '[options] PAGENAME ...'
-        CommandBase.__init__(self, 'pull_commandat', 'add remote pages to repo '
-                             'belonging to the given category', usage)
-        self.query_continue = ''
+class MigrateCacheCommand(CommandBase):
+    name = 'migrate-cache'
+    description = 'move the page cache into a single database'
 
     def _do_command(self):
         self._die_if_no_init()
-        self._api_setup()
-        pages = []
-        pages += self.args
-        for these_pages in [pages[i:i + 25] for i in range(0, len(pages), 25)]:
-            data = {
-                'action': 'query',
-                'gcmtitle': '|'.join(these_pages),
-                'generator': 'categorymembers',
-                'gcmlimit': 500
-            }
-        if self.query_continue != '':
-           data['gcmcontinue'] = self.query_continue
-
-        api_call = self.api.call(data)
-        if 'query-continue' in api_call:
-            self.query_continue = api_call['query-continue']['categorymembers']['gcmcontinue']
+        if self.metadir.migrate_cache():
+            print 'cache migrated to .mw/cache/store.db'
         else:
-            self.query_continue = ''
-        if api_call != [] :
- 
-            response = api_call['query']['pages']
-            pull_command = PullCommand()
-            pull_command.args = []
+            print 'cache is already stored in .mw/cache/store.db'
 
-            for pageid in response.keys():
-                 pagename = response[pageid]['title']
-                 pull_command.args += [pagename.encode('utf-8')]
 
-            pull_command._do_command()
+class DaemonCommand(CommandBase):
+    name = 'daemon'
+    description = 'watch the working directory to make status, diff ' \
+                  'and commit faster'
+    usage = '[options]'
 
-            if self.query_continue != '':
-                 print 'query continue detected - continuing the query'
-                 self._do_command()
+    def __init__(self, metadir=None):
+        CommandBase.__init__(self, metadir)
+        self.parser.add_option('-d', '--detach', dest='detach',
+                               action='store_true', default=False,
+                               help='run in the background')
+        self.parser.add_option('--stop', dest='stop', action='store_true',
+                               default=False,
+                               help='stop the daemon watching this repo')
 
+    def _do_command(self):
+        import mw.daemon
+        import signal
+        import socket
+        self._die_if_no_init()
+        if not self.metadir.use_sqlite:
+            print '%s: the daemon needs the page cache in store.db, ' \
+                  'run mw migrate-cache first' % self.me
+            sys.exit(1)
+        running = mw.daemon.request(self.metadir, {'command': 'status',
+                                                   'clean': False})
+        if self.options.stop:
+            if running is None:
+                print '%s: no daemon is running' % self.me
+                sys.exit(1)
+            mw.daemon.request(self.metadir, {'command': 'stop'})
+            return
+        if running is not None:
+            print '%s: a daemon is already running' % self.me
+            sys.exit(1)
+        try:
+            daemon = mw.daemon.Daemon(self.metadir)
+        except OSError, e:
+            print '%s: cannot watch files: %s' % (self.me, e.strerror)
+            sys.exit(1)
+        path = os.path.join(self.metadir.location, mw.daemon.SOCKET)
+        if os.path.exists(path):
+            os.remove(path)  # left by one that was killed
+        if self.options.detach:
+            ready, tell_ready = os.pipe()
+            if os.fork() > 0:
+                # wait for the first scan, so the next command benefits
+                os.close(tell_ready)
+                if os.read(ready, 1) != 'y':
+                    print '%s: the daemon failed to start' % self.me
+                    sys.exit(1)
+                return
+            os.close(ready)
+            os.setsid()
+            if os.fork() > 0:
+                os._exit(0)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in [0, 1, 2]:
+                os.dup2(devnull, fd)
+        # the status keys are relative to the root, and so is the socket
+        os.chdir(self.metadir.root)
+        daemon.scan()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(os.path.join('.mw', mw.daemon.SOCKET))
+        listener.listen(16)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if self.options.detach:
+            os.write(tell_ready, 'y')
+            os.close(tell_ready)
+        else:
+            print 'watching %s (%d files), ^C to stop' % (
+                    self.metadir.root, len(daemon.status))
+        try:
+            daemon.serve(listener)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+            listener.close()
 
 
 class PullCommand(CommandBase):
-    
-    def __init__(self):
-        usage = '[options] PAGENAME ...'
-        CommandBase.__init__(self, 'pull', 'add remote pages to repo', usage)
+    name = 'pull'
+    description = 'add remote pages to repo'
+    usage = '[options] PAGENAME ...'
+
+    def __init__(self, metadir=None):
+        CommandBase.__init__(self, metadir)
+        self.parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                               help='number of requests to keep in flight '
+                               '(default: pull.jobs from .mw/config)')
+        self.parser.add_option('-n', '--dry-run', dest='dry_run',
+                               action='store_true', default=False,
+                               help='only show which pages would be pulled')
+        self.parser.add_option('--history', dest='history',
+                               action='store_true', default=False,
+                               help='also keep every older revision of the '
+                               'pages in .mw/cache')
+        self.parser.add_option('--since', dest='since', metavar='TIMESTAMP',
+                               help='with --history, start from revisions '
+                               'made at TIMESTAMP (e.g. 2011-01-01T00:00:00Z)')
+        self.parser.add_option('--resume', dest='resume',
+                               action='store_true', default=False,
+                               help='carry on with an interrupted pull; '
+                               'pages it got are not downloaded again')
+        self.parser.add_option('--namespace', dest='namespace', type='int',
+                               metavar='N',
+                               help='pull every page in namespace N '
+                               '(e.g. 10 for templates)')
+        self.parser.add_option('--prefix', dest='prefix', metavar='PREFIX',
+                               help='with --namespace, only the pages whose '
+                               'title (without the namespace) starts with '
+                               'PREFIX')
+        self.parser.add_option('--no-media', dest='media',
+                               action='store_false', default=True,
+                               help="don't download the files behind File: "
+                               'pages')
+        # defaults, for when another command runs a pull
+        (self.options, self.args) = self.parser.parse_args([])
 
     def _do_command(self):
         self._die_if_no_init()
+        if self.options.resume:
+            self._session_resume()
+        elif self.options.namespace is not None and self.args:
+            self.parser.error('--namespace takes no page names')
+        elif not self.options.dry_run:
+            self._session_start(['history', 'since', 'jobs', 'namespace',
+                                 'prefix'])
+        if self.options.prefix is not None and self.options.namespace is None:
+            self.options.namespace = 0
+        if self.options.history and not self.metadir.use_sqlite:
+            print '%s: pull --history needs the page cache in store.db, ' \
+                  'run mw migrate-cache first' % self.me
+            sys.exit(1)
+        self.sparse = self.metadir.use_sqlite and \
+                self.metadir.sparse_get() is not None
         self._api_setup()
+        self.status = {}
+        self.skipped = []
+        self.media = []
+        if self.options.namespace is not None:
+            self._pull_namespace(self.options.namespace, self.options.prefix)
+            if self.options.dry_run:
+                return  # nothing is written on a dry run
+            self.metadir.index_save()
+            self._session_end()
+            return
         pages = []
         pages += self.args
 
         # Pull should work with pagename, filename, or working directory
         converted_pages = []
-        if pages == []:
-            pages = self.metadir.working_dir_status().keys()
+        mark = None
+        if pages == [] and self.sparse:
+            # every page in the cache, whether it is written out or not
+            pages, mark = self._changed_pages(
+                    [mw.metadir.pagename_to_filename(title) + u'.wiki'
+                     for title in self.metadir.page_titles()])
+        elif pages == []:
+            pages, mark = self._changed_pages(
+                    [filename for filename in self.metadir.working_dir_status()
+                     if filename[-5:] == '.wiki'])
         for pagename in pages:
             if '.wiki' in pagename:
                 converted_pages.append(
@@ -196,138 +396,1140 @@ class PullCommand(CommandBase):
                 converted_pages.append(pagename)
         pages = converted_pages
 
-        # process the files in groups of 25 to be kind to service
-        for these_pages in [pages[i:i + 25] for i in 
-                range(0, len(pages), 25)]: 
-            data = {
-                    'action': 'query',
-                    'titles': '|'.join(these_pages),
-                    'prop': 'info|revisions',
-                    'rvprop': 'ids|flags|timestamp|user|comment|content',
-            }
-            response = self.api.call(data)['query']['pages']
-            # for every pageid, returns dict.keys() = {'lastrevid', 'pageid', 'title', 'counter', 'length', 'touched': u'2011-02-02T19:32:04Z', 'ns', 'revisions' {...}}
-            for pageid in response.keys():
-                pagename = response[pageid]['title']
-                
-                if 'revisions' not in response[pageid]:
-                    print 'skipping:       "%s" -- cannot find page, perhaps deleted' % (pagename)
+        self._pull_titles(pages)
+        if self.options.dry_run:
+            return  # nothing is written, the mark stays where it was
+        if self.options.history:
+            self._pull_history(pages)
+        self._pull_media(self.media)
+        self.metadir.index_save()
+        if mark is not None:
+            # pages we couldn't update get another look next time
+            mark['pending'] = self.skipped
+            self.metadir.rcmark_set(mark)
+        self._session_end()
+
+    def _changed_pages(self, filenames):
+        # work out which tracked pages changed on the wiki since the last
+        # pull of the whole working directory, returning those and the
+        # mark to save once they are pulled
+        head = self._rc_head()
+        mark = self.metadir.rcmark_get()
+        if mark is None or head is None or not self._rc_covers(mark):
+            return filenames, head
+        tracked = set()
+        for filename in filenames:
+            if isinstance(filename, str):
+                filename = filename.decode('utf-8')
+            tracked.add(mw.metadir.filename_to_pagename(filename[:-5]))
+        pages = []
+        for title in mark.get('pending', []):
+            if title in tracked:
+                pages.append(title)
+        wanted = set(pages)
+        data = {
+                'action': 'query',
+                'list': 'recentchanges',
+                'rcdir': 'newer',
+                'rcstart': mark['timestamp'],
+                'rcprop': 'title|ids|timestamp|loginfo',
+                'rctype': 'edit|new|log',
+                'rclimit': 'max',
+        }
+        while data is not None:
+            response = self.api.call(data)
+            for change in response['query']['recentchanges']:
+                if change['rcid'] <= mark['rcid']:
                     continue
-                
-                # ['revisions'][0] is the latest revid
-                if 'comment' in response[pageid]['revisions'][0]:
-                    last_wiki_rev_comment = response[pageid]['revisions'][0]['comment']
-                else:
-                    last_wiki_rev_comment = ''
-                last_wiki_rev_user = response[pageid]['revisions'][0]['user']
-                
-                # check if working file is modified or if wiki page doesn't exists
-                status = self.metadir.working_dir_status()
+                head = {'timestamp': change['timestamp'],
+                        'rcid': change['rcid']}
+                title = change['title']
+                if title not in tracked:
+                    continue
+                if change['type'] == 'log' and \
+                   change.get('logtype') == 'delete' and \
+                   change.get('logaction') == 'delete':
+                    print 'deleted:        "%s" -- deleted on the wiki, ' \
+                          'local file kept' % title
+                    wanted.discard(title)
+                    continue
+                if change['type'] == 'log' and change.get('logtype') == 'move':
+                    # older wikis put the target in 'move', newer ones
+                    # in 'logparams'
+                    if 'move' in change:
+                        target = change['move']['new_title']
+                    else:
+                        target = change['logparams']['target_title']
+                    print 'moved:          "%s" -> "%s"' % (title, target)
+                    tracked.add(target)
+                    if target not in wanted:
+                        pages.append(target)
+                        wanted.add(target)
+                if title not in wanted:
+                    pages.append(title)
+                    wanted.add(title)
+            data = self._continue(data, response, 'recentchanges')
+        changed = []
+        for title in pages:
+            if title in wanted:
+                changed.append(title)
+                wanted.discard(title)
+        return changed, head
+
+    def _rc_head(self):
+        # the newest entry in recent changes, or None on a brand new wiki
+        data = {
+                'action': 'query',
+                'list': 'recentchanges',
+                'rcprop': 'ids|timestamp',
+                'rclimit': 1,
+        }
+        changes = self.api.call(data)['query']['recentchanges']
+        if changes == []:
+            return None
+        return {'timestamp': changes[0]['timestamp'],
+                'rcid': changes[0]['rcid']}
+
+    def _rc_covers(self, mark):
+        # recent changes are purged after a while ($wgRCMaxAge), if the
+        # oldest one left is newer than our mark we may have missed some
+        data = {
+                'action': 'query',
+                'list': 'recentchanges',
+                'rcdir': 'newer',
+                'rcprop': 'ids|timestamp',
+                'rclimit': 1,
+        }
+        changes = self.api.call(data)['query']['recentchanges']
+        return changes != [] and changes[0]['timestamp'] <= mark['timestamp']
+
+    def _pull_titles(self, pages):
+        # ask for the latest revision ids first (cheap), then download
+        # content only for the pages whose revision we don't have
+        batch = self._batch_size()
+        self.summary = {'info': 0, 'content': 0, 'pulled': 0, 'unchanged': 0,
+                        'bytes': 0, 'saved': 0}
+        requests = ({
+                'action': 'query',
+                'titles': '|'.join(these_pages),
+                'prop': 'info',
+        } for these_pages in _chunks(pages, batch))
+        stale = self._stale_revisions(requests)
+        if self.options.dry_run:
+            for pagename, length, lastrevid in stale:
+                print 'would pull:     "%s" (%d bytes)' % (pagename, length)
+            self._print_summary()
+            return
+        requests = ({
+                'action': 'query',
+                'revids': '|'.join([str(revid) for revid in these_revids]),
+                'prop': 'info|revisions',
+                'rvprop': 'ids|flags|timestamp|user|comment|content',
+        } for these_revids in _chunks(self._revids(stale), batch))
+        for data, response in self._fetcher().run(requests):
+            self.summary['content'] += 1
+            with mw.metrics.timer('pull.write'):
+                self._pull_response(response['query']['pages'])
+            self.metadir.cache_commit()
+        self._print_summary()
+
+    def _pull_namespace(self, namespace, prefix):
+        # the wiki lists the pages and sends their latest revisions in the
+        # same request, a batch at a time; each batch is written before
+        # the next is asked for, and the place in the list is kept in the
+        # session so --resume carries on from there
+        data = {
+                'action': 'query',
+                'generator': 'allpages',
+                'gapnamespace': namespace,
+                'gaplimit': self._batch_size(),
+                'prop': 'info|revisions',
+                'rvprop': 'ids|flags|timestamp|user|comment|content',
+        }
+        if self.options.dry_run:
+            data['prop'] = 'info'
+            del data['rvprop']
+        if prefix is not None:
+            data['gapprefix'] = prefix
+        if self.options.resume and 'next' in self.session:
+            data = self.session['next']
+        fetcher = self._fetcher()
+        requests = pulled = unchanged = 0
+        while data is not None:
+            response = fetcher.call(self.api, data)
+            requests += 1
+            if 'error' in response:
+                print 'error:          namespace %d -- %s' % (
+                        namespace, response['error'].get('info'))
+                break
+            pages = response.get('query', {}).get('pages', {})
+            # the batch is written before the next one comes, so its
+            # snapshot replaces the last
+            self.status = self._status_snapshot(
+                    [page['title'] for page in pages.itervalues()])
+            stale = {}
+            for pageid, page in pages.iteritems():
+                if not self.options.dry_run and 'revisions' not in page:
+                    continue  # too much text for one answer, comes next
+                if self._up_to_date(page['title'], pageid, page['lastrevid'],
+                                    page['ns']):
+                    unchanged += 1
+                    continue
+                stale[pageid] = page
+            if self.options.dry_run:
+                for page in sorted(stale.itervalues(),
+                                   key=lambda page: page['title']):
+                    print 'would pull:     "%s" (%d bytes)' % (
+                            page['title'], page.get('length', 0))
+            else:
+                skipped = len(self.skipped)
+                with mw.metrics.timer('pull.write'):
+                    self._pull_response(stale)
+                self.metadir.cache_commit()
+                pulled -= len(self.skipped) - skipped
+                self._pull_media([page['title'] for page in pages.itervalues()
+                                  if page['ns'] == mw.media.NAMESPACE])
+            pulled += len(stale)
+            data = self._continue(data, response, 'allpages')
+            if not self.options.dry_run:
+                self.session['next'] = data
+                self.metadir.session_set(self.session)
+        if self.options.dry_run:
+            verb = 'would pull'
+        else:
+            verb = 'pulled'
+        print '%s %d pages in namespace %d, %d unchanged; %d requests' % (
+                verb, pulled, namespace, unchanged, requests)
+
+    def _pull_history(self, pages):
+        # one page at a time, since each request continues the one before;
+        # every batch is stored and checkpointed as soon as it arrives so
+        # an interrupted pull picks up where it stopped
+        fetcher = self._fetcher()
+        for pagename in pages:
+            pageid = self.metadir.get_pageid_from_pagename(pagename)
+            if pageid is None:
+                continue  # doesn't exist, already reported
+            data, lastrevid = self.metadir.history_get(pageid)
+            if data is None:
+                data = {
+                        'action': 'query',
+                        'titles': pagename,
+                        'prop': 'revisions',
+                        'rvprop': 'ids|flags|timestamp|user|comment|content',
+                        'rvlimit': 'max',
+                        'rvdir': 'newer',
+                }
+                if lastrevid is not None:
+                    # got all of it before, only look for newer revisions
+                    data['rvstartid'] = lastrevid
+                elif self.options.since:
+                    data['rvstart'] = self.options.since
+            count = 0
+            while data is not None:
+                response = fetcher.call(self.api, data)
+                if 'error' in response:
+                    print 'error:          "%s" -- %s' % (
+                            pagename, response['error'].get('info'))
+                    break
+                for page in response['query']['pages'].itervalues():
+                    for rv in page.get('revisions', []):
+                        lastrevid = max(lastrevid, rv['revid'])
+                        if '*' not in rv or self.metadir.pages_get_rv_sha1(
+                                pageid, rv['revid']) is not None:
+                            continue  # hidden, or already cached
+                        self.metadir.pages_add_rv(pageid['id'], rv)
+                        count += 1
+                data = self._continue(data, response, 'revisions')
+                self.metadir.history_set(pageid, data, lastrevid)
+                self.metadir.cache_commit()
+            print 'history:        "%s" -- %d revisions added' % (pagename,
+                                                                  count)
+
+    def _stale_revisions(self, requests):
+        for data, response in self._fetcher().run(requests):
+            self.summary['info'] += 1
+            self.status.update(self._status_snapshot(
+                    [page['title'] for page in
+                     response['query']['pages'].itervalues()]))
+            for page in response['query']['pages'].itervalues():
+                pagename = page['title']
+                if 'missing' in page or 'invalid' in page:
+                    print 'error:          "%s": -- page does not exist, ' \
+                          'file not created' % pagename
+                    continue
+                if page['ns'] == mw.media.NAMESPACE:
+                    self.media.append(pagename)
                 filename = mw.metadir.pagename_to_filename(pagename)
-                full_filename = os.path.join(self.metadir.root, filename + '.wiki')
-                if filename + '.wiki' in status and \
-                    status[filename + '.wiki' ] in ['M']:
-                    print 'skipping:       "%s" -- uncommitted modifications ' % (pagename)
+                status = self._file_status(filename + '.wiki')
+                if status in ['M']:
+                    print 'skipping:       "%s" -- uncommitted ' \
+                          'modifications ' % (pagename)
+                    self.skipped.append(pagename)
                     continue
-                if 'missing' in response[pageid].keys():
-                    print 'error:          "%s": -- page does not exist, file not created' % \
-                            (self.me, pagename)
+                if self._up_to_date(pagename, page['pageid'],
+                                    page['lastrevid'], page['ns']):
+                    self.summary['unchanged'] += 1
+                    self.summary['saved'] += page.get('length', 0)
                     continue
+                if not self.options.dry_run:
+                    # kept until the content comes and the file is written
+                    self.status[filename + '.wiki'] = status
+                self.summary['pulled'] += 1
+                self.summary['bytes'] += page.get('length', 0)
+                yield pagename, page.get('length', 0), page['lastrevid']
 
-                wiki_revids = sorted([x['revid'] for x in response[pageid]['revisions']])
-                last_wiki_revid = wiki_revids[-1]
-                working_revids = sorted(self.metadir.pages_get_rv_list({'id' : pageid}))
-                last_working_revid = working_revids[-1]
-                if ( os.path.exists(full_filename) and 
-                        last_wiki_revid == last_working_revid):
-                    #print 'wiki unchanged: "%s"' % (pagename)
-                    pass
+    def _pull_media(self, titles):
+        # the files behind File: pages: imageinfo for a batch of titles at
+        # a time, then the downloads that are needed, a few at once, each
+        # streamed to .mw/tmp/ and checked against the wiki's SHA-1
+        if not titles or not self.options.media or self.options.dry_run:
+            return
+        requests = ({
+                'action': 'query',
+                'titles': '|'.join(these_titles),
+                'prop': 'imageinfo',
+                'iiprop': 'url|sha1|size|timestamp',
+        } for these_titles in _chunks(titles, self._batch_size()))
+        fetcher = self._fetcher(lambda: mw.media.Downloader(self._new_api()))
+        done = []
+        for data, response in fetcher.run(self._media_downloads(requests)):
+            filename = data['filename']
+            if 'error' in response or response['sha1'] != data['sha1']:
+                if 'error' in response:
+                    error = response['error'].get('info')
                 else:
-                    print 'pulling:        "%s" : "%s" by "%s"' % (
-                        pagename, last_wiki_rev_comment, last_wiki_rev_user)
-                    self.metadir.pagedict_add(pagename, pageid, last_wiki_revid)
-                    self.metadir.pages_add_rv(int(pageid),
-                                              response[pageid]['revisions'][0])
-                    with file(full_filename, 'w') as fd:
-                        data = response[pageid]['revisions'][0]['*']
-                        data = data.encode('utf-8')
-                        fd.write(data)
-                        
+                    error = 'the download is damaged'
+                print 'error:          "%s" -- %s' % (filename, error)
+                os.remove(data['path'])
+                continue
+            print 'downloaded:     "%s" (%d bytes)' % (filename,
+                                                      response['size'])
+            self.metadir.stage_file(filename, data['path'])
+            done.append(data)
+            if len(done) == self._batch_size():
+                self._media_recorded(done)
+                done = []
+        self._media_recorded(done)
+
+    def _media_downloads(self, requests):
+        for data, response in self._fetcher().run(requests):
+            for page in response['query'].get('pages', {}).itervalues():
+                if not page.get('imageinfo'):
+                    continue  # a description page with no file
+                if not self.metadir.sparse_wanted(page['title'],
+                                                  mw.media.NAMESPACE):
+                    continue  # its page isn't written out either
+                info = page['imageinfo'][0]
+                filename = mw.metadir.pagename_to_filename(
+                        page['title']).encode('utf-8')
+                known = self.metadir.media_get(filename)
+                local = self.metadir.media_sha1(filename)
+                if local == info['sha1']:
+                    if known is None or known['sha1'] != local:
+                        self.metadir.media_set(filename, local,
+                                               info['timestamp'])
+                    continue
+                if local is not None and \
+                   (known is None or known['sha1'] != local):
+                    print 'skipping:       "%s" -- uncommitted ' \
+                          'modifications' % filename
+                    continue
+                yield {
+                        'url': info['url'],
+                        'path': self.metadir.media_tmp(),
+                        'filename': filename,
+                        'sha1': info['sha1'],
+                        'timestamp': info['timestamp'],
+                }
+
+    def _media_recorded(self, done):
+        # once they are in place
+        self.metadir.cache_commit()
+        for data in done:
+            self.metadir.media_set(data['filename'], data['sha1'],
+                                   data['timestamp'])
+
+    def _up_to_date(self, pagename, pageid, lastrevid, ns):
+        # whether the cache has the wiki's latest revision, and the file
+        # is written out if it should be
+        if lastrevid != self.metadir.pages_get_rv_list({'id': pageid})[-1]:
+            return False
+        filename = mw.metadir.pagename_to_filename(pagename) + '.wiki'
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+        return os.path.exists(os.path.join(self.metadir.root, filename)) or \
+               not self.metadir.sparse_wanted(pagename, ns)
+
+    def _revids(self, stale):
+        for pagename, length, revid in stale:
+            yield revid
+
+    def _print_summary(self):
+        summary = self.summary
+        if summary['pulled'] + summary['unchanged'] == 0:
+            return
+        if self.options.dry_run:
+            verb = 'would pull'
+        else:
+            verb = 'pulled'
+        print '%s %d pages (%d bytes), %d unchanged; %d requests for ' \
+              'revision ids and %d for content, %d bytes not downloaded' % (
+              verb, summary['pulled'], summary['bytes'],
+              summary['unchanged'], summary['info'], summary['content'],
+              summary['saved'])
+
+    def _pull_response(self, response):
+        # for every pageid, returns dict.keys() = {'lastrevid', 'pageid', 'title', 'counter', 'length', 'touched': u'2011-02-02T19:32:04Z', 'ns', 'revisions' {...}}
+        for pageid in response.keys():
+            pagename = response[pageid]['title']
+            
+            if 'revisions' not in response[pageid]:
+                print 'skipping:       "%s" -- cannot find page, perhaps deleted' % (pagename)
+                continue
+            
+            # ['revisions'][0] is the latest revid
+            if 'comment' in response[pageid]['revisions'][0]:
+                last_wiki_rev_comment = response[pageid]['revisions'][0]['comment']
+            else:
+                last_wiki_rev_comment = ''
+            last_wiki_rev_user = response[pageid]['revisions'][0]['user']
+            
+            # check if working file is modified or if wiki page doesn't exists
+            filename = mw.metadir.pagename_to_filename(pagename)
+            if self._file_status(filename + '.wiki') in ['M']:
+                print 'skipping:       "%s" -- uncommitted modifications ' % (pagename)
+                self.skipped.append(pagename)
+                continue
+            if 'missing' in response[pageid].keys():
+                print 'error:          "%s": -- page does not exist, file not created' % \
+                        (pagename)
+                continue
+
+            wiki_revids = sorted([x['revid'] for x in response[pageid]['revisions']])
+            last_wiki_revid = wiki_revids[-1]
+            if self._up_to_date(pagename, pageid, last_wiki_revid,
+                                response[pageid].get('ns')):
+                #print 'wiki unchanged: "%s"' % (pagename)
+                pass
+            else:
+                print 'pulling:        "%s" : "%s" by "%s"' % (
+                    pagename, last_wiki_rev_comment, last_wiki_rev_user)
+                self.metadir.pagedict_add(pagename, pageid, last_wiki_revid)
+                self.metadir.pages_add_rv(int(pageid),
+                                          response[pageid]['revisions'][0])
+                if not self.metadir.sparse_wanted(pagename,
+                                                  response[pageid].get('ns')):
+                    continue  # kept in the cache only
+                data = response[pageid]['revisions'][0]['*']
+                self.metadir.write_working_file(filename + '.wiki',
+                                                data.encode('utf-8'))
+
+    def _status_snapshot(self, pages):
+        # one scan per batch, limited to the files the batch can touch
+        check = []
+        for pagename in pages:
+            full = os.path.join(self.metadir.root,
+                    mw.metadir.pagename_to_filename(pagename) + '.wiki')
+            if os.path.exists(full):
+                check.append(full)
+        status = {}
+        if check:
+            for filename, code in \
+                    self.metadir.working_dir_status(files=check).items():
+                if isinstance(filename, str):
+                    filename = filename.decode('utf-8')
+                status[filename] = code
+        return status
+
+    def _file_status(self, filename):
+        # each file is looked at once, so its entry is dropped as it is
+        # read and self.status never holds more than a batch or two; the
+        # wiki may have normalized the title into a file we haven't seen
+        if filename in self.status:
+            return self.status.pop(filename)
+        full = os.path.join(self.metadir.root, filename)
+        if not os.path.exists(full):
+            return None
+        return self.metadir.working_dir_status(files=[full]).values()[0]
+
+
+class PullCategoryMembersCommand(PullCommand):
+    name = 'pullcat'
+    description = 'add remote pages to repo belonging to the given category'
+    usage = '[options] CATEGORY ...'
+
+    def __init__(self, metadir=None):
+        PullCommand.__init__(self, metadir)
+        self.parser.add_option('-d', '--depth', dest='depth', type='int',
+                               default=0,
+                               help='also pull subcategories this many '
+                               'levels down')
+        (self.options, self.args) = self.parser.parse_args([])
+
+    def _do_command(self):
+        self._die_if_no_init()
+        if self.options.resume:
+            self._session_resume()
+        elif len(self.args) < 1:
+            self.parser.error('must name at least one category')
+        elif not self.options.dry_run:
+            self._session_start(['depth', 'jobs'])
+        self._api_setup()
+        self.status = {}
+        self.skipped = []
+        self.media = []
+        self._pull_titles(self._category_members(self.args,
+                                                 self.options.depth))
+        if self.options.dry_run:
+            return
+        self._pull_media(self.media)
+        self.metadir.index_save()
+        self._session_end()
+
+    def _category_members(self, categories, depth):
+        # stream the titles in the categories (and their subcategories,
+        # down to depth) one page of results at a time
+        queue = []
+        for category in categories:
+            if isinstance(category, str):
+                category = category.decode('utf-8')
+            if not category.lower().startswith(u'category:'):
+                category = u'Category:' + category
+            queue.append((category, 0))
+        seen_categories = set()
+        seen_titles = set()
+        while queue:
+            category, level = queue.pop(0)
+            if category in seen_categories:
+                continue  # categories can contain each other
+            seen_categories.add(category)
+            data = {
+                    'action': 'query',
+                    'list': 'categorymembers',
+                    'cmtitle': category,
+                    'cmprop': 'title',
+                    'cmlimit': 'max',
+            }
+            while data is not None:
+                response = self.api.call(data)
+                for member in response['query']['categorymembers']:
+                    if member['ns'] == 14 and level < depth:
+                        queue.append((member['title'], level + 1))
+                    if depth > 0:
+                        # only subcategories can list a page twice; the
+                        # titles remembered are capped, and pages that
+                        # come up again after that are found up to date
+                        # by the revision check (or pulled again)
+                        if member['title'] in seen_titles:
+                            continue
+                        if len(seen_titles) >= SEEN_TITLES:
+                            seen_titles.clear()
+                        seen_titles.add(member['title'])
+                    yield member['title']
+                data = self._continue(data, response, 'categorymembers')
+
+
+class ImportDumpCommand(CommandBase):
+    name = 'import-dump'
+    description = 'add pages to repo from an XML dump of the wiki'
+    usage = '[options] FILE'
+
+    def __init__(self, metadir=None):
+        CommandBase.__init__(self, metadir)
+        self.parser.add_option('-t', '--title', dest='titles',
+                               action='append', metavar='TITLE',
+                               help='only import this page (may be given '
+                               'more than once)')
+        self.parser.add_option('--namespace', dest='namespaces', type='int',
+                               action='append', metavar='N',
+                               help='only import pages in namespace N (may '
+                               'be given more than once)')
+        self.parser.add_option('--latest-only', dest='latest_only',
+                               action='store_true', default=False,
+                               help='only keep the newest revision of each '
+                               'page')
+
+    def _do_command(self):
+        import mw.dump
+        self._die_if_no_init()
+        if len(self.args) != 1:
+            self.parser.error('must have the name of one dump file')
+        titles = None
+        if self.options.titles:
+            titles = set(title.decode('utf-8').replace('_', ' ')
+                         for title in self.options.titles)
+        namespaces = None
+        if self.options.namespaces:
+            namespaces = set(self.options.namespaces)
+        fresh = not [name for name in os.listdir(self.metadir.root)
+                     if name.endswith('.wiki')]
+        self.summary = {'pages': 0, 'revisions': 0}
+        self.skipped = []
+        newest = None
+        page = latest = have = None
+        fd = mw.dump.open_dump(self.args[0])
+        try:
+            for this_page, rv in mw.dump.read_dump(fd):
+                if titles is not None and this_page['title'] not in titles:
+                    continue
+                if namespaces is not None and \
+                   this_page['ns'] not in namespaces:
+                    continue
+                newest = max(newest, rv.get('timestamp'))
+                if this_page is not page:
+                    if page is not None:
+                        self._finish_page(page, latest, have)
+                    page = this_page
+                    latest = None
+                    have = self._start_page(page)
+                if have is None or '*' not in rv:
+                    continue  # locally modified, or text hidden
+                if latest is None or rv['revid'] > latest['revid']:
+                    latest = rv
+                if not self.options.latest_only and \
+                   self.metadir.pages_get_rv_sha1(
+                           {'id': page['pageid']}, rv['revid']) is None:
+                    self.metadir.pages_add_rv(page['pageid'], rv)
+                    self.summary['revisions'] += 1
+            if page is not None:
+                self._finish_page(page, latest, have)
+        finally:
+            fd.close()
+        self.metadir.cache_commit()
+        self.metadir.index_save()
+        self._set_rcmark(newest, fresh)
+        print 'imported %d pages (%d revisions), skipped %d' % (
+                self.summary['pages'], self.summary['revisions'],
+                len(self.skipped))
+
+    def _start_page(self, page):
+        # the newest revision cached so far, or None if local changes
+        # mean the page has to be left alone
+        filename = mw.metadir.pagename_to_filename(page['title']) + '.wiki'
+        full = os.path.join(self.metadir.root, filename)
+        if os.path.exists(full) and \
+           self.metadir.working_dir_status(files=[full]).get(filename) == 'M':
+            print 'skipping:       "%s" -- uncommitted modifications' % (
+                    page['title'])
+            self.skipped.append(page['title'])
+            return None
+        return self.metadir.pages_get_rv_list({'id': page['pageid']})[-1] \
+                or 0
+
+    def _finish_page(self, page, latest, have):
+        if latest is None or latest['revid'] <= have:
+            return  # skipped, or we already have something newer
+        if self.options.latest_only:
+            self.metadir.pages_add_rv(page['pageid'], latest)
+            self.summary['revisions'] += 1
+        self.metadir.pagedict_add(page['title'], page['pageid'],
+                                  latest['revid'])
+        if self.metadir.sparse_wanted(page['title'], page['ns']):
+            filename = mw.metadir.pagename_to_filename(page['title']) + \
+                    '.wiki'
+            self.metadir.write_working_file(filename,
+                                            latest['*'].encode('utf-8'))
+        self.summary['pages'] += 1
+        if self.summary['pages'] % 1000 == 0:
+            self.metadir.cache_commit()
+
+    def _set_rcmark(self, newest, fresh):
+        # a later `mw pull` catches up from the newest revision in the
+        # dump; only safe when no page in the checkout could be older
+        # than that, i.e. there was nothing here or there already is a
+        # (later) mark
+        if newest is None:
+            return
+        mark = self.metadir.rcmark_get()
+        if mark is None and not fresh:
+            return
+        if mark is None or newest < mark['timestamp']:
+            mark = {'timestamp': newest, 'rcid': 0,
+                    'pending': mark and mark.get('pending', []) or []}
+        mark['pending'] = mark.get('pending', []) + self.skipped
+        self.metadir.rcmark_set(mark)
+
+
+class CheckoutCommand(CommandBase):
+    name = 'checkout'
+    description = 'write cached pages out to the working directory'
+    usage = '[options] TITLE ...'
+    shortcuts = ['co']
+
+    def __init__(self, metadir=None):
+        CommandBase.__init__(self, metadir)
+        self.parser.add_option('--sparse', dest='sparse',
+                               action='store_true', default=False,
+                               help='also write pages matching TITLE out on '
+                               'later pulls, and no others')
+        self.parser.add_option('-f', '--force', dest='force',
+                               action='store_true', default=False,
+                               help='overwrite files with uncommitted '
+                               'changes')
+
+    def _do_command(self):
+        import fnmatch
+        self._die_if_no_init()
+        if not self.metadir.use_sqlite:
+            print '%s: checkout needs the page cache in store.db, run ' \
+                  'mw migrate-cache first' % self.me
+            sys.exit(1)
+        if not self.args:
+            self.parser.error('must have at least one title or pattern')
+        patterns = []
+        for arg in self.args:
+            if arg.endswith('.wiki'):
+                arg = mw.metadir.filename_to_pagename(arg[:-5])
+            if isinstance(arg, str):
+                arg = arg.decode('utf-8')
+            patterns.append(arg)
+        if self.options.sparse:
+            self.metadir.sparse_add(patterns)
+        # ns:N lines can't be matched offline, the cache doesn't know
+        # namespaces; `pull --namespace N` writes those pages out
+        globs = dict((pattern, pattern.replace(u'_', u' '))
+                     for pattern in patterns if not pattern.startswith(u'ns:'))
+        titles = []
+        unmatched = set(globs)
+        for title in self.metadir.page_titles():
+            for pattern, glob in globs.iteritems():
+                if fnmatch.fnmatchcase(title, glob):
+                    titles.append(title)
+                    unmatched.discard(pattern)
+                    break
+        if self.options.sparse:
+            unmatched = []  # they're for later pulls
+        for pattern in sorted(unmatched):
+            print 'no match:       "%s" -- not in the cache, pull it ' \
+                  'first' % pattern
+        # one status check for all the files already there
+        files = {}
+        for title in titles:
+            filename = (mw.metadir.pagename_to_filename(title) +
+                        u'.wiki').encode('utf-8')
+            files[title] = filename
+        existing = [os.path.join(self.metadir.root, filename)
+                    for filename in files.itervalues()
+                    if os.path.exists(os.path.join(self.metadir.root,
+                                                   filename))]
+        status = {}
+        if existing:
+            status = self.metadir.working_dir_status(files=existing)
+        written = skipped = 0
+        for title in titles:
+            filename = files[title]
+            code = status.get(filename)
+            if code == 'C':
+                continue
+            if code == 'M' and not self.options.force:
+                print 'skipping:       "%s" -- uncommitted modifications' % (
+                        title)
+                skipped += 1
+                continue
+            page = self.metadir.get_pageid_from_pagename(title)
+            rv = self.metadir.pages_get_rv(page, page['currentrv'])
+            if not rv or 'content' not in rv:
+                continue
+            self.metadir.write_working_file(filename,
+                                            rv['content'].encode('utf-8'))
+            written += 1
+            if written % 500 == 0:
+                self.metadir.cache_commit()
+        self.metadir.cache_commit()
+        self.metadir.index_save()
+        print 'checked out %d pages, %d already there, skipped %d' % (
+                written, len(titles) - written - skipped, skipped)
+
+
+def _chunks(iterable, size):
+    # lists of `size` items at a time, without reading ahead any further
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 class StatusCommand(CommandBase):
+    name = 'status'
+    description = 'check repo status'
+    shortcuts = ['st']
 
-    def __init__(self):
-        CommandBase.__init__(self, 'status', 'check repo status')
-        self.shortcuts.append('st')
+    def __init__(self, metadir=None):
+        CommandBase.__init__(self, metadir)
         self.parser.add_option('-A', '--all', dest='show_all', action='store_true',
                                 default = False,
                                 help="show all files' status")
+        self.parser.add_option('--refresh', dest='refresh',
+                               action='store_true', default=False,
+                               help='rebuild the index from scratch')
+        self.parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                               help='read this many files at once when many '
+                               'have changed (default: number of CPUs)')
 
     def _do_command(self):
         self._die_if_no_init()
-        status = self.metadir.working_dir_status()
-        for filename in status:
-
-            if not self.options.show_all and status[filename] == 'C':
+        # printed as the scan goes, in filename order
+        for filename, code in self.metadir.iter_status(
+                refresh=self.options.refresh, clean=self.options.show_all,
+                jobs=self.options.jobs):
+            if not self.options.show_all and code == 'C':
                 continue
-            else:
-                print '%s %s' % (status[filename], filename)
+            print '%s %s' % (code, filename)
 
 
 class DiffCommand(CommandBase):
+    name = 'diff'
+    description = 'diff wiki to working directory'
+    usage = '[FILES]'
 
-    def __init__(self):
-        CommandBase.__init__(self, 'diff', 'diff wiki to working directory')
+    def __init__(self, metadir=None):
+        CommandBase.__init__(self, metadir)
+        self.parser.add_option('--stat', dest='mode', action='store_const',
+                               const='stat', default='unified',
+                               help='show lines added and removed per file')
+        self.parser.add_option('--name-only', dest='mode',
+                               action='store_const', const='names',
+                               help='only list the files that differ')
+        self.parser.add_option('-w', '--word-diff', dest='mode',
+                               action='store_const', const='word',
+                               help='show changes word by word')
+        self.parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                               help='diff this many files at once '
+                               '(default: number of CPUs)')
+        self.parser.add_option('-r', '--revision', dest='revision',
+                               metavar='OLD[:NEW]',
+                               help='compare cached revision OLD of one page '
+                               'to NEW, or to the working copy')
 
     def _do_command(self):
         self._die_if_no_init()
-        status = self.metadir.working_dir_status()
-        for filename in status:
-            if status[filename] == 'M':
-                print self.metadir.diff_rv_to_working(
-                        mw.metadir.filename_to_pagename(filename[:-5])),
+        if self.options.revision is not None:
+            self._diff_revisions()
+            return
+        status = self.metadir.working_dir_status(files=self.args,
+                                                 clean=False)
+        modified = sorted(filename for filename in status
+                          if status[filename] == 'M' and
+                          filename[-5:] == '.wiki')
+        if self.options.mode == 'names':
+            for filename in modified:
+                print filename
+            return
+        jobs = [(self.options.mode,) + self.metadir.diff_inputs(
+                    mw.metadir.filename_to_pagename(filename[:-5]))
+                for filename in modified]
+        if self.options.mode == 'stat':
+            self._print_stat(modified, self._render(jobs))
+            return
+        for diff in self._render(jobs):
+            sys.stdout.write(diff)
+
+    def _diff_revisions(self):
+        # works entirely from .mw/cache, no need to ask the wiki
+        if len(self.args) != 1:
+            self.parser.error('-r needs exactly one page or file')
+        try:
+            revids = [int(revid) for revid in
+                      self.options.revision.split(':', 1)]
+        except ValueError:
+            self.parser.error('-r takes revision ids, OLD or OLD:NEW')
+        pagename = self.args[0]
+        if pagename.endswith('.wiki'):
+            pagename = mw.metadir.filename_to_pagename(
+                    os.path.basename(pagename)[:-5])
+        try:
+            job = self.metadir.diff_inputs(pagename, *revids)
+        except ValueError, e:
+            print '%s: %s' % (self.me, e)
+            sys.exit(1)
+        if self.options.mode == 'names':
+            if job[1] != job[3]:
+                print self.args[0]
+            return
+        result = list(self._render([(self.options.mode,) + job]))
+        if self.options.mode == 'stat':
+            self._print_stat([self.args[0]], result)
+        else:
+            sys.stdout.write(result[0])
+
+    def _render(self, jobs):
+        # results come back in path order whether or not a pool is used
+        import mw.diff
+        processes = self.options.jobs
+        if len(jobs) > 1 and processes is None:
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+        if len(jobs) < 2 or processes < 2:
+            for result in itertools.imap(mw.diff.render, jobs):
+                yield result
+            return
+        import multiprocessing
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            for result in pool.imap(mw.diff.render, jobs):
+                yield result
+        finally:
+            pool.terminate()
+
+    def _print_stat(self, filenames, stats):
+        width = max([len(filename) for filename in filenames] + [0])
+        total_added = total_removed = 0
+        for filename, (added, removed) in itertools.izip(filenames, stats):
+            total_added += added
+            total_removed += removed
+            print ' %-*s | %5d %s%s' % (width, filename, added + removed,
+                                        '+' * min(added, 40),
+                                        '-' * min(removed, 40))
+        if filenames:
+            print ' %d files changed, %d insertions(+), %d deletions(-)' % (
+                    len(filenames), total_added, total_removed)
+
+
+class GrepCommand(CommandBase):
+    name = 'grep'
+    description = 'search the text of pulled pages'
+    usage = '[options] PATTERN'
+    shortcuts = ['search']
+
+    def __init__(self, metadir=None):
+        CommandBase.__init__(self, metadir)
+        self.parser.add_option('-i', '--ignore-case', dest='ignore_case',
+                               action='store_true', default=False,
+                               help='ignore upper/lower case')
+        self.parser.add_option('-F', '--fixed-strings', dest='fixed',
+                               action='store_true', default=False,
+                               help='PATTERN is plain text, not a regex')
+        self.parser.add_option('-w', '--word-regexp', dest='word',
+                               action='store_true', default=False,
+                               help='only match whole words')
+        self.parser.add_option('-l', '--files-with-matches', dest='titles',
+                               action='store_true', default=False,
+                               help='only print the titles of matching pages')
+        self.parser.add_option('--rebuild', dest='rebuild',
+                               action='store_true', default=False,
+                               help='index every cached page again')
+
+    def _do_command(self):
+        import re
+        import mw.search
+        self._die_if_no_init()
+        if not self.metadir.use_sqlite:
+            print '%s: grep needs the page cache in store.db, run ' \
+                  'mw migrate-cache first' % self.me
+            sys.exit(1)
+        if len(self.args) != 1 and not self.options.rebuild:
+            self.parser.error('must have one pattern')
+        index = self.metadir.search_index()
+        if index is None or self.options.rebuild:
+            count = self.metadir.search_rebuild()
+            index = self.metadir.search_index()
+            if self.options.rebuild:
+                print 'indexed %d pages' % count
+        if not self.args:
+            return
+        pattern = self.args[0].decode('utf-8')
+        if self.options.fixed:
+            pattern = re.escape(pattern)
+        if self.options.word:
+            pattern = r'\b%s\b' % pattern
+        flags = re.UNICODE | re.MULTILINE
+        if self.options.ignore_case:
+            flags |= re.IGNORECASE
+        try:
+            regex = re.compile(pattern, flags)
+        except re.error, e:
+            self.parser.error('bad pattern: %s' % e)
+        # the index narrows the pages down, the regex has the final say
+        pageids = index.candidates(mw.search.required_terms(pattern, flags))
+        if pageids is None:
+            pageids = index.pages()
+        matches = []
+        for pageid in pageids:
+            title = self.metadir.get_pagename_from_pageid(pageid)
+            if title is None:
+                continue
+            page = {'id': pageid}
+            rv = self.metadir.pages_get_rv(
+                    page, self.metadir.pages_get_rv_list(page)[-1])
+            if rv and regex.search(rv.get('content', u'')):
+                matches.append((title, rv['content']))
+        matches.sort()
+        for title, content in matches:
+            if self.options.titles:
+                print title.encode('utf-8')
+                continue
+            for number, line in enumerate(content.split(u'\n')):
+                if regex.search(line):
+                    print ('%s:%d:%s' % (title, number + 1,
+                                         line)).encode('utf-8')
 
 
 class MergeCommand(CommandBase):
-    def __init__(self):
-        usage = '[FILES]'
-        CommandBase.__init__(self, 'merge', 'merge local and wiki copies', usage)
+    name = 'merge'
+    description = 'merge wiki changes into locally modified files'
+    usage = '[options] [FILES]'
+
+    def __init__(self, metadir=None):
+        CommandBase.__init__(self, metadir)
+        self.parser.add_option('-m', '--message', dest='edit_summary',
+                               help='edit summary for committing the merged '
+                               'files, instead of prompting for one')
+        self.parser.add_option('-b', '--bot', dest='bot', action='store_true',
+                               default=False,
+                               help='mark the commits as a bot')
+        self.parser.add_option('-n', '--no-commit', dest='commit',
+                               action='store_false', default=True,
+                               help='leave the merged files uncommitted')
+        self.parser.add_option('--tool', dest='tool', action='store_true',
+                               default=False,
+                               help='run merge.tool from .mw/config on the '
+                               'files that still conflict')
 
     def _do_command(self):
+        # the base of each merge is the revision we last pulled, so the
+        # wiki is only asked for the latest revisions, in batches, and the
+        # merged files are committed together at the end
+        import mw.merge3
         self._die_if_no_init()
-        self.merge_tool = self.metadir.config.get('merge', 'tool')
-        status = self.metadir.working_dir_status()
+        self._api_setup()
+        status = self.metadir.working_dir_status(files=self.args,
+                                                 clean=False)
+        by_title = {}
         for filename in status:
-            if status[filename] == 'M':
-                full_filename = os.path.join(self.metadir.root, filename)
-                pagename = mw.metadir.filename_to_pagename(filename[:-5])
-                # mv local to filename.wiki.local
-                os.rename(full_filename, full_filename + '.local')
-                # pull wiki copy
-                pull_command = PullCommand()
-                pull_command.args = [pagename]#.encode('utf-8')] #assuming the file is already using utf-8 - esby
-                pull_command._do_command()
-                # mv remote to filename.wiki.remote
-                os.rename(full_filename, full_filename + '.remote')
-                # Open merge tool
-                merge_command = self.merge_tool % (full_filename + '.local', 
+            if status[filename] != 'M' or filename[-5:] != '.wiki':
+                continue
+            pagename = mw.metadir.filename_to_pagename(filename[:-5])
+            if isinstance(pagename, str):
+                pagename = pagename.decode('utf-8')
+            by_title[pagename] = filename
+        merged = []
+        conflicted = []
+        for filename, pageid, title, rv in self._remote_heads(by_title):
+            baserevid = self.metadir.pages_get_rv_list({'id': pageid})[-1]
+            base = self.metadir.pages_get_rv({'id': pageid},
+                                             baserevid)['content']
+            local = self._local_text(filename)
+            remote = rv['*']
+            with mw.metrics.timer('merge.merge'):
+                text, conflicts = mw.merge3.merge(base, local, remote,
+                        'local', 'wiki (revision %d)' % rv['revid'])
+            # the wiki's revision becomes the one the file is changed from
+            self.metadir.pagedict_add(title, pageid, rv['revid'])
+            self.metadir.pages_add_rv(int(pageid), rv)
+            self.metadir.write_working_file(filename, text.encode('utf-8'),
+                                            clean=text == remote)
+            if conflicts:
+                print 'conflict:       "%s" -- %d conflicting changes ' \
+                      '(%d -> %d)' % (filename, conflicts, baserevid,
+                                      rv['revid'])
+                conflicted.append((filename, local, remote))
+            elif text == remote:
+                print 'up to date:     "%s" -- the wiki already has the ' \
+                      'local changes' % filename
+            else:
+                print 'merged:         "%s" (%d -> %d)' % (filename,
+                                                          baserevid,
+                                                          rv['revid'])
+                merged.append(filename)
+        self.metadir.cache_commit()
+        self.metadir.index_save()
+        if not merged and not conflicted:
+            print 'nothing to merge'
+        if self.options.tool:
+            merged += self._run_tool(conflicted)
+        elif conflicted:
+            print '%d files have conflicts, fix the parts between <<<<<<< ' \
+                  'and >>>>>>> and commit them' % len(conflicted)
+        if merged and self.options.commit:
+            commit = CommitCommand(self.metadir)
+            commit.options.edit_summary = self.options.edit_summary
+            commit.options.bot = self.options.bot
+            commit.args = [os.path.join(self.metadir.root, filename)
+                           for filename in sorted(merged)]
+            commit._do_command()
+
+    def _remote_heads(self, by_title):
+        # yields (filename, pageid, title, latest revision) for the pages
+        # edited on the wiki since we pulled them, with the content
+        batch = self._batch_size()
+        requests = ({
+                'action': 'query',
+                'titles': '|'.join(these_pages),
+                'prop': 'info',
+        } for these_pages in _chunks(sorted(by_title), batch))
+        changed = {}
+        for data, response in self._fetcher().run(requests):
+            response = response['query']
+            for normalized in response.get('normalized', []):
+                by_title[normalized['to']] = by_title[normalized['from']]
+            for pageid, page in response['pages'].iteritems():
+                filename = by_title[page['title']]
+                if 'missing' in page:
+                    print 'warning: "%s" no longer exists on the wiki ' \
+                          '-- skipping!' % filename
+                    continue
+                if page['lastrevid'] != \
+                   self.metadir.pages_get_rv_list({'id': pageid})[-1]:
+                    changed[page['lastrevid']] = (filename, pageid)
+        requests = ({
+                'action': 'query',
+                'revids': '|'.join([str(revid) for revid in these_revids]),
+                'prop': 'info|revisions',
+                'rvprop': 'ids|flags|timestamp|user|comment|content',
+        } for these_revids in _chunks(sorted(changed), batch))
+        for data, response in self._fetcher().run(requests):
+            for pageid, page in response['query']['pages'].iteritems():
+                rv = page['revisions'][0]
+                filename, pageid = changed[rv['revid']]
+                yield filename, pageid, page['title'], rv
+
+    def _local_text(self, filename):
+        text = codecs.open(os.path.join(self.metadir.root, filename), 'r',
+                           'utf-8').read()
+        if text[-1:] == u'\n':
+            text = text[:-1]
+        return text
+
+    def _run_tool(self, conflicted):
+        # the old way: merge.tool gets the local and the wiki's copy and
+        # writes FILE.merge, which replaces the file with the markers
+        import subprocess
+        merge_tool = self.metadir.config_get('merge', 'tool',
+                                             'kdiff3 %s %s -o %s')
+        resolved = []
+        for filename, local, remote in conflicted:
+            full_filename = os.path.join(self.metadir.root, filename)
+            for suffix, text in [('.local', local), ('.remote', remote)]:
+                fd = file(full_filename + suffix, 'w')
+                fd.write(text.encode('utf-8'))
+                fd.close()
+            merge_command = merge_tool % (full_filename + '.local',
                     full_filename + '.remote', full_filename + '.merge')
-                subprocess.call(merge_command.split(' '))
-                # mv filename.merge filename and delete tmp files
-                os.rename(full_filename + '.merge', full_filename)
-                os.remove(full_filename + '.local')
-                os.remove(full_filename + '.remote')
-                # mw ci pagename
-                commit_command = CommitCommand()
-                commit_command.args = [pagename]#.encode('utf-8')] #assuming the file is already using utf-8 - esby
-                commit_command._do_command()
+            code = subprocess.call(merge_command.split(' '))
+            os.remove(full_filename + '.local')
+            os.remove(full_filename + '.remote')
+            if code != 0 or not os.path.exists(full_filename + '.merge'):
+                print 'conflict:       "%s" -- left with conflict markers' \
+                      % filename
+                continue
+            os.rename(full_filename + '.merge', full_filename)
+            resolved.append(filename)
+        return resolved
 
 
 class CommitCommand(CommandBase):
+    name = 'commit'
+    description = 'commit changes to wiki'
+    usage = '[FILES]'
+    shortcuts = ['ci']
 
-    def __init__(self):
-        usage = '[FILES]'
-        CommandBase.__init__(self, 'commit', 'commit changes to wiki', usage)
-        self.shortcuts.append('ci')
+    def __init__(self, metadir=None):
+        CommandBase.__init__(self, metadir)
         self.parser.add_option('-m', '--message', dest='edit_summary',
                                help='don\'t prompt for edit summary and '
                                'use this instead')
@@ -335,108 +1537,320 @@ class CommitCommand(CommandBase):
                                help='mark actions as a bot (won\'t affect '
                                'anything if you don\'t have the bot right',
                                default=False)
+        self.parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                               help='number of edits to keep in flight '
+                               '(default: commit.jobs from .mw/config)')
+        self.parser.add_option('--resume', dest='resume',
+                               action='store_true', default=False,
+                               help='carry on with an interrupted commit; '
+                               'edits it made are not made again')
+        # defaults, for when another command runs a commit
+        (self.options, self.args) = self.parser.parse_args([])
 
     def _do_command(self):
         self._die_if_no_init()
         self._api_setup()
-        files_to_commit = 0 # how many files to process
-        status = self.metadir.working_dir_status(files=self.args)
-        for filename in status:
-            if status[filename] in ['M']:
-                print '%s %s' % (status[filename], filename)
-                files_to_commit += 1
-        if not files_to_commit:
+        if self.options.resume:
+            # the edits that went through only need their new revisions
+            # fetched back, the rest are committed as usual
+            session = self._session_resume()
+            self._refetch([tuple(edit) for edit in session['edited']])
+        status = self.metadir.working_dir_status(files=self.args,
+                                                 clean=False)
+        filenames = sorted([filename for filename in status
+                            if status[filename] in ['M']])
+        for filename in filenames:
+            print '%s %s' % (status[filename], filename)
+        media = [filename for filename in filenames
+                 if filename[-5:] != '.wiki']
+        filenames = [filename for filename in filenames
+                     if filename[-5:] == '.wiki']
+        if not filenames and not media:
             print 'nothing to commit'
+            if self.options.resume:
+                self.metadir.index_save()
+                self._session_end()
             sys.exit()
         if self.options.edit_summary == None:
             print 'Edit summary:',
             edit_summary = raw_input()
         else:
             edit_summary = self.options.edit_summary
-        for filename in status:
-            if status[filename] in ['M']:
-                start_time = time.time()
-                files_to_commit -= 1
-                # get edit token
-                data = {
-                        'action': 'query',
-                        'prop': 'info|revisions',
-                        'intoken': 'edit',
-                        'titles': mw.metadir.filename_to_pagename(filename[:-5]),
-                }
-                response = self.api.call(data)
-                pages = response['query']['pages']
-                pageid = pages.keys()[0]
-                revid = pages[pageid]['revisions'][0]['revid']
+        self.options.edit_summary = edit_summary
+        self._session_start(['edit_summary', 'bot', 'jobs'])
+        self.session['edited'] = []
+        with mw.metrics.timer('commit.check'):
+            pages = self._check_conflicts(filenames)
+        with mw.metrics.timer('commit.edit'):
+            committed = self._edit(pages, edit_summary)
+        with mw.metrics.timer('commit.refetch'):
+            self._refetch(committed + self.unrecorded)
+        if media:
+            with mw.metrics.timer('commit.upload'):
+                self._upload(media, edit_summary)
+        self.metadir.index_save()
+        self._session_end()
+
+    def _check_conflicts(self, filenames):
+        # one query per batch of titles tells us whether anyone edited the
+        # pages since we pulled them, and gives us an edit token; the size
+        # and SHA-1 of the wiki's text, compared with ours, tell us
+        # without any text being sent whether there is anything to do
+        by_title = {}
+        for filename in filenames:
+            pagename = mw.metadir.filename_to_pagename(filename[:-5])
+            if isinstance(pagename, str):
+                pagename = pagename.decode('utf-8')
+            by_title[pagename] = filename
+        self.edittoken = None
+        self.unrecorded = []
+        pages = []
+        for these_pages in _chunks(sorted(by_title), self._batch_size()):
+            data = {
+                    'action': 'query',
+                    'prop': 'info|revisions',
+                    'rvprop': 'ids|timestamp|sha1|size',
+                    'intoken': 'edit',
+                    'titles': '|'.join(these_pages),
+            }
+            response = self.api.call(data)['query']
+            for normalized in response.get('normalized', []):
+                by_title[normalized['to']] = by_title[normalized['from']]
+            for pageid, page in response['pages'].iteritems():
+                filename = by_title[page['title']]
+                if 'edittoken' in page:
+                    self.edittoken = page['edittoken']
+                if 'missing' in page:
+                    print 'warning: "%s" no longer exists on the wiki ' \
+                            '-- skipping!' % filename
+                    continue
+                rv = page['revisions'][0]
                 awaitedrevid = \
-                        self.metadir.pages_get_rv_list({'id': pageid})[0]
-                if revid != awaitedrevid:
+                        self.metadir.pages_get_rv_list({'id': pageid})[-1]
+                text = self._edit_text(filename)
+                if rv.get('size') == len(text) and \
+                   rv.get('sha1') == hashlib.sha1(text).hexdigest():
+                    # the wiki has this text already: made by an
+                    # interrupted commit that was stopped before it could
+                    # note that down, or nothing but a trailing newline
+                    # changed; no edit needed, just the revision recorded
+                    self.unrecorded.append((filename, pageid, rv['revid']))
+                    continue
+                if rv['revid'] != awaitedrevid and rv.get('sha1') != \
+                   self.metadir.pages_get_rv_sha1({'id': pageid},
+                                                  awaitedrevid):
                     print 'warning: edit conflict detected on "%s" (%s -> %s) ' \
-                            '-- skipping! (try merge)' % (filename, awaitedrevid, revid)
+                            '-- skipping! (try merge)' % (filename, awaitedrevid,
+                                                          rv['revid'])
                     continue
-                edittoken = pages[pageid]['edittoken']
-                full_filename = os.path.join(self.metadir.root, filename)
-                text = codecs.open(full_filename, 'r', 'utf-8').read()
-                text = text.encode('utf-8')
-                if (len(text) != 0) and (text[-1] == '\n'):
-                    text = text[:-1]
-                md5 = hashlib.md5()
-                md5.update(text)
-                textmd5 = md5.hexdigest()
-                data = {
-                        'action': 'edit',
-                        'title': mw.metadir.filename_to_pagename(filename[:-5]),
-                        'token': edittoken,
-                        'text': text,
-                        'md5': textmd5,
-                        'summary': edit_summary,
-                }
-                if self.options.bot:
-                    data['bot'] = 'bot'
-                response = self.api.call(data)
-                if 'error' in response:
-                    if 'code' in response['error']:
-                        if response['error']['code'] == 'permissiondenied':
-                            print 'Permission denied -- try running "mw login"'
-                            return
-                if response['edit']['result'] == 'Success':
-                    if 'nochange' in response['edit']:
-                        print 'warning: no changes detected in %s - ' \
-                                'skipping and removing ending LF' % filename
-                        pagename = mw.metadir.filename_to_pagename(filename[:-5])
-                        self.metadir.clean_page(pagename)
-                        continue
-                    if response['edit']['oldrevid'] != revid:
-                        print 'warning: edit conflict detected on %s (%s -> %s) ' \
-                                '-- skipping!' % (file, 
-                                response['edit']['oldrevid'], revid)
-                        continue
-                    data = {
-                            'action': 'query',
-                            'revids': response['edit']['newrevid'],
-                            'prop': 'info|revisions',
-                            'rvprop':
-                                    'ids|flags|timestamp|user|comment|content',
-                    }
-                    response = self.api.call(data)['query']['pages']
-                    self.metadir.pages_add_rv(int(pageid),
-                                              response[pageid]['revisions'][0])
-                    # need to write latest rev to file too, as text may be changed
-                    #such as a sig, e.g., -~ =>  -[[User:Reagle|Reagle]]
-                    with file(full_filename, 'w') as fd:
-                        data = response[pageid]['revisions'][0]['*']
-                        data = data.encode('utf-8')
-                        fd.write(data)
-                    if files_to_commit :
-                        end_time = time.time()
-                        print time.strftime("%Y-%m-%d - %H:%M:%S", time.gmtime(time.time())) \
-                            + " - Committed - " + mw.metadir.filename_to_pagename(filename[:-5]) \
-                            + " - Files left: " + str(files_to_commit)
-                        time_inc = end_time - start_time
-                        delay = 10 - time_inc
-                        if delay > 0 :
-                            print "adjusting throttle - waiting for %.2fs" % delay
-                            time.sleep(delay) 
+                # a newer revision with the same text (a move or protection
+                # note) is no conflict, the edit goes on top of it
+                pages.append((filename, page['title'], pageid, rv['revid'],
+                              rv['timestamp']))
+        if pages:
+            self._csrf_token()
+        pages.sort()
+        return pages
+
+    def _csrf_token(self):
+        if self.edittoken is None:
+            # newer wikis dropped intoken in favour of meta=tokens
+            data = {
+                    'action': 'query',
+                    'meta': 'tokens',
+            }
+            response = self.api.call(data)
+            self.edittoken = response['query']['tokens']['csrftoken']
+        return self.edittoken
+
+    def _edit(self, pages, edit_summary):
+        import mw.fetcher
+        config = self.metadir.config_get
+        jobs = self.options.jobs or int(config('commit', 'jobs', 1))
+        maxlag = config('remote', 'maxlag', None)
+        if maxlag is not None:
+            maxlag = int(maxlag)
+        # the wiki gets at most edits_per_minute edits from us, whatever
+        # the number of jobs; maxlag and rate limit errors slow us down
+        # further
+        fetcher = mw.fetcher.BatchFetcher(self._new_api, jobs=jobs,
+                rate=float(config('commit', 'edits_per_minute', 6)) / 60,
+                burst=1, maxlag=maxlag)
+        by_title = dict([(page[1].encode('utf-8'), page) for page in pages])
+        self.stop = False
+        committed = []
+        files_to_commit = len(pages)
+        for data, response in fetcher.run(self._edit_requests(pages,
+                                                              edit_summary)):
+            files_to_commit -= 1
+            filename, pagename, pageid, revid, basetimestamp = \
+                    by_title[data['title']]
+            if 'error' in response:
+                code = response['error'].get('code')
+                if code == 'permissiondenied':
+                    print 'Permission denied -- try running "mw login"'
+                    self.stop = True  # let the edits in flight finish
+                elif code == 'editconflict':
+                    print 'warning: edit conflict detected on "%s" ' \
+                            '-- skipping! (try merge)' % filename
                 else:
                     print 'error: committing %s failed: %s' % \
-                            (filename, response['edit']['result'])
+                            (filename, response['error'].get('info', code))
+                continue
+            if response['edit']['result'] == 'Success':
+                if 'nochange' in response['edit']:
+                    print 'warning: no changes detected in %s - ' \
+                            'skipping and removing ending LF' % filename
+                    self.metadir.clean_page(
+                            mw.metadir.filename_to_pagename(filename[:-5]))
+                    continue
+                if response['edit']['oldrevid'] != revid:
+                    print 'warning: edit conflict detected on %s (%s -> %s) ' \
+                            '-- skipping!' % (filename,
+                            response['edit']['oldrevid'], revid)
+                    continue
+                committed.append((filename, pageid,
+                                  response['edit']['newrevid']))
+                # the edit is made, whatever happens to us from here on
+                self.session['edited'].append(list(committed[-1]))
+                self.metadir.session_set(self.session)
+                print time.strftime("%Y-%m-%d - %H:%M:%S", time.gmtime(time.time())) \
+                    + " - Committed - " + pagename.encode('utf-8') \
+                    + " - Files left: " + str(files_to_commit)
+            else:
+                print 'error: committing %s failed: %s' % \
+                        (filename, response['edit']['result'])
+        return committed
+
+    def _edit_requests(self, pages, edit_summary):
+        for filename, pagename, pageid, revid, basetimestamp in pages:
+            if self.stop:
+                return
+            text = self._edit_text(filename)
+            md5 = hashlib.md5()
+            md5.update(text)
+            textmd5 = md5.hexdigest()
+            data = {
+                    'action': 'edit',
+                    'title': pagename.encode('utf-8'),
+                    'token': self.edittoken,
+                    'text': text,
+                    'md5': textmd5,
+                    'summary': edit_summary,
+                    'basetimestamp': basetimestamp,
+            }
+            if self.options.bot:
+                data['bot'] = 'bot'
+            yield data
+
+    def _edit_text(self, filename):
+        # the text the wiki gets for `filename`
+        full_filename = os.path.join(self.metadir.root, filename)
+        text = codecs.open(full_filename, 'r', 'utf-8').read()
+        text = text.encode('utf-8')
+        if (len(text) != 0) and (text[-1] == '\n'):
+            text = text[:-1]
+        return text
+
+    def _upload(self, filenames, comment):
+        # new versions of media files, one at a time through the upload
+        # stash; the wiki's SHA-1 tells us whether someone uploaded one
+        # since we pulled (or we did, in an interrupted commit)
+        by_title = {}
+        for filename in filenames:
+            by_title[mw.metadir.filename_to_pagename(filename).decode(
+                    'utf-8')] = filename
+        uploads = []
+        for these_titles in _chunks(sorted(by_title), self._batch_size()):
+            data = {
+                    'action': 'query',
+                    'titles': '|'.join(these_titles),
+                    'prop': 'imageinfo',
+                    'iiprop': 'sha1|timestamp',
+            }
+            response = self.api.call(data)['query']
+            for normalized in response.get('normalized', []):
+                by_title[normalized['to']] = by_title[normalized['from']]
+            for page in response['pages'].itervalues():
+                filename = by_title[page['title']]
+                if not page.get('imageinfo'):
+                    print 'warning: "%s" no longer exists on the wiki ' \
+                            '-- skipping!' % filename
+                    continue
+                info = page['imageinfo'][0]
+                sha1 = self.metadir.media_sha1(filename)
+                if info['sha1'] == sha1:
+                    self.metadir.media_set(filename, sha1, info['timestamp'])
+                    continue
+                if info['sha1'] != self.metadir.media_get(filename)['sha1']:
+                    print 'warning: edit conflict detected on "%s" ' \
+                            '-- skipping! (move it aside and pull it ' \
+                            'again)' % filename
+                    continue
+                uploads.append((filename, page['title'], sha1))
+        chunk_size = int(self.metadir.config_get('commit', 'upload_chunk',
+                                                 mw.media.UPLOAD_CHUNK))
+        for filename, title, sha1 in sorted(uploads):
+            response = mw.media.upload(self.api,
+                    os.path.join(self.metadir.root, filename),
+                    title.split(u':', 1)[1], comment, self._csrf_token(),
+                    chunk_size)
+            if 'error' in response:
+                print 'error: uploading %s failed: %s' % (filename,
+                        response['error'].get('info',
+                                              response['error'].get('code')))
+                continue
+            if response['upload']['result'] != 'Success':
+                print 'error: uploading %s failed: %s' % (filename,
+                        response['upload']['result'])
+                continue
+            self.metadir.media_set(filename, sha1,
+                    response['upload'].get('imageinfo', {}).get('timestamp'))
+            print time.strftime("%Y-%m-%d - %H:%M:%S", time.gmtime(time.time())) \
+                + " - Uploaded - " + filename
+
+    def _refetch(self, committed):
+        # the new revisions go into the cache; the wiki keeps our text as
+        # it is unless a pre-save transform changed it (a sig, e.g.,
+        # -~ =>  -[[User:Reagle|Reagle]]), so its size and SHA-1 tell us
+        # whether the text has to be downloaded and the file rewritten
+        by_pageid = dict([(str(pageid), filename)
+                          for filename, pageid, newrevid in committed])
+        changed = []
+        for these_revids in _chunks([newrevid for filename, pageid, newrevid
+                                     in committed], self._batch_size()):
+            data = {
+                    'action': 'query',
+                    'revids': '|'.join([str(revid) for revid in these_revids]),
+                    'prop': 'info|revisions',
+                    'rvprop': 'ids|flags|timestamp|user|comment|sha1|size',
+            }
+            response = self.api.call(data)['query']['pages']
+            for pageid, page in response.iteritems():
+                rv = page['revisions'][0]
+                filename = by_pageid[pageid]
+                text = self._edit_text(filename)
+                if rv.get('size') != len(text) or \
+                   rv.get('sha1') != hashlib.sha1(text).hexdigest():
+                    changed.append(rv['revid'])
+                    continue
+                rv['*'] = text.decode('utf-8')
+                self._refetched(page['title'], pageid, rv, filename)
+            self.metadir.cache_commit()
+        for these_revids in _chunks(changed, self._batch_size()):
+            data = {
+                    'action': 'query',
+                    'revids': '|'.join([str(revid) for revid in these_revids]),
+                    'prop': 'info|revisions',
+                    'rvprop': 'ids|flags|timestamp|user|comment|content',
+            }
+            response = self.api.call(data)['query']['pages']
+            for pageid, page in response.iteritems():
+                self._refetched(page['title'], pageid, page['revisions'][0],
+                                by_pageid[pageid])
+            self.metadir.cache_commit()
+
+    def _refetched(self, pagename, pageid, rv, filename):
+        self.metadir.pagedict_add(pagename, pageid, rv['revid'])
+        self.metadir.pages_add_rv(int(pageid), rv)
+        self.metadir.write_working_file(filename, rv['*'].encode('utf-8'))
@@ -0,0 +1,271 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+# `mw daemon` keeps the status of every file in the working directory in
+# memory and is told about changes by inotify, so a status scan becomes a
+# question over .mw/daemon.sock. Requests and answers are one line of
+# JSON each.
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import socket
+import struct
+
+SOCKET = 'daemon.sock'
+# a daemon that takes longer than this to answer is treated as absent
+TIMEOUT = 2.0
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+             IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | \
+             IN_MOVE_SELF
+_event = struct.Struct('iIII')
+
+
+def socket_path(metadir):
+    # sockaddr_un only holds ~100 bytes, so prefer a relative path
+    path = os.path.join(metadir.location, SOCKET)
+    relative = os.path.relpath(path)
+    if len(relative) < len(path):
+        return relative
+    return path
+
+
+def request(metadir, data):
+    """Ask the daemon; None if there is none or it didn't answer."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.settimeout(TIMEOUT)
+            sock.connect(socket_path(metadir))
+            sock.sendall(json.dumps(data) + '\n')
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                if chunk.endswith('\n'):
+                    break
+            response = json.loads(''.join(chunks))
+        except (socket.error, ValueError):
+            return None
+    finally:
+        sock.close()
+    if 'error' in response:
+        return None
+    return response
+
+
+def status(metadir, clean=True):
+    # the same as metadir.working_dir_status() with no files, less the
+    # clean ones unless `clean`
+    response = request(metadir, {'command': 'status', 'clean': clean})
+    if response is None:
+        return None
+    return dict([(filename.encode('utf-8'), code) for filename, code
+                 in response['status'].iteritems()])
+
+
+class Inotify(object):
+    """Just enough of inotify(7), through ctypes."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read(self):
+        """Return the queued (wd, mask, name) events, without waiting."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return events
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event.unpack_from(data, offset)
+                offset += _event.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Daemon(object):
+
+    def __init__(self, metadir):
+        self.metadir = metadir
+        # the daemon is the one doing the scanning
+        metadir.use_daemon = False
+        self.inotify = Inotify()
+        self.watches = {}
+        self.dirty = set()
+        self.status = {}
+        self.running = True
+
+    def scan(self):
+        # everything from scratch, and a watch on every directory
+        for wd in self.watches.keys():
+            self.inotify.libc.inotify_rm_watch(self.inotify.fd, wd)
+        self.watches = {}
+        self._watch('')
+        self.inotify.read()  # the scan sees whatever these were about
+        self.dirty = set()
+        self.status = self.metadir.working_dir_status()
+
+    def _watch(self, reldir):
+        dirs = [reldir]
+        while dirs:
+            reldir = dirs.pop()
+            full = os.path.join(self.metadir.root, reldir)
+            try:
+                self.watches[self.inotify.add_watch(full)] = reldir
+                names = os.listdir(full)
+            except OSError:
+                continue  # gone again already
+            for name in names:
+                if reldir == '' and name == '.mw':
+                    continue
+                path = os.path.join(full, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    dirs.append(os.path.join(reldir, name))
+
+    def catch_up(self):
+        """Bring the status up to date with what inotify has seen."""
+        rescan = False
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                rescan = True  # we missed some
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            if mask & IN_ISDIR:
+                # a directory came, went or moved along with its files
+                rescan = True
+                continue
+            filename = os.path.join(self.watches[wd], name)
+            if name.endswith('.wiki') or \
+               self.metadir.media_get(filename) is not None:
+                self.dirty.add(filename)
+        if rescan:
+            self.scan()
+            return
+        if not self.dirty:
+            return
+        check = []
+        for filename in self.dirty:
+            full = os.path.join(self.metadir.root, filename)
+            if os.path.isfile(full):
+                check.append(full)
+            else:
+                self.status.pop(filename, None)
+        self.dirty = set()
+        try:
+            if check:
+                self.status.update(
+                        self.metadir.working_dir_status(files=check))
+        except OSError:
+            # one went away while we looked, there is an event for it
+            self.dirty.update(os.path.relpath(full, self.metadir.root)
+                              for full in check)
+
+    def handle(self, data):
+        command = data.get('command')
+        if command == 'status':
+            self.catch_up()
+            if data.get('clean', True):
+                return {'status': self.status}
+            # most of a big checkout is clean, and callers skip those
+            return {'status': dict([(filename, code) for filename, code
+                                    in self.status.iteritems()
+                                    if code != 'C'])}
+        if command == 'stop':
+            self.running = False
+            return {'stopped': True}
+        return {'error': 'unknown command %r' % command}
+
+    def serve(self, listener):
+        clients = {}
+        while self.running:
+            readable = select.select([listener, self.inotify.fd] +
+                                     clients.keys(), [], [])[0]
+            if self.inotify.fd in readable:
+                # read events as they come, so the queue can't overflow
+                self.catch_up()
+            if listener in readable:
+                client = listener.accept()[0]
+                client.settimeout(TIMEOUT)
+                clients[client] = []
+            for client in clients.keys():
+                if client not in readable:
+                    continue
+                try:
+                    chunk = client.recv(65536)
+                except socket.error:
+                    chunk = ''
+                clients[client].append(chunk)
+                if chunk and not chunk.endswith('\n'):
+                    continue
+                data = ''.join(clients.pop(client))
+                try:
+                    if data:
+                        client.sendall(json.dumps(
+                                self.handle(json.loads(data))) + '\n')
+                except (socket.error, ValueError):
+                    pass
+                client.close()
@@ -0,0 +1,254 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import bisect
+import re
+
+# a line that shows up more often than this on either side is too common
+# to anchor a match on; the region around it is reported as a replacement
+MAX_CHAIN = 64
+
+_word_re = re.compile(r'\w+|\s+|[^\w\s]+', re.UNICODE)
+
+
+def split_lines(text):
+    """Split `text` into lines that each end in a newline."""
+    return [line + '\n' for line in text.split('\n')]
+
+
+def matching_lines(a, b):
+    """
+    Return the sorted (i, j) pairs where a[i] == b[j] is part of the diff.
+
+    Patience diff: lines unique on both sides anchor the match, the
+    longest increasing run of them is kept, and the gaps in between are
+    worked on the same way. Gaps without unique lines fall back to the
+    rarest shared line, as histogram diff does.
+    """
+    matches = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        alo, ahi, blo, bhi = regions.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = _unique_lcs(a, alo, ahi, b, blo, bhi)
+        if not anchors:
+            anchors = _rarest(a, alo, ahi, b, blo, bhi)
+        for i, j in anchors:
+            regions.append((alo, i, blo, j))
+            matches.append((i, j))
+            alo = i + 1
+            blo = j + 1
+        if anchors:
+            regions.append((alo, ahi, blo, bhi))
+    matches.sort()
+    return matches
+
+
+def _unique_lcs(a, alo, ahi, b, blo, bhi):
+    # lines that occur exactly once in each range, in b's order
+    in_a = {}
+    for i in xrange(alo, ahi):
+        in_a[a[i]] = -1 if a[i] in in_a else i
+    in_b = {}
+    for j in xrange(blo, bhi):
+        line = b[j]
+        if line in in_a and in_a[line] >= 0:
+            in_b[line] = -1 if line in in_b else j
+    pairs = [(in_a[line], j) for line, j in in_b.iteritems() if j >= 0]
+    if not pairs:
+        return []
+    pairs.sort(key=lambda pair: pair[1])
+    # longest run of increasing a positions, by patience sorting
+    tops = []
+    stacks = []
+    back = {}
+    for pair in pairs:
+        k = bisect.bisect(tops, pair[0])
+        if k == len(tops):
+            tops.append(pair[0])
+            stacks.append(pair)
+        else:
+            tops[k] = pair[0]
+            stacks[k] = pair
+        back[pair] = stacks[k - 1] if k > 0 else None
+    run = []
+    pair = stacks[-1]
+    while pair is not None:
+        run.append(pair)
+        pair = back[pair]
+    run.reverse()
+    return run
+
+
+def _rarest(a, alo, ahi, b, blo, bhi):
+    counts = {}
+    for i in xrange(alo, ahi):
+        counts[a[i]] = counts.get(a[i], 0) + 1
+    best = None
+    for j in xrange(blo, bhi):
+        line = b[j]
+        if line in counts and (best is None or counts[line] < counts[best]):
+            best = line
+    if best is None or counts[best] > MAX_CHAIN:
+        return []
+    i = a.index(best, alo, ahi)
+    j = b.index(best, blo, bhi)
+    return [(i, j)]
+
+
+def opcodes(a, b):
+    """Describe how to turn `a` into `b` like SequenceMatcher.get_opcodes."""
+    codes = []
+    i = j = 0
+    for mi, mj in matching_lines(a, b) + [(len(a), len(b))]:
+        if i < mi and j < mj:
+            codes.append(('replace', i, mi, j, mj))
+        elif i < mi:
+            codes.append(('delete', i, mi, j, j))
+        elif j < mj:
+            codes.append(('insert', i, i, j, mj))
+        if mi < len(a):
+            if codes and codes[-1][0] == 'equal':
+                codes[-1] = ('equal', codes[-1][1], mi + 1,
+                             codes[-1][3], mj + 1)
+            else:
+                codes.append(('equal', mi, mi + 1, mj, mj + 1))
+        i = mi + 1
+        j = mj + 1
+    return codes
+
+
+def hunks(codes, context=3):
+    """Group `codes` into hunks with `context` lines of equal text around."""
+    if not codes:
+        return
+    codes = list(codes)
+    tag, i1, i2, j1, j2 = codes[0]
+    if tag == 'equal':
+        codes[0] = (tag, max(i1, i2 - context), i2,
+                    max(j1, j2 - context), j2)
+    tag, i1, i2, j1, j2 = codes[-1]
+    if tag == 'equal':
+        codes[-1] = (tag, i1, min(i2, i1 + context), j1,
+                     min(j2, j1 + context))
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > context * 2:
+            group.append((tag, i1, i1 + context, j1, j1 + context))
+            yield group
+            group = []
+            i1 = i2 - context
+            j1 = j2 - context
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _range(start, length):
+    if length == 1:
+        return '%d' % (start + 1)
+    if length == 0:
+        return '%d,0' % start
+    return '%d,%d' % (start + 1, length)
+
+
+def _header(group):
+    first, last = group[0], group[-1]
+    return '@@ -%s +%s @@\n' % (_range(first[1], last[2] - first[1]),
+                                _range(first[3], last[4] - first[3]))
+
+
+def unified_diff(oldname, a, newname, b, context=3):
+    """Return a unified diff of the line lists `a` and `b`, or ''."""
+    out = []
+    for group in hunks(opcodes(a, b), context):
+        if not out:
+            out.append('--- %s\n+++ %s\n' % (oldname, newname))
+        out.append(_header(group))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                out.extend(' ' + line for line in a[i1:i2])
+                continue
+            out.extend('-' + line for line in a[i1:i2])
+            out.extend('+' + line for line in b[j1:j2])
+    return ''.join(out)
+
+
+def word_diff(oldname, a, newname, b, context=3):
+    """
+    Like unified_diff, but changed lines are shown once with the removed
+    words as [-...-] and the added ones as {+...+}; long wikitext
+    paragraphs with a single changed word stay readable.
+    """
+    out = []
+    for group in hunks(opcodes(a, b), context):
+        if not out:
+            out.append('--- %s\n+++ %s\n' % (oldname, newname))
+        out.append(_header(group))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                out.extend(a[i1:i2])
+                continue
+            old = _word_re.findall(''.join(a[i1:i2]).decode('utf-8'))
+            new = _word_re.findall(''.join(b[j1:j2]).decode('utf-8'))
+            text = []
+            for wtag, k1, k2, l1, l2 in opcodes(old, new):
+                if wtag == 'equal':
+                    text.extend(old[k1:k2])
+                    continue
+                if k1 < k2:
+                    text.append(u'[-%s-]' % u''.join(old[k1:k2]))
+                if l1 < l2:
+                    text.append(u'{+%s+}' % u''.join(new[l1:l2]))
+            out.append(u''.join(text).encode('utf-8'))
+    return ''.join(out)
+
+
+def diffstat(a, b):
+    """Return (lines added, lines removed) without building any hunks."""
+    added = removed = 0
+    for tag, i1, i2, j1, j2 in opcodes(a, b):
+        if tag != 'equal':
+            removed += i2 - i1
+            added += j2 - j1
+    return added, removed
+
+
+def render(job):
+    """
+    Diff one file for `mw diff`; `job` is (mode, oldname, old text,
+    newname, new text) with UTF-8 texts. Runs in pool workers, so it
+    only deals in picklable values.
+    """
+    mode, oldname, old, newname, new = job
+    a = split_lines(old)
+    b = split_lines(new)
+    if mode == 'stat':
+        return diffstat(a, b)
+    if mode == 'word':
+        return word_diff(oldname, a, newname, b)
+    return unified_diff(oldname, a, newname, b)
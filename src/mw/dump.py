@@ -0,0 +1,97 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+
+def open_dump(filename):
+    """Open an XML dump, decompressing .bz2 and .gz on the fly."""
+    if filename.endswith('.bz2'):
+        import bz2
+        return bz2.BZ2File(filename)
+    if filename.endswith('.gz'):
+        import gzip
+        return gzip.open(filename)
+    return file(filename, 'rb')
+
+
+def _tag(element):
+    # dumps put everything in the export-0.x namespace
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _text(element):
+    # cElementTree hands back plain ASCII as str
+    if element.text is None:
+        return u''
+    return unicode(element.text)
+
+
+def read_dump(fd):
+    """
+    Yield (page, revision) for every revision in a Special:Export or
+    dumpBackup.php file, in the order they appear.
+
+    `page` has 'title', 'ns' and 'pageid'; `revision` looks like a
+    revision from the API (revid, timestamp, user, comment, and the text
+    as '*'). Only the element being read is kept in memory, so the size
+    of the dump doesn't matter.
+    """
+    events = ElementTree.iterparse(fd, events=('start', 'end'))
+    root = None
+    page = None
+    rv = None
+    for event, element in events:
+        tag = _tag(element)
+        if event == 'start':
+            if root is None:
+                root = element
+            elif tag == 'page':
+                page = {'ns': 0}
+            elif tag == 'revision':
+                rv = {}
+            continue
+        if rv is not None:
+            if tag == 'revision':
+                yield page, rv
+                rv = None
+                element.clear()
+            elif tag == 'id' and 'revid' not in rv:
+                rv['revid'] = int(element.text)
+            elif tag == 'timestamp':
+                rv['timestamp'] = _text(element)
+            elif tag in ['username', 'ip']:
+                rv['user'] = _text(element)
+            elif tag == 'comment':
+                rv['comment'] = _text(element)
+            elif tag == 'text' and 'deleted' not in element.attrib:
+                rv['*'] = _text(element)
+            continue
+        if page is not None:
+            if tag == 'page':
+                page = None
+                root.clear()  # drop the finished page from the tree
+            elif tag == 'title':
+                page['title'] = _text(element)
+            elif tag == 'ns':
+                page['ns'] = int(element.text)
+            elif tag == 'id':
+                page['pageid'] = int(element.text)
@@ -0,0 +1,164 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import itertools
+import mw.metrics
+import Queue
+import sys
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Allow `rate` calls per second on average, `burst` at once."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            mw.metrics.sleep(wait, 'sleep.throttle')
+
+    def slow_down(self):
+        # halve the rate for good; an unlimited bucket drops to 1/s
+        with self.lock:
+            if self.rate > 0:
+                self.rate /= 2
+            else:
+                self.rate = 1.0
+
+
+class BatchFetcher(object):
+    """Keep several API requests in flight on a pool of worker threads.
+
+    Every worker gets its own client from `api_factory`. Responses are
+    handed back to the calling thread in the order the requests came in,
+    so anything that writes to .mw stays single-threaded.
+    """
+
+    def __init__(self, api_factory, jobs=1, rate=0, burst=1, maxlag=None,
+                 retries=5, retry_after=5):
+        self.api_factory = api_factory
+        self.jobs = max(1, jobs)
+        self.bucket = TokenBucket(rate, burst)
+        self.maxlag = maxlag
+        self.retries = retries
+        self.retry_after = retry_after
+
+    def call(self, api, data):
+        if self.maxlag is not None:
+            data = dict(data)
+            data['maxlag'] = self.maxlag
+        backoff = self.retry_after
+        for attempt in range(self.retries + 1):
+            self.bucket.take()
+            response = api.call(data)
+            code = None
+            if 'error' in response:
+                code = response['error'].get('code')
+            if code not in ['maxlag', 'ratelimited'] or \
+               attempt == self.retries:
+                return response
+            mw.metrics.count('api.retries')
+            mw.metrics.trace('retrying after %s' % code)
+            if code == 'ratelimited':
+                # we're going faster than the wiki allows this account,
+                # back off now and stay slower from here on
+                self.bucket.slow_down()
+                wait = backoff
+                backoff *= 2
+            else:
+                # the servers are lagged and asked us to come back later
+                wait = response['error'].get('retryafter') or \
+                        self.retry_after
+            mw.metrics.sleep(wait, 'sleep.' + code)
+
+    def run(self, requests):
+        requests = iter(requests)
+        if self.jobs == 1:
+            api = self.api_factory()
+            for data in requests:
+                yield data, self.call(api, data)
+            return
+        todo = Queue.Queue()
+        done = Queue.Queue()
+        workers = []
+        for i in range(self.jobs):
+            worker = threading.Thread(target=self._worker, args=(todo, done))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        submitted = 0
+        received = 0
+        results = {}
+        try:
+            # two requests per worker keeps them all busy without reading
+            # the whole (possibly streamed) request list up front
+            for data in itertools.islice(requests, self.jobs * 2):
+                todo.put((submitted, data))
+                submitted += 1
+            while received < submitted:
+                try:
+                    n, data, response, exc_info = done.get(True, 1)
+                except Queue.Empty:
+                    continue  # wake up regularly so ^C gets through
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                results[n] = (data, response)
+                for data in itertools.islice(requests, 1):
+                    todo.put((submitted, data))
+                    submitted += 1
+                while received in results:
+                    yield results.pop(received)
+                    received += 1
+        finally:
+            for worker in workers:
+                todo.put(None)
+            # let them go before the interpreter starts tearing down
+            # the modules they use
+            for worker in workers:
+                worker.join()
+
+    def _worker(self, todo, done):
+        api = None
+        while True:
+            item = todo.get()
+            if item is None:
+                return
+            n, data = item
+            try:
+                if api is None:
+                    api = self.api_factory()
+                done.put((n, data, self.call(api, data), None))
+            except Exception:
+                done.put((n, data, None, sys.exc_info()))
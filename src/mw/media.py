@@ -0,0 +1,104 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+# Media files are the uploads behind File: pages. They are kept next to
+# their description pages (File:Foo.png beside File:Foo.png.wiki) and are
+# never read into memory whole: downloads are streamed to disk and
+# uploads go to the wiki's upload stash a chunk at a time.
+
+import hashlib
+import os
+
+NAMESPACE = 6
+# the most of a file in memory at once when uploading
+UPLOAD_CHUNK = 1024 * 1024
+
+
+def file_sha1(path):
+    """(SHA-1, size) of the file at `path`, read a chunk at a time."""
+    sha1 = hashlib.sha1()
+    size = 0
+    fd = file(path, 'rb')
+    try:
+        while True:
+            chunk = fd.read(UPLOAD_CHUNK)
+            if not chunk:
+                break
+            sha1.update(chunk)
+            size += len(chunk)
+    finally:
+        fd.close()
+    return sha1.hexdigest(), size
+
+
+class Downloader(object):
+    """Enough of a transport for BatchFetcher to run downloads with.
+
+    call() takes {'url': ..., 'path': ...} and answers like
+    Transport.download().
+    """
+
+    def __init__(self, api):
+        self.api = api
+
+    def call(self, data):
+        return self.api.download(data['url'], data['path'])
+
+
+def upload(api, path, filename, comment, token, chunk_size=UPLOAD_CHUNK):
+    """
+    Upload the file at `path` as a new version of File:`filename`: the
+    chunks go to the upload stash first, then the stashed file is
+    published with `comment`. Returns the last response.
+    """
+    size = os.path.getsize(path)
+    data = {
+            'action': 'upload',
+            'filename': filename,
+            'filesize': size,
+            'stash': 1,
+            'ignorewarnings': 1,
+            'token': token,
+    }
+    offset = 0
+    fd = file(path, 'rb')
+    try:
+        while True:
+            chunk = fd.read(chunk_size)
+            data['offset'] = offset
+            response = api.call(data, {'chunk': (filename, chunk)})
+            if 'error' in response:
+                return response
+            result = response['upload']
+            data['filekey'] = result.get('filekey',
+                                         result.get('sessionkey'))
+            offset += len(chunk)
+            if result['result'] != 'Continue' or offset >= size:
+                break
+    finally:
+        fd.close()
+    if result['result'] not in ['Continue', 'Success']:
+        return response
+    return api.call({
+            'action': 'upload',
+            'filename': filename,
+            'filekey': data['filekey'],
+            'comment': comment,
+            'ignorewarnings': 1,
+            'token': token,
+    })
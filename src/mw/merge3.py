@@ -0,0 +1,81 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from mw.diff import matching_lines, split_lines
+
+
+def merge_regions(base, a, b):
+    """
+    Split the three-way merge of the line lists `a` and `b` against
+    `base` into regions: ('same', lines) that neither side changed,
+    ('a', lines) or ('b', lines) changed on one side only (or the same
+    way on both), and ('conflict', a lines, b lines).
+
+    Like diff3, the base lines kept on both sides split the texts into
+    chunks, and a chunk only conflicts if both sides changed it.
+    """
+    in_a = dict(matching_lines(base, a))
+    in_b = dict(matching_lines(base, b))
+    regions = []
+    i = j = k = 0
+    for n in xrange(len(base) + 1):
+        if n < len(base):
+            if n not in in_a or n not in in_b:
+                continue
+            aj, bk = in_a[n], in_b[n]
+        else:
+            aj, bk = len(a), len(b)
+        if i < n or j < aj or k < bk:
+            regions.append(_resolve(base[i:n], a[j:aj], b[k:bk]))
+        if n < len(base):
+            if regions and regions[-1][0] == 'same':
+                regions[-1][1].append(base[n])
+            else:
+                regions.append(('same', [base[n]]))
+        i, j, k = n + 1, aj + 1, bk + 1
+    return regions
+
+
+def _resolve(base, a, b):
+    if a == base:
+        return ('b', b)
+    if b == base or a == b:
+        return ('a', a)
+    return ('conflict', a, b)
+
+
+def merge(base, a, b, a_label='local', b_label='remote'):
+    """
+    Merge the texts `a` and `b`, both changed from `base`. Returns the
+    merged text and the number of conflicts, which are marked the way
+    diff3 -m (and git) mark them.
+    """
+    out = []
+    conflicts = 0
+    for region in merge_regions(split_lines(base), split_lines(a),
+                                split_lines(b)):
+        if region[0] != 'conflict':
+            out.extend(region[1])
+            continue
+        conflicts += 1
+        out.append(u'<<<<<<< %s\n' % a_label)
+        out.extend(region[1])
+        out.append(u'=======\n')
+        out.extend(region[2])
+        out.append(u'>>>>>>> %s\n' % b_label)
+    return u''.join(out)[:-1], conflicts
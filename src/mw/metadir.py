@@ -16,14 +16,24 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 ###
 
-import bzrlib.diff
+import atexit
 import codecs
 import ConfigParser
+import errno
+import fnmatch
+import itertools
 import json
+import mw.metrics
 import os
-from StringIO import StringIO
+import stat
 import sys
 import hashlib
+import time
+
+# names for the files staged in .mw/tmp/, unique within the process
+_staged_names = itertools.count()
+# status reads files in a pool of processes once this many need reading
+PARALLEL_MIN = 200
 
 
 class Metadir(object):
@@ -32,7 +42,7 @@ class Metadir(object):
         self.me = os.path.basename(sys.argv[0])
         root = os.getcwd()
         while True:
-            if '.mw' in os.listdir(root):
+            if os.path.isdir(os.path.join(root, '.mw')):
                 self.root = root
                 break
             head = os.path.split(root)[0]
@@ -46,16 +56,33 @@ class Metadir(object):
            os.path.isfile(self.config_loc):
             self.config = ConfigParser.RawConfigParser()
             self.config.read(self.config_loc)
+            self.store = None
+            self.search = None
+            self.use_sqlite = \
+                    self.config_get('cache', 'backend') == 'sqlite'
             self.use_md5 = False
-            if self.config.has_option('index', 'use_md5'):
+            if not self.use_sqlite and \
+               self.config.has_option('index', 'use_md5'):
                 self.use_md5 = ( self.config.get('index', 'use_md5') == 'on' )
                 md5path = os.path.join(self.location, 'cache', 'md5index')
                 if self.use_md5 and not  os.path.exists(md5path):
                     os.mkdir(md5path, 0755)
             self.pagedict_loaded = False
+            self.pagedict_dirty = False
+            self.index_loaded = False
+            self.staged = {}
+            self.tmp_ready = False
+            self.use_daemon = True
+            self.sparse = None
+            self.recover()
         else:
             self.config = None
 
+    def config_get(self, section, option, default=None):
+        if self.config.has_option(section, option):
+            return self.config.get(section, option)
+        return default
+
     def save_config(self):
         with open(self.config_loc, 'wb') as config_file:
             self.config.write(config_file)
@@ -77,36 +104,289 @@ class Metadir(object):
         self.config.set('remote', 'api_url', api_url)
         self.config.add_section('merge')
         self.config.set('merge', 'tool', 'kidff3 %s %s -o %s')
-        self.config.add_section('index')
-        self.config.set('index', 'use_md5','on')
+        self.config.add_section('cache')
+        self.config.set('cache', 'backend', 'sqlite')
+        self.config.set('remote', 'maxlag', '5')
+        self.config.add_section('pull')
+        self.config.set('pull', 'jobs', '4')
+        self.config.set('pull', 'rate', '10')
+        self.config.add_section('commit')
+        self.config.set('commit', 'jobs', '1')
+        self.config.set('commit', 'edits_per_minute', '6')
         self.save_config()
-        # create cache/
+        # create cache/, the page index and revisions live in
+        # cache/store.db which is created on first use
         os.mkdir(os.path.join(self.location, 'cache'))
-        # create cache/pagedict
-        fd = file(os.path.join(self.location, 'cache', 'pagedict'), 'w')
-        fd.write(json.dumps({}))
+        self.use_sqlite = True
+        self.store = None
+        self.search = None
+        self.index_loaded = False
+        self.pagedict_dirty = False
+        self.staged = {}
+        self.tmp_ready = False
+        self.use_daemon = True
+        self.sparse = None
+
+    def _store(self):
+        if self.store is None:
+            import mw.store
+            self.store = mw.store.open_store(
+                    os.path.join(self.location, 'cache', 'store.db'))
+        return self.store
+
+    # Writes are grouped in batches that end with cache_commit(). The
+    # working files (and, with the old JSON cache, the cache files) a
+    # batch writes are staged in .mw/tmp/ and only moved into place once
+    # the batch's cache rows are committed. .mw/journal lists the moves
+    # while they happen, so a batch interrupted at any point is either
+    # finished or undone by recover() the next time mw runs.
+
+    def cache_commit(self):
+        if self.staged or self.pagedict_dirty:
+            self._commit_batch()
+        if self.store is not None:
+            self.store.commit()
+        if self.search is not None:
+            self.search.commit()
+
+    def write_working_file(self, filename, data, clean=True):
+        # `data` becomes the contents of `filename` (relative to the root)
+        # when the batch is committed; unless it is `clean`, i.e. the same
+        # as the cached revision, the next scan works out its status
+        if clean:
+            self._stage(os.path.join(self.root, filename), data, filename)
+        else:
+            self._stage(os.path.join(self.root, filename), data)
+            self.index_forget(filename)
+        mw.metrics.count('files.written')
+
+    def _stage(self, target, data, filename=None):
+        if target not in self.staged:
+            tmp = os.path.join(self._tmp_dir(), '%d-%d' % (
+                    os.getpid(), _staged_names.next()))
+            self.staged[target] = (tmp, filename)
+        # written now, synced with the rest of the batch at commit time
+        fd = file(self.staged[target][0], 'wb')
+        fd.write(data)
+        fd.close()
+
+    def _cache_path(self, path):
+        # where the current batch's version of a cache file is
+        if path in self.staged:
+            return self.staged[path][0]
+        return path
+
+    def _tmp_dir(self):
+        tmp = os.path.join(self.location, 'tmp')
+        if not os.path.isdir(tmp):
+            os.mkdir(tmp, 0755)
+        if not self.tmp_ready:
+            # runs before the store's own exit handler, registered earlier
+            atexit.register(self._abort_batch)
+            self._clean_tmp()
+            self.tmp_ready = True
+        return tmp
+
+    def _clean_tmp(self):
+        # files left behind by mw processes that died mid-batch
+        tmp = os.path.join(self.location, 'tmp')
+        if not os.path.isdir(tmp):
+            return
+        for name in os.listdir(tmp):
+            pid = int(name.split('-')[0])
+            if pid != os.getpid() and not _process_alive(pid):
+                os.remove(os.path.join(tmp, name))
+
+    def _commit_batch(self):
+        if self.pagedict_dirty:
+            self._stage(os.path.join(self.location, 'cache', 'pagedict'),
+                        json.dumps(self.pagedict))
+            self.pagedict_dirty = False
+        with mw.metrics.timer('cache.sync'):
+            for tmp, filename in self.staged.values():
+                _fsync(tmp)
+        journal = {
+                'batch': os.urandom(8).encode('hex'),
+                'store': self.use_sqlite,
+                'moves': [[tmp, target, filename] for target, (tmp, filename)
+                          in sorted(self.staged.items())],
+        }
+        _write_atomic(os.path.join(self.location, 'journal'),
+                      json.dumps(journal))
+        if self.use_sqlite:
+            # the batch happens when its id is committed with its cache
+            # rows; the old JSON cache is all in the moves, so there it
+            # happens when the journal is written
+            store = self._store()
+            store.journal_mark(journal['batch'])
+            store.commit(sync=True)
+        if self.search is not None:
+            self.search.commit()
+        self.staged = {}
+        self._finish_batch(journal)
+
+    def _finish_batch(self, journal):
+        dirs = set()
+        for tmp, target, filename in journal['moves']:
+            if os.path.exists(tmp):
+                os.rename(tmp, target)
+                dirs.add(os.path.dirname(target))
+        for directory in dirs:
+            _fsync(directory)  # makes the renames stick
+        for tmp, target, filename in journal['moves']:
+            if filename is not None and os.path.exists(target):
+                self.index_update(filename, 'C')
+        os.remove(os.path.join(self.location, 'journal'))
+
+    def _abort_batch(self):
+        # still staging at exit means we were interrupted: drop the batch
+        # instead of letting the store's exit handler commit half of it,
+        # unless it got past its commit point
+        if not self.staged:
+            return
+        staged = self.staged.values()
+        self.staged = {}
+        if self.store is not None:
+            self.store.rollback()
+        if self.search is not None:
+            self.search.rollback()
+        if not self.recover():
+            for tmp, filename in staged:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def recover(self):
+        """Finish or undo a batch an earlier mw was interrupted in."""
+        journal_loc = os.path.join(self.location, 'journal')
+        if not os.path.isfile(journal_loc):
+            return False
+        fd = file(journal_loc, 'r')
+        journal = json.loads(fd.read())
         fd.close()
+        if not journal['store'] or \
+           self._store().journal_batch() == journal['batch']:
+            self._finish_batch(journal)
+            self.index_save()
+            print '%s: finished writing %d files from an interrupted ' \
+                  'update' % (self.me, len(journal['moves']))
+        else:
+            for tmp, target, filename in journal['moves']:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            os.remove(journal_loc)
+            print '%s: rolled back an interrupted update' % self.me
+        self._clean_tmp()
+        return True
 
-        # structure replacement for pagedict
-        # will also be created if use_md5 is turned on with an existing project
-        os.mkdir(os.path.join(self.location, 'cache', 'md5index'), 0755)
+    def session_get(self):
+        # what an interrupted pull or commit was doing, for --resume
+        session_loc = os.path.join(self.location, 'session')
+        if not os.path.isfile(session_loc):
+            return None
+        fd = file(session_loc, 'r')
+        session = json.loads(fd.read())
+        fd.close()
+        return session
 
-        # create cache/pages/
-        os.mkdir(os.path.join(self.location, 'cache', 'pages'), 0755)
+    def session_set(self, session):
+        session_loc = os.path.join(self.location, 'session')
+        if session is None:
+            if os.path.exists(session_loc):
+                os.remove(session_loc)
+            return
+        _write_atomic(session_loc, json.dumps(session))
+
+    def search_index(self, create=False):
+        # the word index of .mw/cache/search.db, None until it is created
+        if self.search is None:
+            path = os.path.join(self.location, 'cache', 'search.db')
+            if create or os.path.exists(path):
+                import mw.search
+                self.search = mw.search.open_index(path)
+        return self.search
+
+    def search_rebuild(self):
+        # index the newest cached revision of every page from scratch
+        store = self._store()
+
+        def pages():
+            for title, pageid, currentrv in store.page_list().fetchall():
+                revid = store.rv_list(pageid)[-1:]
+                rv = revid and store.rv_get(pageid, revid[0])
+                if rv and 'content' in rv:
+                    yield pageid, revid[0], rv['content']
+        return self.search_index(create=True).rebuild(pages())
+
+    def migrate_cache(self):
+        # move a cache made of pagedict, md5index/ and pages/ into store.db
+        import shutil
+        if self.use_sqlite:
+            return False
+        cache = os.path.join(self.location, 'cache')
+        store = self._store()
+        pagedict = {}
+        if os.path.isfile(os.path.join(cache, 'pagedict')):
+            self.pagedict_load()
+            pagedict.update(self.pagedict)
+        md5index = os.path.join(cache, 'md5index')
+        if os.path.isdir(md5index):
+            for name in os.listdir(md5index):
+                fd = file(os.path.join(md5index, name), 'r')
+                pagedict.update(json.loads(fd.read()))
+                fd.close()
+        for pagename, page in pagedict.iteritems():
+            store.page_add(pagename, page['id'], page['currentrv'])
+        pages = os.path.join(cache, 'pages')
+        if os.path.isdir(pages):
+            for pageid in os.listdir(pages):
+                fd = file(os.path.join(pages, pageid), 'r')
+                pagedata = json.loads(fd.read())
+                fd.close()
+                for rvid, rv in pagedata.iteritems():
+                    store.rv_add(pageid, rvid, rv['user'], rv['timestamp'],
+                                 rv.get('content'))
+        store.commit()
+        if not self.config.has_section('cache'):
+            self.config.add_section('cache')
+        self.config.set('cache', 'backend', 'sqlite')
+        if self.config.has_option('index', 'use_md5'):
+            self.config.remove_option('index', 'use_md5')
+            if self.config.items('index') == []:
+                self.config.remove_section('index')
+        self.save_config()
+        self.use_sqlite = True
+        self.use_md5 = False
+        for name in ['md5index', 'pages']:
+            if os.path.isdir(os.path.join(cache, name)):
+                shutil.rmtree(os.path.join(cache, name))
+        if os.path.isfile(os.path.join(cache, 'pagedict')):
+            os.remove(os.path.join(cache, 'pagedict'))
+        return True
+
+    def rcmark_get(self):
+        # where the last full pull left off in the wiki's recent changes
+        mark_loc = os.path.join(self.location, 'rcmark')
+        if not os.path.isfile(mark_loc):
+            return None
+        fd = file(mark_loc, 'r')
+        mark = json.loads(fd.read())
+        fd.close()
+        return mark
+
+    def rcmark_set(self, mark):
+        _write_atomic(os.path.join(self.location, 'rcmark'), json.dumps(mark))
 
     def clean_page(self, pagename):
         filename = pagename_to_filename(pagename) + '.wiki'
         cur_content = codecs.open(filename, 'r', 'utf-8').read()
         if len(cur_content) != 0 and cur_content[-1] == '\n':
             cur_content = cur_content[:-1]
-        fd = file(filename, 'w')
-        fd.write(cur_content.encode('utf-8'))
-        fd.close()
+        _write_atomic(filename, cur_content.encode('utf-8'))
 
     def pagedict_load(self):
         if not self.pagedict_loaded:
             fd = file(os.path.join(self.location, 'cache', 'pagedict'), 'r+')
-            self.pagedict = json.loads(fd.read())
+            self.pagedict = _read_json(fd)
             fd.close
             self.pagedict_loaded = True
 
@@ -117,24 +397,29 @@ class Metadir(object):
         return os.path.join(self.location, 'cache', 'md5index', m.hexdigest())
 
     def pagedict_add(self, pagename, pageid, currentrv):
-        if not self.use_md5:
+        if self.use_sqlite:
+            if isinstance(pagename, str):
+                pagename = pagename.decode('utf-8')
+            self._store().page_add(pagename, pageid, currentrv)
+        elif not self.use_md5:
             self.pagedict_load()
             self.pagedict[pagename] = {'id': int(pageid), 'currentrv': int(currentrv)}
-            fd = file(os.path.join(self.location, 'cache', 'pagedict'), 'w')
-            fd.write(json.dumps(self.pagedict))
-            fd.truncate()
-            fd.close()
+            # written once per batch, by cache_commit()
+            self.pagedict_dirty = True
         else: # feeding the new index structure
              md5pagename = self.get_md5_from_pagename(pagename)
              page = {}
              page[pagename] =  {'id': int(pageid), 'currentrv': int(currentrv)}
-             fd = file(md5pagename , 'w')
-             fd.write(json.dumps(page))
-             fd.truncate()
-             fd.close()
+             self._stage(md5pagename, json.dumps(page))
+        # the cached revision changed, so the stat data we have is stale
+        self.index_forget(pagename_to_filename(pagename) + '.wiki')
 
     def get_pageid_from_pagename(self, pagename):
-        if not self.use_md5:
+        if self.use_sqlite:
+            if isinstance(pagename, str):
+                pagename = pagename.decode('utf-8')
+            return self._store().page_get(pagename)
+        elif not self.use_md5:
              self.pagedict_load()
              pagename = pagename.decode('utf-8')
              if pagename in self.pagedict.keys():
@@ -143,40 +428,103 @@ class Metadir(object):
                  return None
         else: # feeding the new index structure
              pagename = pagename.decode('utf-8')
-             md5pagename = self.get_md5_from_pagename(pagename)
+             md5pagename = self._cache_path(
+                     self.get_md5_from_pagename(pagename))
              if os.path.isfile(md5pagename):
                  fd = file(md5pagename, 'r+')
-                 page = json.loads(fd.read())
+                 page = _read_json(fd)
                  return page[pagename]
              else:
                  return None
 
+    def get_pagename_from_pageid(self, pageid):
+        return self._store().page_title(pageid)
+
+    def page_titles(self):
+        # every page in the cache
+        return [row[0] for row in self._store().page_list()]
+
+    # In a sparse checkout (one with a .mw/sparse file) pulled pages go
+    # into the cache, but only the ones matching a line of .mw/sparse, or
+    # whose files are already there, are written out. A line is a glob
+    # on the title (Template:*) or ns:N for all of namespace N.
+
+    def sparse_get(self):
+        # the patterns, or None if this isn't a sparse checkout
+        if self.sparse is None:
+            sparse_loc = os.path.join(self.location, 'sparse')
+            if not os.path.isfile(sparse_loc):
+                self.sparse = False
+                return None
+            fd = codecs.open(sparse_loc, 'r', 'utf-8')
+            self.sparse = [line.strip() for line in fd
+                           if line.strip() and not line.startswith('#')]
+            fd.close()
+        if self.sparse is False:
+            return None
+        return self.sparse
+
+    def sparse_add(self, patterns):
+        # makes this a sparse checkout if it wasn't one
+        current = self.sparse_get() or []
+        self.sparse = current + [pattern for pattern in patterns
+                                 if pattern not in current]
+        _write_atomic(os.path.join(self.location, 'sparse'),
+                      u''.join(pattern + u'\n' for pattern
+                               in self.sparse).encode('utf-8'))
+
+    def sparse_wanted(self, pagename, ns=None):
+        # whether a pulled page is written to the working directory
+        patterns = self.sparse_get()
+        if patterns is None:
+            return True
+        if isinstance(pagename, str):
+            pagename = pagename.decode('utf-8')
+        filename = pagename_to_filename(pagename) + u'.wiki'
+        if os.path.exists(os.path.join(self.root, filename.encode('utf-8'))):
+            return True
+        for pattern in patterns:
+            if pattern.startswith(u'ns:'):
+                if ns is not None and pattern[3:].strip() == str(ns):
+                    return True
+            elif fnmatch.fnmatchcase(pagename, pattern.replace(u'_', u' ')):
+                return True
+        return False
+
     def pages_add_rv(self, pageid, rv):
+        if self.use_sqlite:
+            self._store().rv_add(pageid, rv['revid'], rv.get('user'),
+                                 rv['timestamp'], rv.get('*'))
+            index = self.search_index()
+            if index is not None and '*' in rv:
+                index.update(pageid, rv['revid'], rv['*'])
+            return
         pagefile = os.path.join(self.location, 'cache', 'pages', str(pageid))
-        fd = file(pagefile, 'w+')
-        pagedata_raw = fd.read()
-        if pagedata_raw == '':
-            pagedata = {}
-        else:
-            pagedata = json.loads(pagedata_raw)
-        rvid = int(rv['revid'])
+        pagedata = {}
+        if os.path.exists(self._cache_path(pagefile)):
+            fd = file(self._cache_path(pagefile), 'r')
+            pagedata = _read_json(fd)
+            fd.close()
+        rvid = str(int(rv['revid']))
         pagedata[rvid] = {
                 'user': rv['user'],
                 'timestamp': rv['timestamp'],
         }
         if '*' in rv.keys():
             pagedata[rvid]['content'] = rv['*']
-        fd.seek(0)
-        fd.write(json.dumps(pagedata))
-        fd.truncate()
-        fd.close()
+        self._stage(pagefile, json.dumps(pagedata))
 
     def pages_get_rv_list(self, pageid):
-        pagefile = os.path.join(self.location, 'cache', 'pages',
-                                str(pageid['id']))
+        if self.use_sqlite:
+            rvs = self._store().rv_list(pageid['id'])
+            if rvs == []:
+                return [None,]
+            return rvs
+        pagefile = self._cache_path(os.path.join(
+                self.location, 'cache', 'pages', str(pageid['id'])))
         if os.path.exists(pagefile):
             fd = file(pagefile, 'r')
-            pagedata = json.loads(fd.read())
+            pagedata = _read_json(fd)
             rvs = [int(x) for x in pagedata.keys()]
             rvs.sort()
             return rvs
@@ -184,79 +532,429 @@ class Metadir(object):
             return [None,]
 
     def pages_get_rv(self, pageid, rvid):
-        pagefile = os.path.join(self.location, 'cache', 'pages',
-                                str(pageid['id']))
+        if self.use_sqlite:
+            return self._store().rv_get(pageid['id'], rvid)
+        pagefile = self._cache_path(os.path.join(
+                self.location, 'cache', 'pages', str(pageid['id'])))
         if os.path.exists(pagefile):
             fd = file(pagefile, 'r')
-            pagedata = json.loads(fd.read())
+            pagedata = _read_json(fd)
             return pagedata[str(rvid)]
         else:
             return None
             
-    def working_dir_status(self, files=None):
-        status = {}
+    def index_load(self):
+        if not self.index_loaded:
+            self.index = self._index_read() or \
+                    {'version': 1, 'written': 0, 'entries': {}}
+            self.index_loaded = True
+            self.index_dirty = False
+            # what we changed since, for index_save to merge
+            self.index_changes = {}
+            self.index_media_changes = {}
+            self.index_reset = False
+
+    def _index_read(self):
+        # the index as it is on disk, or None if there isn't a good one
+        index_loc = os.path.join(self.location, 'index')
+        try:
+            fd = file(index_loc, 'r')
+        except IOError:
+            self.index_stat = None
+            return None
+        try:
+            self.index_stat = _stat_key(os.fstat(fd.fileno()))
+            with mw.metrics.timer('index.load'):
+                return json.loads(fd.read())
+        except ValueError:
+            return None  # a broken index is rebuilt on the next scan
+        finally:
+            fd.close()
+
+    def index_save(self):
+        if not self.index_loaded or not self.index_dirty:
+            return
+        index_loc = os.path.join(self.location, 'index')
+        with mw.metrics.timer('index.save'):
+            # other mw processes (and the daemon, which keeps its index
+            # for as long as it runs) may have saved theirs since we read
+            # ours; their entries are kept, ours win where both changed
+            try:
+                current = _stat_key(os.stat(index_loc))
+            except OSError:
+                current = None
+            if current is not None and current != self.index_stat and \
+               not self.index_reset:
+                disk = self._index_read()
+                if disk is not None:
+                    self._index_merge(disk)
+            self.index['written'] = _time_ns()
+            # no fsync: a lost or broken index is only rebuilt
+            _write_atomic(index_loc, json.dumps(self.index), sync=False)
+            self.index_stat = _stat_key(os.stat(index_loc))
+        self.index_dirty = False
+        self.index_changes = {}
+        self.index_media_changes = {}
+        self.index_reset = False
+
+    def _index_merge(self, disk):
+        # entries the other writer couldn't trust yet (see
+        # _indexed_status) would look trustworthy under our later
+        # timestamp, so those are left out and read again when needed
+        cutoff = disk.get('written', 0) - 1000000000
+        entries = dict((key, entry) for key, entry
+                       in disk.get('entries', {}).iteritems()
+                       if entry[1] < cutoff)
+        for key, entry in self.index_changes.iteritems():
+            if entry is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = entry
+        media = disk.get('media', {})
+        media.update(self.index_media_changes)
+        self.index['entries'] = entries
+        self.index['media'] = media
+
+    def index_forget(self, filename):
+        self.index_load()
+        if _index_key(filename) in self.index['entries']:
+            del self.index['entries'][_index_key(filename)]
+            self.index_changes[_index_key(filename)] = None
+            self.index_dirty = True
+
+    def index_update(self, filename, status):
+        # record a file we have just written or checked ourselves
+        full = os.path.join(self.root, filename)
+        content = codecs.open(full, 'r', 'utf-8').read()
+        if (len(content) != 0) and (content[-1] == '\n'):
+            content = content[:-1]
+        self._index_store(filename, os.stat(full), content, status)
+
+    def _index_store(self, filename, st, content, status):
+        content = content.encode('utf-8')
+        mw.metrics.count('files.hashed')
+        mw.metrics.count('files.bytes_hashed', len(content))
+        self._index_put(filename, st, hashlib.sha1(content).hexdigest(),
+                        status)
+
+    def _index_put(self, filename, st, sha1, status):
+        self.index_load()
+        entry = _stat_key(st) + [sha1, status]
+        self.index['entries'][_index_key(filename)] = entry
+        self.index_changes[_index_key(filename)] = entry
+        self.index_dirty = True
+
+    def _indexed_status(self, filename, st):
+        # the status in the index, or None if the file has to be read
+        entry = self.index['entries'].get(_index_key(filename))
+        # files modified within a second of the last index write may have
+        # changed again without their mtime moving, so don't trust those
+        if entry is not None and entry[:3] == _stat_key(st) and \
+           entry[1] < self.index['written'] - 1000000000:
+            return entry[4]
+        return None
+
+    def _file_status(self, full, filename, st, hashed=None):
+        # `hashed` is what _hash_file() made of the file, if it has
+        # already been read
+        status = self._indexed_status(filename, st)
+        if status is not None:
+            mw.metrics.count('index.hits')
+            return status
+        mw.metrics.count('index.misses')
+        if filename[-5:] != '.wiki':
+            return self._media_status(full, filename, st)
+        name = os.path.split(full)[1]
+        pagename = filename_to_pagename(name[:-5])
+        pageid = self.get_pageid_from_pagename(pagename)
+        if not pageid:
+            self._index_put(filename, st, None, '?')
+            return '?'
+        rvid = self.pages_get_rv_list(pageid)[-1]
+        if hashed is None:
+            cur_content = codecs.open(full, 'r', 'utf-8').read()
+            if (len(cur_content) != 0) and (cur_content[-1] == '\n'):
+                cur_content = cur_content[:-1]
+            self._index_store(filename, st, cur_content, None)
+        else:
+            mw.metrics.count('files.hashed')
+            mw.metrics.count('files.bytes_hashed', hashed[1])
+            self._index_put(filename, st, hashed[0], None)
+        entry = self.index['entries'][_index_key(filename)]
+        if entry[3] != self.pages_get_rv_sha1(pageid, rvid):
+            entry[4] = 'M'  # modified
+        else:
+            entry[4] = 'C'  # clean
+        return entry[4]
+
+    def _media_status(self, full, filename, st):
+        import mw.media
+        sha1, size = mw.media.file_sha1(full)
+        mw.metrics.count('files.hashed')
+        mw.metrics.count('files.bytes_hashed', size)
+        media = self.media_get(filename)
+        if media is None:
+            status = '?'
+        elif media['sha1'] == sha1:
+            status = 'C'
+        else:
+            status = 'M'
+        self._index_put(filename, st, sha1, status)
+        return status
+
+    # Media files (see mw.media) are tracked in the index too: beside the
+    # usual stat entry, index['media'] has the SHA-1 the wiki has for the
+    # file, which status compares the file against.
+
+    def media_get(self, filename):
+        self.index_load()
+        return self.index.get('media', {}).get(_index_key(filename))
+
+    def media_set(self, filename, sha1, timestamp):
+        # record a media file we have just downloaded or uploaded
+        self.index_load()
+        self.index.setdefault('media', {})[_index_key(filename)] = \
+                self.index_media_changes[_index_key(filename)] = {
+                        'sha1': sha1,
+                        'timestamp': timestamp,
+                }
+        self._index_put(filename, os.stat(os.path.join(self.root, filename)),
+                        sha1, 'C')
+
+    def media_sha1(self, filename):
+        # SHA-1 of the file as it is now, or None if there isn't one
+        full = os.path.join(self.root, filename)
+        if not os.path.isfile(full):
+            return None
+        self.index_load()
+        st = os.stat(full)
+        if self._indexed_status(filename, st) is None:
+            self._media_status(full, filename, st)
+        return self.index['entries'][_index_key(filename)][3]
+
+    def media_tmp(self):
+        # a name in .mw/tmp/ for a download to go to
+        return os.path.join(self._tmp_dir(), '%d-%d' % (
+                os.getpid(), _staged_names.next()))
+
+    def stage_file(self, filename, tmp):
+        # like write_working_file(), for a file already written to `tmp`
+        target = os.path.join(self.root, filename)
+        if target in self.staged:
+            os.remove(self.staged[target][0])
+        self.staged[target] = (tmp, None)
+        mw.metrics.count('files.written')
+
+    def pages_get_rv_sha1(self, pageid, rvid):
+        # SHA-1 of a cached revision's text, as the API's rvprop=sha1
+        if self.use_sqlite:
+            return self._store().rv_sha1(pageid['id'], rvid)
+        rv = self.pages_get_rv(pageid, rvid)
+        if rv is None or 'content' not in rv:
+            return None
+        return hashlib.sha1(rv['content'].encode('utf-8')).hexdigest()
+
+    def history_get(self, pageid):
+        # (request to resume `pull --history` with, newest revid seen)
+        return self._store().history_get(pageid['id'])
+
+    def history_set(self, pageid, cont, lastrevid=None):
+        self._store().history_set(pageid['id'], cont, lastrevid)
+
+    def _walk(self):
+        # like os.walk, but stats every entry only once and hands that on
+        # as (full path, path relative to the root, stat)
+        dirs = ['']
+        while dirs:
+            reldir = dirs.pop()
+            fulldir = os.path.join(self.root, reldir)
+            for name in os.listdir(fulldir):
+                if reldir == '' and name == '.mw':
+                    continue
+                full = os.path.join(fulldir, name)
+                try:
+                    st = os.stat(full)
+                except OSError:
+                    continue  # dangling symlink
+                if stat.S_ISDIR(st.st_mode):
+                    if not os.path.islink(full):
+                        dirs.append(os.path.join(reldir, name))
+                else:
+                    yield full, os.path.join(reldir, name), st
+
+    def working_dir_status(self, files=None, refresh=False, clean=True,
+                           jobs=None):
+        # with clean=False, clean files may be left out
+        return dict(self.iter_status(files, refresh, clean, jobs))
+
+    def iter_status(self, files=None, refresh=False, clean=True, jobs=None):
+        """
+        Yield (filename, status) for the files in the working directory,
+        or just `files`, sorted by filename and as soon as each is known.
+        Files the index can't vouch for are read by `jobs` processes
+        (default: one per CPU) when there are many of them.
+        """
+        with mw.metrics.timer('status'):
+            if not files and not refresh and self.use_daemon and \
+               os.path.exists(os.path.join(self.location, 'daemon.sock')):
+                # `mw daemon` is watching, ask it instead of scanning
+                status = self._daemon_status(clean)
+                if status is not None:
+                    mw.metrics.count('status.daemon')
+                    for item in sorted(status.iteritems()):
+                        yield item
+                    return
+            for item in self._iter_status(files, refresh, jobs):
+                yield item
+
+    def _daemon_status(self, clean):
+        import mw.daemon
+        return mw.daemon.status(self, clean)
+
+    def _iter_status(self, files, refresh, jobs):
         check = []
         if files == None or files == []:
-            for root, dirs, files in os.walk(self.root):
-                if root == self.root:
-                    dirs.remove('.mw')
-                for name in files:
-                    check.append(os.path.join(root, name))
+            check = list(self._walk())
         else:
             for file in files:
-                check.append(os.path.join(os.getcwd(), file))
+                full = os.path.abspath(os.path.join(os.getcwd(), file))
+                check.append((full, os.path.relpath(full, self.root),
+                              os.stat(full)))
+        self.index_load()
+        media = self.index.get('media', {})
+        check = [(filename, full, st) for full, filename, st in check
+                 if filename[-5:] == '.wiki' or _index_key(filename) in media]
         check.sort()
-        for full in check:
-            name = os.path.split(full)[1]
-            if name[-5:] == '.wiki':
-                pagename = filename_to_pagename(name[:-5])
-                pageid = self.get_pageid_from_pagename(pagename)
-                if not pageid:
-                    status[os.path.relpath(full, self.root)] = '?'
+        if refresh:
+            self.index['entries'] = {}
+            self.index_reset = True
+            self.index_dirty = True
+        # the files that have to be read are hashed ahead of us, in order,
+        # while the rest are answered from the index
+        unread = [full for filename, full, st in check
+                  if filename[-5:] == '.wiki' and
+                  self._indexed_status(filename, st) is None]
+        hashed = self._hash_files(unread, jobs)
+        unread = set(unread)
+        try:
+            for filename, full, st in check:
+                if full in unread:
+                    status = self._file_status(full, filename, st,
+                                               hashed.next())
                 else:
-                    rvid = self.pages_get_rv_list(pageid)[-1]
-                    rv = self.pages_get_rv(pageid, rvid)
-                    cur_content = codecs.open(full, 'r', 'utf-8').read()
-                    if (len(cur_content) != 0) and (cur_content[-1] == '\n'):
-                        cur_content = cur_content[:-1]
-                    if cur_content != rv['content']:
-                        status[os.path.relpath(full, self.root)] = 'M' # modified
-                    else:
-                        status[os.path.relpath(full, self.root)] = 'C' # clean
-        return status
+                    status = self._file_status(full, filename, st)
+                yield filename, status
+        finally:
+            hashed.close()
+        self.index_save()
+
+    def _hash_files(self, fulls, jobs):
+        # what _hash_file() makes of each of `fulls`, in order
+        if jobs is None and len(fulls) >= PARALLEL_MIN:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        if jobs is None or jobs < 2 or len(fulls) < PARALLEL_MIN:
+            for full in fulls:
+                yield _hash_file(full)
+            return
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for hashed in pool.imap(_hash_file, fulls,
+                                    chunksize=max(1, len(fulls) / jobs / 8)):
+                yield hashed
+        finally:
+            pool.terminate()
 
-    def diff_rv_to_working(self, pagename, oldrvid=0, newrvid=0):
+    def diff_inputs(self, pagename, oldrvid=0, newrvid=0):
         # oldrvid=0 means latest fetched revision
         # newrvid=0 means working copy
+        # returns (oldname, old text, newname, new text), texts in UTF-8
         filename = pagename_to_filename(pagename) + '.wiki'
         filename = filename.decode('utf-8')
         pageid = self.get_pageid_from_pagename(pagename)
         if not pageid:
             raise ValueError('page named %s has not been fetched' % pagename)
+        if oldrvid == 0:
+            oldrvid = self.pages_get_rv_list(pageid)[-1]
+        oldrv = self.pages_get_rv(pageid, oldrvid)
+        if oldrv is None or 'content' not in oldrv:
+            raise ValueError('revision %i of %s is not in the cache' %
+                             (oldrvid, pagename))
+        oldname = u'a/%s (revision %i)' % (filename, oldrvid)
+        old = oldrv['content'].encode('utf-8')
+        if newrvid == 0:
+            new = file(os.path.join(self.root, filename)).read()
+            if new[-1:] == '\n':
+                new = new[:-1]
+            newname = u'b/%s (working copy)' % filename
         else:
-            if oldrvid == 0:
-                oldrvid = self.pages_get_rv_list(pageid)[-1]
-            oldrv = self.pages_get_rv(pageid, oldrvid)
-            oldname = 'a/%s (revision %i)' % (filename, oldrvid)
-            old = [i + '\n' for i in \
-                   oldrv['content'].encode('utf-8').split('\n')]
-            if newrvid == 0:
-                cur_content = codecs.open(filename, 'r', 'utf-8').read()
-                cur_content = cur_content.encode('utf-8')
-                if (len(cur_content) != 0) and (cur_content[-1] == '\n'):
-                    cur_content = cur_content[:-1]
-                newname = 'b/%s (working copy)' % filename
-                new = [i + '\n' for i in cur_content.split('\n')]
-            else:
-                newrv = self.pages_get_rv(pageid, newrvid)
-                newname = 'b/%s (revision %i)' % (filename, newrvid)
-                new = [i + '\n' for i in newrv['content'].split('\n')]
-            diff_fd = StringIO()
-            bzrlib.diff.internal_diff(oldname, old, newname, new, diff_fd)
-            diff = diff_fd.getvalue()
-            if diff[-1] == '\n':
-                diff = diff[:-1]
-            return diff
+            newrv = self.pages_get_rv(pageid, newrvid)
+            if newrv is None or 'content' not in newrv:
+                raise ValueError('revision %i of %s is not in the cache' %
+                                 (newrvid, pagename))
+            newname = u'b/%s (revision %i)' % (filename, newrvid)
+            new = newrv['content'].encode('utf-8')
+        return (oldname.encode('utf-8'), old, newname.encode('utf-8'), new)
+
+    def diff_rv_to_working(self, pagename, oldrvid=0, newrvid=0,
+                           mode='unified'):
+        import mw.diff
+        diff = mw.diff.render((mode,) + self.diff_inputs(pagename, oldrvid,
+                                                         newrvid))
+        if diff[-1:] == '\n':
+            diff = diff[:-1]
+        return diff
+
+
+def _hash_file(full):
+    # (SHA-1 of the text as commit would send it, its length), or None if
+    # it isn't UTF-8; runs in the status pool's processes
+    try:
+        content = codecs.open(full, 'r', 'utf-8').read()
+    except (IOError, OSError, UnicodeDecodeError):
+        return None  # _file_status() reads it again, and reports why
+    if (len(content) != 0) and (content[-1] == '\n'):
+        content = content[:-1]
+    content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest(), len(content)
+
+
+def _write_atomic(path, data, sync=True):
+    # readers see the old contents or the new, never a mix, whenever we
+    # are stopped; with `sync` that holds across a crash of the machine
+    tmp = path + '.tmp'
+    fd = file(tmp, 'wb')
+    fd.write(data)
+    if sync:
+        fd.flush()
+        os.fsync(fd.fileno())
+    fd.close()
+    os.rename(tmp, path)
+    if sync:
+        _fsync(os.path.dirname(path) or '.')
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _read_json(fd):
+    # the old one-file-per-page cache, slow on big checkouts
+    with mw.metrics.timer('cache.json'):
+        return json.loads(fd.read())
 
 
 def pagename_to_filename(name):
@@ -269,3 +967,20 @@ def filename_to_pagename(name):
     name = name.replace('!', '/')
     name = name.replace('_', ' ')
     return name
+
+
+def _index_key(filename):
+    if isinstance(filename, str):
+        filename = filename.decode('utf-8')
+    return filename
+
+
+def _stat_key(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return [st.st_size, mtime_ns, st.st_ino]
+
+
+def _time_ns():
+    return int(time.time() * 1000000000)
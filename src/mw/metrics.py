@@ -0,0 +1,113 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+# Counters and timers for `mw --profile`. Everything here is a no-op
+# until enable() is called, so the calls can stay in hot paths.
+
+import json
+import os
+import sys
+import threading
+import time
+
+enabled = False
+tracing = os.environ.get('MW_TRACE', '') not in ['', '0']
+
+_lock = threading.Lock()
+_counters = {}
+_timers = {}
+_started = None
+
+
+def enable():
+    global enabled, _started
+    enabled = True
+    _started = time.time()
+
+
+def count(name, n=1):
+    if enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def add_time(name, seconds):
+    if enabled:
+        with _lock:
+            total, calls = _timers.get(name, (0.0, 0))
+            _timers[name] = (total + seconds, calls + 1)
+
+
+class timer(object):
+    """Time a block: `with mw.metrics.timer('status'): ...`"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if enabled:
+            add_time(self.name, time.time() - self.start)
+        return False
+
+
+def sleep(seconds, name='sleep'):
+    """time.sleep, counted towards `name`."""
+    add_time(name, seconds)
+    time.sleep(seconds)
+
+
+def trace(message):
+    # MW_TRACE=1 logs every request as it happens, profiling or not
+    if tracing:
+        sys.stderr.write('mw: %.3f %s\n' % (time.time(), message))
+
+
+def summary():
+    with _lock:
+        return {
+                'seconds': _started and time.time() - _started,
+                'counters': dict(_counters),
+                'timers': dict((name, {'seconds': total, 'calls': calls})
+                               for name, (total, calls) in _timers.items()),
+        }
+
+
+def write_json(filename):
+    with file(filename, 'w') as fd:
+        json.dump(summary(), fd, indent=1, sort_keys=True)
+        fd.write('\n')
+
+
+def report(fd=None):
+    fd = fd or sys.stderr
+    data = summary()
+    fd.write('%-32s %10s %8s\n' % ('timer', 'seconds', 'calls'))
+    for name in sorted(data['timers']):
+        timed = data['timers'][name]
+        fd.write('%-32s %10.3f %8d\n' % (name, timed['seconds'],
+                                         timed['calls']))
+    fd.write('%-32s %10.3f\n' % ('total', data['seconds'] or 0))
+    if data['counters']:
+        fd.write('\n%-32s %10s\n' % ('counter', 'value'))
+        for name in sorted(data['counters']):
+            fd.write('%-32s %10d\n' % (name, data['counters'][name]))
@@ -0,0 +1,265 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import difflib
+import fcntl
+import hashlib
+import json
+import mw.metrics
+import os
+import zlib
+
+# no object is more than this many deltas away from a full copy, which
+# bounds the cost of reading any revision; the latest ones are full
+MAX_DEPTH = 16
+PACK_SIZE = 64 * 1024 * 1024
+# the pack number of objects kept in the `loose` table instead
+LOOSE = 0
+CACHE_SIZE = 32
+
+
+def text_sha1(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def make_delta(base, text):
+    """Describe `text` as line ranges copied from `base` plus new text."""
+    base_lines = base.splitlines(True)
+    lines = text.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, base_lines, lines)
+    ops = []
+    j = 0
+    for (a, b, n) in matcher.get_matching_blocks():
+        if b > j:
+            ops.append(''.join(lines[j:b]))
+        if n:
+            ops.append([a, a + n])
+        j = b + n
+    return ops
+
+
+def apply_delta(base, ops):
+    base_lines = base.splitlines(True)
+    out = []
+    for op in ops:
+        if isinstance(op, list):
+            out.extend(base_lines[op[0]:op[1]])
+        else:
+            out.append(op)
+    return u''.join(out)
+
+
+class ObjectStore(object):
+    """Compressed revision texts, keyed by SHA-1, in .mw/cache/objects/.
+
+    Objects are appended to a few large pack files. Where they are, and
+    which object a delta applies to, is kept in the `objects` table of
+    the database `db`. The latest revisions, which put_full() stores and
+    rebase() later turns into deltas, wait in the `loose` table instead,
+    so the full copies they replace don't pile up in the packs.
+    """
+
+    def __init__(self, location, db):
+        self.location = location
+        self.db = db
+        self.pack = None
+        self.readers = {}
+        self.cache = {}
+        self.cache_order = []
+        if not os.path.isdir(location):
+            os.mkdir(location, 0755)
+
+    def has(self, sha1):
+        return self.db.execute('SELECT 1 FROM objects WHERE sha1 = ?',
+                               (sha1,)).fetchone() is not None
+
+    def put(self, text, base_sha1=None, loose=False):
+        sha1 = text_sha1(text)
+        if self.has(sha1):
+            return sha1
+        data = zlib.compress(text.encode('utf-8'))
+        base = None
+        depth = 0
+        if base_sha1 is not None and base_sha1 != sha1:
+            row = self.db.execute('SELECT depth FROM objects WHERE sha1 = ?',
+                                  (base_sha1,)).fetchone()
+            if row is not None and row[0] < MAX_DEPTH:
+                delta = zlib.compress(json.dumps(
+                        make_delta(self.get(base_sha1), text)))
+                if len(delta) < len(data):
+                    data = delta
+                    base = base_sha1
+                    depth = row[0] + 1
+        pack, offset = self._write(sha1, data, loose)
+        self.db.execute('INSERT INTO objects '
+                        '(sha1, pack, offset, length, base, depth) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (sha1, pack, offset, len(data), base, depth))
+        self._remember(sha1, text)
+        return sha1
+
+    def put_full(self, text):
+        """Store `text` as a full copy, even if it was a delta before."""
+        sha1 = text_sha1(text)
+        row = self.db.execute('SELECT depth FROM objects WHERE sha1 = ?',
+                              (sha1,)).fetchone()
+        if row is None:
+            return self.put(text, loose=True)
+        if row[0] > 0:
+            self._store(sha1, zlib.compress(text.encode('utf-8')), None,
+                        -row[0], loose=True)
+        return sha1
+
+    def rebase(self, sha1, base_sha1):
+        """
+        Store the object `sha1` again as a delta against the full object
+        `base_sha1` (the revision that replaced it), if that is smaller
+        and keeps everything based on it within MAX_DEPTH. Deltas so go
+        from newer revisions to older ones, as in git's packs.
+        """
+        if sha1 == base_sha1:
+            return
+        row = self.db.execute('SELECT length, base, depth FROM objects '
+                              'WHERE sha1 = ?', (sha1,)).fetchone()
+        if row is None or row[1] == base_sha1:
+            return
+        if self._levels_below(sha1) + 1 > MAX_DEPTH:
+            return  # it stays full and starts a chain of its own
+        delta = zlib.compress(json.dumps(
+                make_delta(self.get(base_sha1), self.get(sha1))))
+        if row[1] is None and len(delta) >= row[0]:
+            return
+        self._store(sha1, delta, base_sha1, 1 - row[2])
+
+    def _levels_below(self, sha1):
+        # how many deltas the longest chain ending at `sha1` has
+        return self.db.execute('''
+            WITH RECURSIVE below(sha1, level) AS (
+                SELECT ?, 0
+                UNION ALL
+                SELECT objects.sha1, below.level + 1
+                FROM objects JOIN below ON objects.base = below.sha1
+            )
+            SELECT MAX(level) FROM below''', (sha1,)).fetchone()[0]
+
+    def _store(self, sha1, data, base, shift, loose=False):
+        # a new copy of an existing object; an old one in a pack is left
+        # there. Everything based on it moves `shift` deltas further from
+        # a full copy along with it.
+        pack, offset = self._write(sha1, data, loose)
+        self.db.execute('''
+            WITH RECURSIVE below(sha1) AS (
+                SELECT ?
+                UNION ALL
+                SELECT objects.sha1
+                FROM objects JOIN below ON objects.base = below.sha1
+            )
+            UPDATE objects SET depth = depth + ?
+            WHERE sha1 IN (SELECT sha1 FROM below)''', (sha1, shift))
+        self.db.execute('UPDATE objects SET pack = ?, offset = ?, '
+                        'length = ?, base = ? WHERE sha1 = ?',
+                        (pack, offset, len(data), base, sha1))
+
+    def get(self, sha1):
+        wanted = sha1
+        if sha1 in self.cache:
+            mw.metrics.count('objects.cache_hits')
+            return self.cache[sha1]
+        mw.metrics.count('objects.cache_misses')
+        # walk down to the nearest full copy, then apply deltas back up
+        chain = []
+        text = None
+        while sha1 is not None:
+            if sha1 in self.cache:
+                text = self.cache[sha1]
+                break
+            row = self.db.execute('SELECT pack, offset, length, base '
+                                  'FROM objects WHERE sha1 = ?',
+                                  (sha1,)).fetchone()
+            if row is None:
+                raise KeyError(sha1)
+            chain.append((sha1, self._read(sha1, row[0], row[1], row[2])))
+            sha1 = row[3]
+        for sha1, data in reversed(chain):
+            if text is None:
+                text = data.decode('utf-8')
+            else:
+                text = apply_delta(text, json.loads(data))
+        self._remember(wanted, text)
+        return text
+
+    def flush(self):
+        if self.pack is not None:
+            self.pack[1].flush()
+            os.fsync(self.pack[1].fileno())
+
+    def _remember(self, sha1, text):
+        if sha1 not in self.cache:
+            self.cache_order.append(sha1)
+            if len(self.cache_order) > CACHE_SIZE:
+                del self.cache[self.cache_order.pop(0)]
+        self.cache[sha1] = text
+
+    def _pack_name(self, pack):
+        return os.path.join(self.location, 'pack-%04d.pack' % pack)
+
+    def _write(self, sha1, data, loose):
+        # the loose table is written in the same transaction as the
+        # objects table, and its rows are gone as soon as they're replaced
+        if loose:
+            self.db.execute('INSERT OR REPLACE INTO loose (sha1, data) '
+                            'VALUES (?, ?)', (sha1, buffer(data)))
+            return LOOSE, 0
+        self.db.execute('DELETE FROM loose WHERE sha1 = ?', (sha1,))
+        return self._append(data)
+
+    def _append(self, data):
+        if self.pack is None:
+            row = self.db.execute('SELECT MAX(pack) FROM objects').fetchone()
+            pack = row[0] or 1
+            self.pack = (pack, file(self._pack_name(pack), 'ab'))
+        pack, fd = self.pack
+        # other mw processes may be appending to the same pack
+        fcntl.flock(fd.fileno(), fcntl.LOCK_EX)
+        try:
+            fd.seek(0, os.SEEK_END)
+            offset = fd.tell()
+            if offset == 0 or offset + len(data) <= PACK_SIZE:
+                fd.write(data)
+                fd.flush()
+                return pack, offset
+        finally:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_UN)
+        # this pack is full, start the next one
+        self.flush()
+        fd.close()
+        self.pack = (pack + 1, file(self._pack_name(pack + 1), 'ab'))
+        return self._append(data)
+
+    def _read(self, sha1, pack, offset, length):
+        if pack == LOOSE:
+            mw.metrics.count('objects.bytes_read', length)
+            return zlib.decompress(str(self.db.execute(
+                    'SELECT data FROM loose WHERE sha1 = ?',
+                    (sha1,)).fetchone()[0]))
+        if pack not in self.readers:
+            self.readers[pack] = file(self._pack_name(pack), 'rb')
+        fd = self.readers[pack]
+        fd.seek(offset)
+        mw.metrics.count('objects.bytes_read', length)
+        return zlib.decompress(fd.read(length))
@@ -0,0 +1,237 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import array
+import atexit
+import re
+import sqlite3
+import sre_constants
+import sre_parse
+
+_token_re = re.compile(r'\w+', re.UNICODE)
+_piece_re = re.compile(r'\w+|\W+', re.UNICODE)
+
+# a substring this short matches too much of the vocabulary to be worth
+# looking up; candidates are narrowed by the other terms instead
+MIN_SUBSTRING = 3
+
+_indexes = {}
+
+
+def open_index(path):
+    if path not in _indexes:
+        _indexes[path] = SearchIndex(path)
+    return _indexes[path]
+
+
+def tokenize(text):
+    """Return the set of lowercased words in `text`."""
+    return set(_token_re.findall(text.lower()))
+
+
+def required_terms(pattern, flags=0):
+    """
+    Work out which words any match of the regex `pattern` must contain.
+
+    Returns a list of (kind, word) where kind is 'exact' (the whole word),
+    'prefix' (the start of a word) or 'substring' (anywhere in a word).
+    Only runs of plain characters at the top level of the pattern are
+    used, so the terms may match pages the regex doesn't, never the other
+    way around.
+    """
+    terms = []
+    run = []
+    left = [False]
+
+    def flush(right):
+        pieces = _piece_re.findall(u''.join(run).lower())
+        for k, piece in enumerate(pieces):
+            if not _token_re.match(piece):
+                continue
+            closed_left = k > 0 or left[0]
+            closed_right = k < len(pieces) - 1 or right
+            if closed_left and closed_right:
+                terms.append(('exact', piece))
+            elif closed_left:
+                terms.append(('prefix', piece))
+            elif len(piece) >= MIN_SUBSTRING:
+                terms.append(('substring', piece))
+        del run[:]
+
+    for op, av in sre_parse.parse(pattern, flags):
+        if op == sre_constants.LITERAL:
+            run.append(unichr(av))
+            continue
+        boundary = op == sre_constants.AT and av in [
+                sre_constants.AT_BOUNDARY, sre_constants.AT_BEGINNING,
+                sre_constants.AT_BEGINNING_STRING, sre_constants.AT_END,
+                sre_constants.AT_END_STRING]
+        flush(boundary)
+        left[0] = boundary
+    flush(False)
+    return terms
+
+
+class SearchIndex(object):
+    """Word index over the newest cached text of every page.
+
+    Lives in .mw/cache/search.db next to the page cache. Each page keeps
+    the list of word ids it was last indexed with, so an edit only
+    touches the postings of words that came or went.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        # postings go in all over the table, more cache means less I/O
+        self.db.execute('PRAGMA cache_size=-65536')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS tokens (
+                id INTEGER PRIMARY KEY,
+                token TEXT NOT NULL UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                tokenid INTEGER NOT NULL,
+                pageid INTEGER NOT NULL,
+                PRIMARY KEY (tokenid, pageid)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS pages (
+                pageid INTEGER PRIMARY KEY,
+                revid INTEGER NOT NULL,
+                tokens BLOB NOT NULL
+            );
+        ''')
+        atexit.register(self.commit)
+
+    def commit(self):
+        if self.db is not None:
+            self.db.commit()
+
+    def rollback(self):
+        if self.db is not None:
+            self.db.rollback()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def rebuild(self, pages):
+        """
+        Index `pages`, an iterable of (pageid, revid, text), from scratch.
+
+        Postings are collected in a scratch table first and then added in
+        key order, which is far quicker than adding them page by page.
+        """
+        self.db.executescript('''
+            DELETE FROM postings;
+            DELETE FROM pages;
+            DELETE FROM tokens;
+            CREATE TEMP TABLE IF NOT EXISTS staging (
+                tokenid INTEGER NOT NULL,
+                pageid INTEGER NOT NULL
+            );
+            DELETE FROM staging;
+        ''')
+        count = 0
+        for pageid, revid, text in pages:
+            new = self._token_ids(tokenize(text))
+            self.db.executemany('INSERT INTO staging (tokenid, pageid) '
+                                'VALUES (?, ?)',
+                                [(tokenid, int(pageid)) for tokenid in new])
+            tokens = array.array('i', sorted(new)).tostring()
+            self.db.execute('INSERT OR REPLACE INTO pages '
+                            '(pageid, revid, tokens) VALUES (?, ?, ?)',
+                            (int(pageid), int(revid), sqlite3.Binary(tokens)))
+            count += 1
+        self.db.executescript('''
+            INSERT OR IGNORE INTO postings (tokenid, pageid)
+                SELECT tokenid, pageid FROM staging ORDER BY tokenid, pageid;
+            DROP TABLE staging;
+        ''')
+        self.db.commit()
+        return count
+
+    def update(self, pageid, revid, text):
+        pageid = int(pageid)
+        row = self.db.execute('SELECT revid, tokens FROM pages '
+                              'WHERE pageid = ?', (pageid,)).fetchone()
+        old = set()
+        if row is not None:
+            if row[0] > revid:
+                return  # an older revision, e.g. from pull --history
+            old = set(array.array('i', str(row[1])))
+        new = self._token_ids(tokenize(text))
+        self.db.executemany('DELETE FROM postings '
+                            'WHERE tokenid = ? AND pageid = ?',
+                            [(tokenid, pageid) for tokenid in old - new])
+        self.db.executemany('INSERT INTO postings (tokenid, pageid) '
+                            'VALUES (?, ?)',
+                            [(tokenid, pageid) for tokenid in new - old])
+        tokens = array.array('i', sorted(new)).tostring()
+        self.db.execute('INSERT OR REPLACE INTO pages (pageid, revid, tokens) '
+                        'VALUES (?, ?, ?)',
+                        (pageid, int(revid), sqlite3.Binary(tokens)))
+
+    def _token_ids(self, tokens):
+        # a handful of statements per page rather than one per word
+        tokens = list(tokens)
+        self.db.executemany('INSERT OR IGNORE INTO tokens (token) VALUES (?)',
+                            [(token,) for token in tokens])
+        ids = set()
+        for start in xrange(0, len(tokens), 500):
+            these = tokens[start:start + 500]
+            ids.update(row[0] for row in self.db.execute(
+                    'SELECT id FROM tokens WHERE token IN (%s)' %
+                    ','.join('?' * len(these)), these))
+        return ids
+
+    def candidates(self, terms):
+        """
+        Return the pageids that contain every term, or None when the
+        terms don't narrow anything down.
+        """
+        order = {'exact': 0, 'prefix': 1, 'substring': 2}
+        found = None
+        for kind, word in sorted(terms, key=lambda term: order[term[0]]):
+            if kind == 'substring' and found is not None and \
+               len(found) < 100:
+                break  # cheaper to check those few pages directly
+            if kind == 'exact':
+                where, args = 'token = ?', (word,)
+            elif kind == 'prefix':
+                where, args = 'token >= ? AND token < ?', (word,
+                                                          word + u'\uffff')
+            else:
+                where, args = 'instr(token, ?) > 0', (word,)
+            pages = set(row[0] for row in self.db.execute(
+                    'SELECT DISTINCT pageid FROM postings WHERE tokenid IN '
+                    '(SELECT id FROM tokens WHERE %s)' % where, args))
+            if found is None:
+                found = pages
+            else:
+                found &= pages
+            if not found:
+                break
+        return found
+
+    def pages(self):
+        return [row[0] for row in self.db.execute('SELECT pageid FROM pages')]
@@ -0,0 +1,270 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import atexit
+import json
+import mw.metrics
+import mw.objects
+import os
+import sqlite3
+
+SCHEMA_VERSION = 6
+
+_stores = {}
+
+
+def open_store(path):
+    # every Metadir in the process shares one connection, so one command
+    # running another can't end up waiting on its own write lock
+    if path not in _stores:
+        _stores[path] = SqliteStore(path)
+    return _stores[path]
+
+
+class SqliteStore(object):
+    """Page index and revision cache in .mw/cache/store.db.
+
+    Revision texts themselves go to the object store in
+    .mw/cache/objects/. Writes are grouped into transactions; nothing is
+    durable until commit() is called (which also happens at exit).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.objects = mw.objects.ObjectStore(
+                os.path.join(os.path.dirname(path), 'objects'), self.db)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError('%s was written by a newer mw' % path)
+        while version < SCHEMA_VERSION:
+            version += 1
+            getattr(self, '_upgrade_to_%d' % version)()
+            self.db.execute('PRAGMA user_version = %d' % version)
+            self.db.commit()
+        atexit.register(self.commit)
+
+    def _upgrade_to_1(self):
+        self.db.executescript('''
+            CREATE TABLE pages (
+                pageid INTEGER PRIMARY KEY,
+                title TEXT NOT NULL,
+                currentrv INTEGER NOT NULL
+            );
+            CREATE UNIQUE INDEX pages_title ON pages (title);
+            CREATE TABLE revisions (
+                pageid INTEGER NOT NULL,
+                revid INTEGER NOT NULL,
+                user TEXT,
+                timestamp TEXT,
+                content TEXT,
+                PRIMARY KEY (pageid, revid)
+            );
+        ''')
+
+    def _upgrade_to_2(self):
+        # revision texts move out of the table into the object store
+        self.db.executescript('''
+            CREATE TABLE objects (
+                sha1 TEXT PRIMARY KEY,
+                pack INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                base TEXT,
+                depth INTEGER NOT NULL
+            );
+            ALTER TABLE revisions ADD COLUMN sha1 TEXT;
+        ''')
+        # the texts are stored the way the newest schema stores them
+        self._upgrade_to_6()
+        rows = self.db.execute('SELECT pageid, revid, content FROM revisions '
+                               'WHERE content IS NOT NULL '
+                               'ORDER BY pageid, revid').fetchall()
+        for pageid, revid, content in rows:
+            self.db.execute('UPDATE revisions SET sha1 = ?, content = NULL '
+                            'WHERE pageid = ? AND revid = ?',
+                            (self._put_text(pageid, revid, content), pageid,
+                             revid))
+        self.commit()
+        if rows:
+            self.db.execute('VACUUM')
+
+    def _upgrade_to_3(self):
+        # where `pull --history` got to for each page: the request to
+        # continue with if it was interrupted, and the newest revision
+        # it has seen once it got to the end
+        self.db.executescript('''
+            CREATE TABLE history (
+                pageid INTEGER PRIMARY KEY,
+                cont TEXT,
+                lastrevid INTEGER
+            );
+        ''')
+
+    def _upgrade_to_4(self):
+        # the id of the last batch of working file updates committed, see
+        # Metadir.cache_commit
+        self.db.executescript('''
+            CREATE TABLE journal (
+                id INTEGER PRIMARY KEY,
+                batch TEXT NOT NULL
+            );
+        ''')
+
+    def _upgrade_to_5(self):
+        # deltas now go from newer revisions to older ones, and finding
+        # what is based on an object has to be quick
+        self.db.executescript('''
+            CREATE INDEX objects_base ON objects (base);
+        ''')
+
+    def _upgrade_to_6(self):
+        # the latest revision of each page is kept out of the packs until
+        # a newer one turns it into a delta, see mw.objects.ObjectStore
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS loose (
+                sha1 TEXT PRIMARY KEY,
+                data BLOB NOT NULL
+            );
+        ''')
+
+    def commit(self, sync=False):
+        if self.db is not None:
+            # packs first, so committed rows never point past their end
+            with mw.metrics.timer('cache.commit'):
+                self.objects.flush()
+                self.db.commit()
+                if sync:
+                    # synchronous=NORMAL leaves the WAL unsynced, which is
+                    # fine for the cache but not for a batch's commit point
+                    wal = self.path + '-wal'
+                    if os.path.exists(wal):
+                        fd = os.open(wal, os.O_RDONLY)
+                        try:
+                            os.fsync(fd)
+                        finally:
+                            os.close(fd)
+
+    def rollback(self):
+        if self.db is not None:
+            self.db.rollback()
+
+    def close(self):
+        if self.db is not None:
+            self.commit()
+            self.db.close()
+            self.db = None
+
+    def page_add(self, pagename, pageid, currentrv):
+        # a title can move to a new pageid if the page was deleted and
+        # recreated, REPLACE drops the old row in that case
+        self.db.execute('INSERT OR REPLACE INTO pages '
+                        '(pageid, title, currentrv) VALUES (?, ?, ?)',
+                        (int(pageid), pagename, int(currentrv)))
+
+    def page_get(self, pagename):
+        row = self.db.execute('SELECT pageid, currentrv FROM pages '
+                              'WHERE title = ?', (pagename,)).fetchone()
+        if row is None:
+            return None
+        return {'id': row[0], 'currentrv': row[1]}
+
+    def page_title(self, pageid):
+        row = self.db.execute('SELECT title FROM pages WHERE pageid = ?',
+                              (int(pageid),)).fetchone()
+        return row and row[0]
+
+    def page_list(self):
+        return self.db.execute('SELECT title, pageid, currentrv FROM pages '
+                               'ORDER BY title')
+
+    def rv_add(self, pageid, rvid, user, timestamp, content):
+        sha1 = None
+        if content is not None:
+            sha1 = self._put_text(pageid, rvid, content)
+        self.db.execute('INSERT OR REPLACE INTO revisions '
+                        '(pageid, revid, user, timestamp, sha1) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (int(pageid), int(rvid), user, timestamp, sha1))
+
+    def _put_text(self, pageid, rvid, content):
+        # the page's latest revision is kept whole, so reading it is
+        # cheap; older ones are deltas against the next newer one
+        row = self.db.execute('SELECT sha1 FROM revisions '
+                              'WHERE pageid = ? AND revid > ? '
+                              'AND sha1 IS NOT NULL '
+                              'ORDER BY revid LIMIT 1',
+                              (int(pageid), int(rvid))).fetchone()
+        if row is not None:
+            return self.objects.put(content, row[0])
+        sha1 = self.objects.put_full(content)
+        row = self.db.execute('SELECT sha1 FROM revisions '
+                              'WHERE pageid = ? AND revid < ? '
+                              'AND sha1 IS NOT NULL '
+                              'ORDER BY revid DESC LIMIT 1',
+                              (int(pageid), int(rvid))).fetchone()
+        if row is not None:
+            self.objects.rebase(row[0], sha1)
+        return sha1
+
+    def rv_list(self, pageid):
+        return [row[0] for row in self.db.execute(
+                'SELECT revid FROM revisions WHERE pageid = ? '
+                'ORDER BY revid', (int(pageid),))]
+
+    def rv_get(self, pageid, rvid):
+        row = self.db.execute('SELECT user, timestamp, sha1 '
+                              'FROM revisions WHERE pageid = ? AND revid = ?',
+                              (int(pageid), int(rvid))).fetchone()
+        if row is None:
+            return None
+        rv = {'user': row[0], 'timestamp': row[1]}
+        if row[2] is not None:
+            rv['content'] = self.objects.get(row[2])
+        return rv
+
+    def rv_sha1(self, pageid, rvid):
+        row = self.db.execute('SELECT sha1 FROM revisions '
+                              'WHERE pageid = ? AND revid = ?',
+                              (int(pageid), int(rvid))).fetchone()
+        return row and row[0]
+
+    def history_get(self, pageid):
+        row = self.db.execute('SELECT cont, lastrevid FROM history '
+                              'WHERE pageid = ?', (int(pageid),)).fetchone()
+        if row is None:
+            return None, None
+        return row[0] and json.loads(row[0]), row[1]
+
+    def journal_mark(self, batch):
+        self.db.execute('INSERT OR REPLACE INTO journal (id, batch) '
+                        'VALUES (1, ?)', (batch,))
+
+    def journal_batch(self):
+        row = self.db.execute('SELECT batch FROM journal '
+                              'WHERE id = 1').fetchone()
+        return row and row[0]
+
+    def history_set(self, pageid, cont, lastrevid):
+        if cont is not None:
+            cont = json.dumps(cont)
+        self.db.execute('INSERT OR REPLACE INTO history '
+                        '(pageid, cont, lastrevid) VALUES (?, ?, ?)',
+                        (int(pageid), cont, lastrevid))
@@ -0,0 +1,314 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import atexit
+import cookielib
+import hashlib
+import httplib
+import json
+import mw
+import mw.metrics
+import os
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import zlib
+
+# longer read queries go as POST, and so does anything that isn't a read
+MAX_GET_LENGTH = 2000
+TIMEOUT = 120
+# downloads are read and written this much at a time
+DOWNLOAD_CHUNK = 65536
+# followed like urllib2 did, up to MAX_REDIRECTS times per call
+REDIRECTS = [301, 302, 303, 307, 308]
+MAX_REDIRECTS = 5
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get(api_url, cookie_file):
+    """The Transport for api_url; every caller in the process shares it."""
+    with _transports_lock:
+        if (api_url, cookie_file) not in _transports:
+            _transports[(api_url, cookie_file)] = \
+                    Transport(api_url, cookie_file)
+        return _transports[(api_url, cookie_file)]
+
+
+class TransportError(Exception):
+    pass
+
+
+class Transport(object):
+    """Talks to api.php over a pool of keep-alive connections.
+
+    Safe to use from several threads at once; each call borrows a
+    connection from the pool (or opens one) and gives it back afterwards.
+    Cookies are loaded once and saved when the process exits.
+    """
+
+    def __init__(self, api_url, cookie_file=None):
+        self.api_url = api_url
+        url = urlparse.urlsplit(api_url)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path or '/'
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.cookie_file = cookie_file
+        self.cookiejar = cookielib.MozillaCookieJar()
+        if cookie_file is not None and os.path.isfile(cookie_file):
+            try:
+                self.cookiejar.load(cookie_file, ignore_discard=True)
+            except (cookielib.LoadError, IOError):
+                pass  # start over with no cookies
+        atexit.register(self.save_cookies)
+
+    def save_cookies(self):
+        if self.cookie_file is not None and len(self.cookiejar) > 0:
+            self.cookiejar.save(self.cookie_file, ignore_discard=True)
+
+    def close(self):
+        """Close every idle pooled connection."""
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for pool in pools.itervalues():
+            for conn in pool:
+                conn.close()
+
+    def call(self, params, files=None):
+        # `files` maps parameter names to (filename, data) to send as file
+        # uploads, which makes the request multipart/form-data
+        params = dict(params)
+        params['format'] = 'json'
+        query = urllib.urlencode([(key, _to_bytes(value))
+                                  for key, value in params.iteritems()])
+        headers = {
+                'Accept-Encoding': 'gzip',
+                'User-Agent': 'mw/%s' % mw.version,
+        }
+        # a read can be sent again if the connection fails under it; an
+        # edit or upload the wiki may already have made can't
+        idempotent = params.get('action') == 'query' and not files
+        if files:
+            method = 'POST'
+            path = self.path
+            headers['Content-Type'], body = _multipart(params, files)
+        elif params.get('action') == 'query' and 'token' not in params and \
+           len(query) <= MAX_GET_LENGTH:
+            method = 'GET'
+            path = self.path + '?' + query
+            body = None
+        else:
+            method = 'POST'
+            path = self.path
+            body = query
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        request = urllib2.Request(self.api_url)
+        self.cookiejar.add_cookie_header(request)
+        headers.update(request.unredirected_hdrs)
+        start = time.time()
+        response, data = self._request(method, path, body, headers,
+                                        idempotent)
+        elapsed = time.time() - start
+        mw.metrics.count('api.calls')
+        mw.metrics.count('api.bytes_sent', len(body or path))
+        mw.metrics.count('api.bytes_received', len(data))
+        mw.metrics.add_time('api', elapsed)
+        mw.metrics.trace('%s %s %d, %d bytes in %.3fs' % (
+                method, _describe(params), response.status, len(data),
+                elapsed))
+        self.cookiejar.extract_cookies(_CookieResponse(response), request)
+        if response.status != 200:
+            raise TransportError('%s returned HTTP %d %s' % (
+                    self.api_url, response.status, response.reason))
+        if response.getheader('content-encoding') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        result = json.loads(data)
+        # how long a lagged wiki wants us to wait goes back with the error
+        # it belongs to, other threads' calls have their own
+        retry_after = response.getheader('retry-after')
+        if 'error' in result and retry_after is not None and \
+           retry_after.isdigit():
+            result['error']['retryafter'] = int(retry_after)
+        return result
+
+    def download(self, url, path):
+        """Save `url` (relative to the API's) to `path` a chunk at a time.
+
+        Returns {'sha1': ..., 'size': ...} for what was saved, or an
+        API-style {'error': ...} if the server wouldn't give it to us.
+        """
+        url = urlparse.urljoin(self.api_url, url)
+        opener = urllib2.build_opener(
+                urllib2.HTTPCookieProcessor(self.cookiejar))
+        opener.addheaders = [('User-Agent', 'mw/%s' % mw.version)]
+        start = time.time()
+        sha1 = hashlib.sha1()
+        size = 0
+        try:
+            response = opener.open(url, timeout=TIMEOUT)
+            try:
+                fd = file(path, 'wb')
+                try:
+                    while True:
+                        chunk = response.read(DOWNLOAD_CHUNK)
+                        if not chunk:
+                            break
+                        sha1.update(chunk)
+                        size += len(chunk)
+                        fd.write(chunk)
+                finally:
+                    fd.close()
+            finally:
+                response.close()
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            return {'error': {'code': 'download', 'info': '%s: %s' % (url,
+                                                                      e)}}
+        mw.metrics.count('media.downloads')
+        mw.metrics.count('media.bytes_received', size)
+        mw.metrics.add_time('media', time.time() - start)
+        mw.metrics.trace('GET %s, %d bytes in %.3fs' % (
+                url, size, time.time() - start))
+        return {'sha1': sha1.hexdigest(), 'size': size}
+
+    def _request(self, method, path, body, headers, idempotent):
+        # redirects are followed, to another host too; only 303 turns the
+        # request into a GET, the others send it again as it was so an
+        # api.php that moved still gets the POSTed parameters
+        origin = (self.scheme, self.host, self.port)
+        for hop in range(MAX_REDIRECTS + 1):
+            response, data = self._send(origin, method, path, body, headers,
+                                        idempotent)
+            location = response.getheader('location')
+            if response.status not in REDIRECTS or location is None or \
+               hop == MAX_REDIRECTS:
+                return response, data
+            mw.metrics.count('api.redirects')
+            url = urlparse.urlsplit(urlparse.urljoin(
+                    _url(origin, path), location))
+            mw.metrics.trace('redirected to %s' % url.geturl())
+            origin = (url.scheme, url.hostname, url.port)
+            path = url.path or '/'
+            if url.query:
+                path += '?' + url.query
+            if response.status == 303 and method != 'GET':
+                method = 'GET'
+                body = None
+                headers = dict(headers)
+                headers.pop('Content-Type', None)
+
+    def _send(self, origin, method, path, body, headers, idempotent):
+        # a pooled connection may have been closed by the server while it
+        # sat idle, so one failure on a reused connection is retried:
+        # always for reads, otherwise only if the request never made it
+        # out, as the wiki may have acted on it
+        for attempt in range(2):
+            conn, reused = self._get_connection(origin)
+            sent = False
+            try:
+                conn.request(method, path, body, headers)
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused and attempt == 0 and (idempotent or not sent):
+                    mw.metrics.count('api.reconnects')
+                    continue
+                raise
+            if response.getheader('connection', '').lower() == 'close':
+                conn.close()
+            else:
+                with self.lock:
+                    self.pools.setdefault(origin, []).append(conn)
+            return response, data
+
+    def _get_connection(self, origin):
+        # one pool per (scheme, host, port), redirects can lead elsewhere
+        with self.lock:
+            if self.pools.get(origin):
+                return self.pools[origin].pop(), True
+        scheme, host, port = origin
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=TIMEOUT)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=TIMEOUT)
+        return conn, False
+
+
+def _url(origin, path):
+    scheme, host, port = origin
+    if port is not None:
+        host = '%s:%d' % (host, port)
+    return '%s://%s%s' % (scheme, host, path)
+
+
+def _describe(params):
+    # enough of a request to tell it apart in the MW_TRACE log
+    keys = ['action', 'list', 'prop', 'meta', 'generator']
+    text = ' '.join('%s=%s' % (key, params[key]) for key in keys
+                    if key in params)
+    for key in ['titles', 'revids', 'title']:
+        if key in params:
+            value = _to_bytes(params[key])
+            count = value.count('|') + 1
+            if count > 1:
+                text += ' %s=(%d)' % (key, count)
+            else:
+                text += ' %s=%s' % (key, value[:60])
+    return text
+
+
+class _CookieResponse(object):
+    # the bit of urllib2's response interface cookielib needs
+
+    def __init__(self, response):
+        self.response = response
+
+    def info(self):
+        return self.response.msg
+
+
+def _multipart(params, files):
+    # (content type, body) for a multipart/form-data POST
+    boundary = '----mw%s' % os.urandom(16).encode('hex')
+    parts = []
+    for key, value in params.iteritems():
+        parts.append('--%s\r\nContent-Disposition: form-data; name="%s"'
+                     '\r\n\r\n%s\r\n' % (boundary, key, _to_bytes(value)))
+    for key, (filename, data) in files.iteritems():
+        parts.append('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                     'filename="%s"\r\nContent-Type: '
+                     'application/octet-stream\r\n\r\n' % (
+                             boundary, key, _to_bytes(filename)))
+        parts.append(data)
+        parts.append('\r\n')
+    parts.append('--%s--\r\n' % boundary)
+    return 'multipart/form-data; boundary=%s' % boundary, ''.join(parts)
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
@@ -0,0 +1,246 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+# mw run as a command against bench/fakewiki.py, a fake api.php on
+# localhost
+
+import ConfigParser
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'bench'))
+import fakewiki
+
+MW = [sys.executable, os.path.join(HERE, '..', 'bin', 'mw')]
+
+
+class CommandTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.wiki = fakewiki.FakeWiki(page_size=300)
+        self.server = fakewiki.start(self.wiki)
+        self.root = tempfile.mkdtemp()
+        self.env = dict(os.environ,
+                        PYTHONPATH=os.path.join(HERE, '..', 'src'))
+        self.assertEqual(self.mw('init', self.server.url)[0], 0)
+        self.config('pull', 'rate', '0')
+        self.config('commit', 'edits_per_minute', '0')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def mw(self, *args):
+        args = [arg.encode('utf-8') if isinstance(arg, unicode) else arg
+                for arg in args]
+        process = subprocess.Popen(MW + args, cwd=self.root, env=self.env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        out = process.communicate()[0]
+        return process.returncode, out
+
+    def config(self, section, option, value):
+        filename = os.path.join(self.root, '.mw', 'config')
+        config = ConfigParser.RawConfigParser()
+        config.read(filename)
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value)
+        fd = file(filename, 'wb')
+        config.write(fd)
+        fd.close()
+
+    def path(self, title):
+        return os.path.join(self.root, title.replace(u' ', u'_'))
+
+    def files(self):
+        return sorted(name for name in os.listdir(self.root)
+                      if name != '.mw')
+
+    def state(self):
+        # what tells the next pull where to go on from
+        return [file(os.path.join(self.root, '.mw', name)).read()
+                for name in ['rcmark', 'session']]
+
+
+class PullTest(CommandTestCase):
+
+    def test_pull(self):
+        titles = self.wiki.populate(5)
+        code, out = self.mw('pull', *titles)
+        self.assertEqual(code, 0, out)
+        self.assertEqual(len(self.files()), 5)
+        text = self.wiki.pages[titles[0]]['revisions'][-1]['*']
+        self.assertEqual(file(self.path(titles[0]) + '.wiki').read(),
+                         text.encode('utf-8'))
+        self.assertEqual(self.mw('status')[1], '')
+
+    def test_dry_run(self):
+        titles = self.wiki.populate(3)
+        code, out = self.mw('pull', '-n', *titles)
+        self.assertEqual(code, 0, out)
+        self.assertEqual(out.count('would pull:'), 3)
+        self.assertEqual(self.files(), [])
+        self.mw('pull', *titles)
+        self.wiki._add_revision(titles[1], u'changed', u'edit')
+        code, out = self.mw('pull', '-n', *titles)
+        self.assertEqual(code, 0, out)
+        self.assertEqual(out.count('would pull:'), 1)
+        self.assertTrue(titles[1] in out)
+        self.assertNotEqual(file(self.path(titles[1]) + '.wiki').read(),
+                            'changed')
+
+    def test_dry_run_writes_nothing(self):
+        titles = self.wiki.populate(3)
+        self.mw('pull', *titles)
+        self.mw('pull')
+        self.wiki._add_revision(titles[1], u'changed', u'edit')
+        # an interrupted pull, to be resumed later
+        file(os.path.join(self.root, '.mw', 'session'), 'w').write(
+                json.dumps({'command': 'pull', 'args': [titles[0]],
+                            'options': {'history': False, 'since': None,
+                                        'jobs': None, 'namespace': None,
+                                        'prefix': None}}))
+        state = self.state()
+        for args in [['pull', '-n'], ['pull', '-n', '--namespace', '0'],
+                     ['pullcat', '-n', 'Things']]:
+            code, out = self.mw(*args)
+            self.assertEqual(code, 0, out)
+            self.assertEqual(self.state(), state, args)
+        code, out = self.mw('pull')
+        self.assertEqual(out.count('pulling:'), 1, out)
+
+    def test_local_changes_are_kept(self):
+        titles = self.wiki.populate(2)
+        self.mw('pull', *titles)
+        file(self.path(titles[0]) + '.wiki', 'a').write('local')
+        self.wiki._add_revision(titles[0], u'remote', u'edit')
+        code, out = self.mw('pull', *titles)
+        self.assertTrue('uncommitted modifications' in out, out)
+        self.assertTrue(file(self.path(titles[0]) + '.wiki').read()
+                        .endswith('local'))
+
+    def test_recent_changes(self):
+        titles = self.wiki.populate(5)
+        self.mw('pull', *titles)
+        self.mw('pull')  # remembers where recent changes are up to
+        self.wiki._add_revision(titles[2], u'changed', u'edit')
+        self.wiki.populate(3)  # not ours, so not pulled
+        asked = []
+        call = self.wiki.call
+        self.wiki.call = lambda params: asked.append(params) or call(params)
+        code, out = self.mw('pull')
+        self.assertEqual(code, 0, out)
+        self.assertEqual(out.count('pulling:'), 1, out)
+        # only the changed page was looked at
+        self.assertEqual([params['titles'] for params in asked
+                          if 'titles' in params], [titles[2]])
+        self.assertEqual(file(self.path(titles[2]) + '.wiki').read(),
+                         'changed')
+        self.assertEqual(len(self.files()), 5)
+        code, out = self.mw('pull')
+        self.assertEqual(out.count('pulling:'), 0, out)
+
+    def test_history(self):
+        title = self.wiki.populate(1)[0]
+        for i in xrange(60):
+            self.wiki._add_revision(title, u'line\nrevision %d\n' % i,
+                                    u'edit')
+        self.mw('pull', title)
+        # more revisions than the wiki sends at once
+        code, out = self.mw('pull', '--history', title)
+        self.assertEqual(code, 0, out)
+        self.assertTrue('60 revisions added' in out, out)
+        revids = [rv['revid'] for rv in self.wiki.pages[title]['revisions']]
+        code, out = self.mw('diff', '-r', '%d:%d' % (revids[1], revids[2]),
+                            title)
+        self.assertEqual(code, 0, out)
+        self.assertTrue('-revision 0\n+revision 1\n' in out, out)
+        code, out = self.mw('pull', '--history', title)
+        self.assertTrue('0 revisions added' in out, out)
+
+
+class PullcatTest(CommandTestCase):
+
+    def test_pullcat(self):
+        titles = self.wiki.populate(4, category=u'Category:Things')
+        self.wiki.populate(2)
+        code, out = self.mw('pullcat', 'Things')
+        self.assertEqual(code, 0, out)
+        self.assertEqual(self.files(), sorted(
+                (title.replace(u' ', u'_') + u'.wiki').encode('utf-8')
+                for title in titles))
+
+    def test_media_members(self):
+        files = self.wiki.populate_files(2, size=5000)
+        pages = self.wiki.populate(2)
+        self.wiki.categories[u'Category:Mixed'] = files + pages
+        code, out = self.mw('pullcat', 'Mixed')
+        self.assertEqual(code, 0, out)
+        for title in files:
+            self.assertEqual(os.path.getsize(self.path(title)), 5000)
+            self.assertTrue(os.path.exists(self.path(title) + '.wiki'))
+
+    def test_depth(self):
+        top = self.wiki.populate(60)
+        sub = self.wiki.populate(1, namespace=u'Category')[0]
+        self.wiki.categories[u'Category:Top'] = top[:40] + [sub]
+        self.wiki.categories[sub] = top[20:]
+        code, out = self.mw('pullcat', 'Top')
+        self.assertEqual(len(self.files()), 41)
+        shutil.rmtree(os.path.join(self.root, '.mw'))
+        for name in self.files():
+            os.remove(os.path.join(self.root, name))
+        self.mw('init', self.server.url)
+        code, out = self.mw('pullcat', '--depth', '1', 'Top')
+        self.assertEqual(code, 0, out)
+        self.assertEqual(len(self.files()), 61)
+        # pages in both categories are only downloaded once
+        self.assertEqual(out.count('pulling:'), 61)
+
+
+class CommitTest(CommandTestCase):
+
+    def test_commit(self):
+        titles = self.wiki.populate(3)
+        self.mw('pull', *titles)
+        for title in titles[:2]:
+            file(self.path(title) + '.wiki', 'a').write('\nmore ~~~~')
+        self.wiki._add_revision(titles[1], u'someone else', u'edit')
+        edits = self.wiki.edits
+        code, out = self.mw('commit', '-m', 'test')
+        self.assertEqual(code, 0, out)
+        self.assertTrue('edit conflict' in out)
+        self.assertEqual(self.wiki.edits - edits, 1)
+        # the signature the wiki put in comes back into the file
+        self.assertTrue(file(self.path(titles[0]) + '.wiki').read()
+                        .endswith('more [[User:Fake|Fake]]'))
+        self.assertEqual(self.mw('status')[1],
+                         'M %s.wiki\n' % titles[1].replace(u' ', u'_'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import mw.diff
+
+
+def apply_opcodes(a, b, codes):
+    # rebuild b from a, taking only the inserted lines from b
+    out = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal':
+            out.extend(a[i1:i2])
+        else:
+            out.extend(b[j1:j2])
+    return out
+
+
+def mutate(rng, lines):
+    lines = list(lines)
+    for _ in range(rng.randint(0, 8)):
+        k = rng.randint(0, len(lines))
+        what = rng.choice(['insert', 'delete', 'change', 'move'])
+        if what == 'insert' or not lines:
+            lines.insert(k, 'new %d\n' % rng.randint(0, 5))
+        elif what == 'delete':
+            del lines[min(k, len(lines) - 1)]
+        elif what == 'change':
+            lines[min(k, len(lines) - 1)] = 'changed\n'
+        else:
+            lines.insert(k, lines.pop(rng.randint(0, len(lines) - 1)))
+    return lines
+
+
+class OpcodesTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            # few distinct lines, so there are plenty of repeats
+            a = ['line %d\n' % rng.randint(0, 6)
+                 for _ in range(rng.randint(0, 30))]
+            b = mutate(rng, a)
+            codes = mw.diff.opcodes(a, b)
+            self.assertEqual(apply_opcodes(a, b, codes), b)
+            # the codes cover both sides without gaps
+            self.assertEqual(sum(i2 - i1 for _, i1, i2, _, _ in codes),
+                             len(a))
+            self.assertEqual(sum(j2 - j1 for _, _, _, j1, j2 in codes),
+                             len(b))
+
+    def test_matching_lines_are_equal_and_increasing(self):
+        a = ['x\n', 'a\n', 'b\n', 'x\n', 'c\n']
+        b = ['a\n', 'x\n', 'b\n', 'c\n', 'x\n']
+        matches = mw.diff.matching_lines(a, b)
+        for i, j in matches:
+            self.assertEqual(a[i], b[j])
+        self.assertEqual(matches, sorted(matches))
+        self.assertEqual(len(set(j for i, j in matches)), len(matches))
+
+    def test_identical(self):
+        a = mw.diff.split_lines('one\ntwo\nthree')
+        self.assertEqual(mw.diff.opcodes(a, a), [('equal', 0, 3, 0, 3)])
+        self.assertEqual(mw.diff.unified_diff('a', a, 'b', a), '')
+
+
+class OutputTest(unittest.TestCase):
+
+    def test_unified_diff(self):
+        a = mw.diff.split_lines('one\ntwo\nthree')
+        b = mw.diff.split_lines('one\n2\nthree\nfour')
+        self.assertEqual(mw.diff.unified_diff('old', a, 'new', b),
+                         '--- old\n+++ new\n@@ -1,3 +1,4 @@\n one\n-two\n'
+                         '+2\n three\n+four\n')
+
+    def test_hunks_split_on_long_equal_runs(self):
+        a = ['%d\n' % i for i in range(20)]
+        b = list(a)
+        b[1] = 'x\n'
+        b[18] = 'y\n'
+        diff = mw.diff.unified_diff('a', a, 'b', b, context=2)
+        self.assertEqual(diff.count('@@ -'), 2)
+
+    def test_word_diff(self):
+        a = mw.diff.split_lines('the quick brown fox')
+        b = mw.diff.split_lines('the slow brown fox')
+        self.assertTrue('the [-quick-]{+slow+} brown fox' in
+                        mw.diff.word_diff('a', a, 'b', b))
+
+    def test_diffstat(self):
+        a = mw.diff.split_lines('one\ntwo\nthree')
+        b = mw.diff.split_lines('one\n2\nthree\nfour')
+        self.assertEqual(mw.diff.diffstat(a, b), (2, 1))
+
+    def test_render(self):
+        job = ('stat', 'a', 'x\ny', 'b', 'x\nz')
+        self.assertEqual(mw.diff.render(job), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+import bz2
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import mw.dump
+
+DUMP = '''<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/"
+           version="0.10" xml:lang="en">
+  <siteinfo>
+    <sitename>Example</sitename>
+    <namespaces><namespace key="10">Template</namespace></namespaces>
+  </siteinfo>
+  <page>
+    <title>Main Page</title>
+    <ns>0</ns>
+    <id>1</id>
+    <revision>
+      <id>10</id>
+      <timestamp>2011-01-01T00:00:00Z</timestamp>
+      <contributor><username>Alice</username><id>3</id></contributor>
+      <comment>first</comment>
+      <text xml:space="preserve">Hello</text>
+    </revision>
+    <revision>
+      <id>12</id>
+      <parentid>10</parentid>
+      <timestamp>2011-01-02T00:00:00Z</timestamp>
+      <contributor><ip>10.0.0.1</ip></contributor>
+      <text xml:space="preserve">Hello, caf\xc3\xa9</text>
+    </revision>
+  </page>
+  <page>
+    <title>Template:Hidden</title>
+    <ns>10</ns>
+    <id>2</id>
+    <revision>
+      <id>11</id>
+      <timestamp>2011-01-01T12:00:00Z</timestamp>
+      <contributor deleted="deleted" />
+      <text deleted="deleted" />
+    </revision>
+  </page>
+</mediawiki>
+'''
+
+
+class ReadDumpTest(unittest.TestCase):
+
+    def read(self, fd):
+        return [(dict(page), rv) for page, rv in mw.dump.read_dump(fd)]
+
+    def test_pages_and_revisions(self):
+        revisions = self.read(StringIO.StringIO(DUMP))
+        self.assertEqual(len(revisions), 3)
+        main = {'title': u'Main Page', 'ns': 0, 'pageid': 1}
+        self.assertEqual(revisions[0], (main, {
+                'revid': 10, 'timestamp': u'2011-01-01T00:00:00Z',
+                'user': u'Alice', 'comment': u'first', '*': u'Hello'}))
+        # the parent and contributor ids aren't the revision's
+        self.assertEqual(revisions[1][1]['revid'], 12)
+        self.assertEqual(revisions[1][1]['user'], u'10.0.0.1')
+        self.assertEqual(revisions[1][1]['*'], u'Hello, caf\xe9')
+        self.assertEqual(revisions[2][0], {'title': u'Template:Hidden',
+                                           'ns': 10, 'pageid': 2})
+
+    def test_hidden_text(self):
+        rv = self.read(StringIO.StringIO(DUMP))[2][1]
+        self.assertEqual(rv['revid'], 11)
+        self.assertFalse('*' in rv)
+
+    def test_text_is_unicode(self):
+        for page, rv in self.read(StringIO.StringIO(DUMP)):
+            self.assertTrue(isinstance(page['title'], unicode))
+            if '*' in rv:
+                self.assertTrue(isinstance(rv['*'], unicode))
+
+    def test_open_compressed(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'dump.xml.bz2')
+            fd = bz2.BZ2File(filename, 'w')
+            fd.write(DUMP)
+            fd.close()
+            fd = mw.dump.open_dump(filename)
+            try:
+                self.assertEqual(len(self.read(fd)), 3)
+            finally:
+                fd.close()
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import mw.merge3
+
+
+class MergeTest(unittest.TestCase):
+
+    base = u'one\ntwo\nthree\nfour\nfive\nsix\nseven'
+
+    def test_both_sides_apart(self):
+        a = self.base.replace(u'two', u'TWO')
+        b = self.base.replace(u'six', u'SIX')
+        self.assertEqual(mw.merge3.merge(self.base, a, b),
+                         (u'one\nTWO\nthree\nfour\nfive\nSIX\nseven', 0))
+
+    def test_one_side(self):
+        a = self.base + u'\neight'
+        self.assertEqual(mw.merge3.merge(self.base, a, self.base), (a, 0))
+        self.assertEqual(mw.merge3.merge(self.base, self.base, a), (a, 0))
+
+    def test_same_change(self):
+        a = self.base.replace(u'four', u'4')
+        self.assertEqual(mw.merge3.merge(self.base, a, a), (a, 0))
+
+    def test_conflict(self):
+        a = self.base.replace(u'four', u'mine')
+        b = self.base.replace(u'four', u'theirs')
+        text, conflicts = mw.merge3.merge(self.base, a, b, u'local',
+                                          u'wiki')
+        self.assertEqual(conflicts, 1)
+        self.assertEqual(text, u'one\ntwo\nthree\n<<<<<<< local\nmine\n'
+                               u'=======\ntheirs\n>>>>>>> wiki\nfive\nsix\n'
+                               u'seven')
+
+    def test_round_trips(self):
+        # whatever the changes, taking one side of every conflict gives
+        # back that side when the other side didn't change anything
+        rng = random.Random(0)
+        lines = self.base.split(u'\n')
+        for _ in range(200):
+            a = list(lines)
+            for _ in range(rng.randint(0, 4)):
+                k = rng.randint(0, len(a) - 1)
+                a[k] = u'changed %d' % rng.randint(0, 3)
+            a = u'\n'.join(a)
+            self.assertEqual(mw.merge3.merge(self.base, a, self.base),
+                             (a, 0))
+            self.assertEqual(mw.merge3.merge(self.base, self.base, a),
+                             (a, 0))
+            self.assertEqual(mw.merge3.merge(self.base, a, a), (a, 0))
+
+    def test_regions(self):
+        base = [u'a\n', u'b\n', u'c\n']
+        a = [u'a\n', u'B\n', u'c\n']
+        b = [u'a\n', u'b\n', u'c\n', u'd\n']
+        self.assertEqual(mw.merge3.merge_regions(base, a, b),
+                         [('same', [u'a\n']), ('a', [u'B\n']),
+                          ('same', [u'c\n']), ('b', [u'd\n'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
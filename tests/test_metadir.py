@@ -0,0 +1,200 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import mw.metadir
+
+
+class MetadirTestCase(unittest.TestCase):
+    # a checkout with a few pulled pages, made without any wiki
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        mw.metadir.Metadir().create('http://localhost/w/api.php')
+        self.metadir = mw.metadir.Metadir()
+        self.metadir.use_daemon = False
+        for pageid in range(1, 4):
+            self.add_page(self.metadir, pageid, u'text %d' % pageid)
+        self.metadir.cache_commit()
+        self.metadir.index_save()
+        self.age_files()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def add_page(self, metadir, pageid, text, revid=None):
+        revid = revid or pageid
+        metadir.pagedict_add(u'Page %d' % pageid, pageid, revid)
+        metadir.pages_add_rv(pageid, {'revid': revid, 'user': 'Test',
+                                      'timestamp': '2011-01-01T00:00:00Z',
+                                      '*': text})
+        metadir.write_working_file('Page_%d.wiki' % pageid,
+                                   text.encode('utf-8'))
+
+    def age_files(self):
+        # files written within a second of the index aren't trusted
+        old = int(time.time()) - 10
+        for name in os.listdir(self.tmp):
+            if name.endswith('.wiki'):
+                os.utime(name, (old, old))
+
+    def write(self, name, data, keep_stat=False):
+        st = os.stat(name)
+        fd = file(name, 'r+b' if keep_stat else 'wb')
+        fd.write(data)
+        fd.close()
+        if keep_stat:
+            os.utime(name, (st.st_atime, st.st_mtime))
+
+    def status(self, metadir=None, **kwargs):
+        return (metadir or self.metadir).working_dir_status(**kwargs)
+
+
+class IndexTest(MetadirTestCase):
+
+    def test_status(self):
+        self.assertEqual(self.status(), {'Page_1.wiki': 'C',
+                                         'Page_2.wiki': 'C',
+                                         'Page_3.wiki': 'C'})
+        self.write('Page_2.wiki', 'changed')
+        file('New.wiki', 'w').write('new')
+        self.assertEqual(self.status(clean=False)['Page_2.wiki'], 'M')
+        self.assertEqual(self.status()['New.wiki'], '?')
+
+    def test_trailing_newline_is_clean(self):
+        self.write('Page_1.wiki', 'text 1\n')
+        self.assertEqual(self.status()['Page_1.wiki'], 'C')
+
+    def test_unchanged_stat_is_not_read(self):
+        self.status()
+        # same size, mtime and inode: only the index can say it's clean
+        self.write('Page_1.wiki', 'TEXT 1', keep_stat=True)
+        metadir = mw.metadir.Metadir()
+        self.assertEqual(self.status(metadir)['Page_1.wiki'], 'C')
+        self.assertEqual(self.status(metadir, refresh=True)['Page_1.wiki'],
+                         'M')
+
+    def test_recent_files_are_read(self):
+        self.write('Page_1.wiki', 'TEXT 1')
+        now = int(time.time())
+        os.utime('Page_1.wiki', (now, now))
+        self.assertEqual(self.status()['Page_1.wiki'], 'M')
+        # changed again without its mtime moving, right after the index
+        # was written
+        self.write('Page_1.wiki', 'text 1', keep_stat=True)
+        metadir = mw.metadir.Metadir()
+        self.assertEqual(self.status(metadir)['Page_1.wiki'], 'C')
+
+    def test_saves_merge(self):
+        self.status()
+        other = mw.metadir.Metadir()
+        self.status(other)
+        # both change a different file and save, one after the other
+        self.write('Page_1.wiki', 'one')
+        self.write('Page_2.wiki', 'two')
+        self.age_files()
+        self.status(files=['Page_1.wiki'])
+        self.status(other, files=['Page_2.wiki'])
+        entries = json.load(file('.mw/index'))['entries']
+        self.assertEqual(entries['Page_1.wiki'][4], 'M')
+        self.assertEqual(entries['Page_2.wiki'][4], 'M')
+        self.assertEqual(entries['Page_3.wiki'][4], 'C')
+
+    def test_forget(self):
+        self.status()
+        self.metadir.index_forget('Page_3.wiki')
+        self.metadir.index_save()
+        entries = json.load(file('.mw/index'))['entries']
+        self.assertFalse('Page_3.wiki' in entries)
+
+
+class JournalTest(MetadirTestCase):
+
+    def setUp(self):
+        MetadirTestCase.setUp(self)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        MetadirTestCase.tearDown(self)
+
+    def test_interrupted_after_commit_point_finishes(self):
+        def interrupted(journal):
+            raise KeyboardInterrupt
+        self.metadir._finish_batch = interrupted
+        self.add_page(self.metadir, 1, u'new text', revid=5)
+        self.assertRaises(KeyboardInterrupt, self.metadir.cache_commit)
+        self.assertEqual(file('Page_1.wiki').read(), 'text 1')
+        self.assertTrue(os.path.exists('.mw/journal'))
+        metadir = mw.metadir.Metadir()
+        self.assertTrue('finished writing 1 files' in sys.stdout.getvalue())
+        self.assertEqual(file('Page_1.wiki').read(), 'new text')
+        self.assertFalse(os.path.exists('.mw/journal'))
+        self.assertEqual(metadir.working_dir_status()['Page_1.wiki'], 'C')
+        self.assertEqual(os.listdir('.mw/tmp'), [])
+
+    def test_interrupted_before_commit_point_rolls_back(self):
+        store = self.metadir._store()
+        store.journal_mark = lambda batch: None
+        commit = store.commit
+
+        def interrupted(sync=False):
+            raise KeyboardInterrupt
+        store.commit = interrupted
+        try:
+            self.add_page(self.metadir, 1, u'new text', revid=5)
+            self.assertRaises(KeyboardInterrupt,
+                              self.metadir.cache_commit)
+        finally:
+            del store.journal_mark
+            store.commit = commit
+        store.rollback()
+        metadir = mw.metadir.Metadir()
+        self.assertTrue('rolled back' in sys.stdout.getvalue())
+        self.assertEqual(file('Page_1.wiki').read(), 'text 1')
+        self.assertEqual(metadir.pages_get_rv_list({'id': 1})[-1], 1)
+        self.assertFalse(os.path.exists('.mw/journal'))
+        self.assertEqual(metadir.working_dir_status()['Page_1.wiki'], 'C')
+
+
+class FilenameTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for title in [u'Main Page', u'Template:Foo bar', u'Caf\xe9/sub']:
+            filename = mw.metadir.pagename_to_filename(title)
+            self.assertFalse(' ' in filename)
+            self.assertEqual(mw.metadir.filename_to_pagename(filename),
+                             title)
+
+
+if __name__ == '__main__':
+    unittest.main()
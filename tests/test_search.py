@@ -0,0 +1,79 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import mw.search
+
+
+class RequiredTermsTest(unittest.TestCase):
+
+    def terms(self, pattern, flags=0):
+        return mw.search.required_terms(pattern, flags)
+
+    def test_plain_words(self):
+        self.assertEqual(self.terms(u'hello big world'),
+                         [('substring', u'hello'), ('exact', u'big'),
+                          ('prefix', u'world')])
+
+    def test_boundaries(self):
+        self.assertEqual(self.terms(r'\bword\b'), [('exact', u'word')])
+        self.assertEqual(self.terms(r'^start'), [('prefix', u'start')])
+
+    def test_lowercased(self):
+        self.assertEqual(self.terms(u'\\bMain\\b', re.IGNORECASE),
+                         [('exact', u'main')])
+
+    def test_short_substrings_are_dropped(self):
+        self.assertEqual(self.terms(u'ab'), [])
+
+    def test_regex_parts_break_runs(self):
+        # nothing inside the alternation or after the repeat is required
+        self.assertEqual(self.terms(u'\\bfoo(bar|baz)'),
+                         [('prefix', u'foo')])
+        self.assertEqual(self.terms(u'\\bcolou?r\\b'),
+                         [('prefix', u'colo')])
+
+    def test_terms_never_miss_a_match(self):
+        text = u'The Main Page links to [[Help:Contents]].'
+        words = mw.search.tokenize(text)
+        for pattern in [u'Main Page', u'\\bHelp:Con', u'links? to',
+                        u'ontent', u'[[]Help']:
+            self.assertTrue(re.search(pattern, text))
+            for kind, term in self.terms(pattern):
+                if kind == 'exact':
+                    self.assertTrue(term in words, (pattern, term))
+                elif kind == 'prefix':
+                    self.assertTrue([w for w in words if w.startswith(term)],
+                                    (pattern, term))
+                else:
+                    self.assertTrue([w for w in words if term in w],
+                                    (pattern, term))
+
+    def test_tokenize(self):
+        self.assertEqual(mw.search.tokenize(u'Foo bar, foo! caf\xe9'),
+                         set([u'foo', u'bar', u'caf\xe9']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import mw.objects
+import mw.store
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = mw.store.SqliteStore(os.path.join(self.tmp, 'store.db'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp)
+
+    def objects(self):
+        return dict((row[0], row) for row in self.store.db.execute(
+                'SELECT sha1, base, depth FROM objects'))
+
+    def check_depths(self):
+        objects = self.objects()
+        for sha1, base, depth in objects.itervalues():
+            steps = 0
+            while objects[sha1][1] is not None:
+                sha1 = objects[sha1][1]
+                steps += 1
+            self.assertEqual(steps, depth)
+            self.assertTrue(depth <= mw.objects.MAX_DEPTH)
+
+    def revisions(self, count):
+        rng = random.Random(0)
+        lines = [u'line %d\n' % i for i in range(100)]
+        texts = []
+        for _ in range(count):
+            lines[rng.randint(0, 99)] = u'changed %d\n' % rng.randint(0, 9)
+            texts.append(u''.join(lines))
+        return texts
+
+    def test_latest_is_whole(self):
+        texts = self.revisions(40)
+        for revid, text in enumerate(texts):
+            self.store.rv_add(1, revid + 1, 'user', 'now', text)
+        self.store.commit()
+        objects = self.objects()
+        self.assertEqual(objects[self.store.rv_sha1(1, 40)][2], 0)
+        # and the older ones are deltas, not full copies
+        self.assertTrue(max(row[2] for row in objects.itervalues()) > 1)
+        for revid, text in enumerate(texts):
+            self.assertEqual(self.store.rv_get(1, revid + 1)['content'], text)
+        self.check_depths()
+
+    def test_history_and_reverts(self):
+        texts = self.revisions(30)
+        # the newest revisions first, then history in between
+        for revid in range(20, 30):
+            self.store.rv_add(1, revid + 1, 'user', 'now', texts[revid])
+        for revid in range(19, -1, -1):
+            self.store.rv_add(1, revid + 1, 'user', 'now', texts[revid])
+        # a revert brings an old text back as the latest
+        self.store.rv_add(1, 31, 'user', 'now', texts[3])
+        texts.append(texts[3])
+        self.assertEqual(self.objects()[self.store.rv_sha1(1, 31)][2], 0)
+        for revid, text in enumerate(texts):
+            self.assertEqual(self.store.rv_get(1, revid + 1)['content'], text)
+        self.check_depths()
+
+    def test_sequential_puts(self):
+        # pulled forward in time, every revision replaces the one before
+        # as the full copy; the old full copies mustn't stay in the packs
+        texts = self.revisions(40)
+        for revid, text in enumerate(texts):
+            self.store.rv_add(1, revid + 1, 'user', 'now', text)
+        self.store.commit()
+        forward = self.pack_size()
+        self.assertEqual(forward, self.store.db.execute(
+                'SELECT SUM(length) FROM objects WHERE pack != ?',
+                (mw.objects.LOOSE,)).fetchone()[0])
+        for revid, text in enumerate(texts):
+            self.assertEqual(self.store.rv_get(1, revid + 1)['content'], text)
+        self.store.close()
+        shutil.rmtree(self.tmp)
+        self.tmp = tempfile.mkdtemp()
+        self.store = mw.store.SqliteStore(os.path.join(self.tmp, 'store.db'))
+        for revid in range(39, -1, -1):
+            self.store.rv_add(1, revid + 1, 'user', 'now', texts[revid])
+        self.store.commit()
+        self.assertTrue(forward <= self.pack_size() * 1.5,
+                        (forward, self.pack_size()))
+
+    def pack_size(self):
+        location = os.path.join(self.tmp, 'objects')
+        return sum(os.path.getsize(os.path.join(location, name))
+                   for name in os.listdir(location))
+
+    def test_reopen(self):
+        self.store.rv_add(1, 1, 'user', 'now', u'one')
+        self.store.rv_add(1, 2, 'user', 'now', u'one\ntwo')
+        self.store.commit()
+        self.store.close()
+        self.store = mw.store.SqliteStore(os.path.join(self.tmp, 'store.db'))
+        self.assertEqual(self.store.rv_get(1, 1)['content'], u'one')
+        self.assertEqual(self.store.rv_get(1, 2)['content'], u'one\ntwo')
+
+
+class DeltaTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        base = u'a\nb\nc\nd\n'
+        for text in [u'', u'a\nb\nc\nd\n', u'x\na\nc\nd\ny', u'd\nc\nb\na\n']:
+            self.assertEqual(mw.objects.apply_delta(
+                    base, mw.objects.make_delta(base, text)), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+import BaseHTTPServer
+import json
+import os
+import SocketServer
+import sys
+import threading
+import unittest
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import mw.transport
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # /api.php answers with what it was asked, the paths in MOVED send
+    # the client on with the status given
+    protocol_version = 'HTTP/1.1'
+    MOVED = {
+            '/old.php': (301, '/api.php'),
+            '/found.php': (302, '/api.php'),
+            '/other.php': (303, '/api.php'),
+            '/temporary.php': (307, '/api.php'),
+            '/permanent.php': (308, '/api.php'),
+            '/loop.php': (302, '/loop.php'),
+    }
+
+    def do_GET(self):
+        self.answer('GET', urlparse.urlsplit(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        self.answer('POST', self.rfile.read(length))
+
+    def answer(self, method, query):
+        path = urlparse.urlsplit(self.path).path
+        if path in self.MOVED:
+            status, location = self.MOVED[path]
+            if path == '/old.php':
+                # to another host name for the same server
+                location = 'http://localhost:%d%s' % (
+                        self.server.server_address[1], location)
+            if urlparse.urlsplit(self.path).query:
+                location += '?' + urlparse.urlsplit(self.path).query
+            self.send_response(status)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        params = dict(urlparse.parse_qsl(query))
+        result = {'method': method, 'params': params}
+        if params.get('maxlag'):
+            result = {'error': {'code': 'maxlag', 'info': 'lagged'}}
+        body = json.dumps(result)
+        self.send_response(200)
+        if params.get('maxlag'):
+            self.send_header('Retry-After', params['maxlag'])
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # pooled keep-alive connections stay open between requests
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # the client closed a keep-alive connection
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.apis = []
+
+    def tearDown(self):
+        for api in self.apis:
+            api.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def transport(self, path):
+        api = mw.transport.Transport('http://127.0.0.1:%d%s' % (
+                self.server.server_address[1], path))
+        self.apis.append(api)
+        return api
+
+    def test_redirects(self):
+        read = {'action': 'query', 'titles': 'Page'}
+        edit = {'action': 'edit', 'title': 'Page', 'text': 'x'}
+        for path in ['/old.php', '/found.php', '/temporary.php',
+                     '/permanent.php']:
+            api = self.transport(path)
+            result = api.call(read)
+            self.assertEqual(result['method'], 'GET')
+            self.assertEqual(result['params']['titles'], 'Page')
+            # the parameters of a POST go along with it
+            result = api.call(edit)
+            self.assertEqual(result['method'], 'POST', path)
+            self.assertEqual(result['params']['text'], 'x', path)
+        result = self.transport('/other.php').call(edit)
+        self.assertEqual(result['method'], 'GET')
+
+    def test_redirect_loop(self):
+        api = self.transport('/loop.php')
+        self.assertRaises(mw.transport.TransportError, api.call,
+                          {'action': 'query'})
+
+    def test_retry_after(self):
+        api = self.transport('/api.php')
+        result = api.call({'action': 'query', 'maxlag': '7'})
+        self.assertEqual(result['error']['retryafter'], 7)
+        self.assertFalse('error' in api.call({'action': 'query'}))
+
+
+if __name__ == '__main__':
+    unittest.main()